@@ -0,0 +1,125 @@
+import sys, os, timeit, random, string
+
+file_directory = sys.path[0]
+sys.path.insert(1, os.path.dirname(file_directory))
+from src import bloom_filter as b
+
+# Helpers
+def random_string(stringLength):
+    letters = string.ascii_letters
+    return ''.join(random.choice(letters) for i in range(stringLength))
+
+# A false positive probability of 2^-(k + 0.5) yields k hash functions
+def probability_for(num_hash_fns):
+    return 0.5 ** (num_hash_fns + 0.5)
+
+num_items = 100000
+keys_by_length = {
+    key_length: [random_string(key_length) for i in range(num_items)]
+    for key_length in [10, 200]
+}
+
+setup = """
+from __main__ import b, keys_by_length, num_items, probability_for
+keys = keys_by_length[{key_length}]
+"""
+
+print("Bloom filter benchmarks")
+
+#
+#
+# Add and check 100k keys, seeded hashing vs double hashing, for growing k
+#
+#
+for key_length in keys_by_length:
+    print('\n100k keys of length {}'.format(key_length))
+    print('{: <6}{: <18}{: <18}{: <18}{: <18}'.format(
+        'k', 'add (seeded)', 'add (double)', 'check (seeded)', 'check (double)'))
+
+    for num_hash_fns in [1, 2, 4, 7, 10, 14]:
+        timings = []
+        for operation in ['add', 'check']:
+            for double_hashing in [False, True]:
+                benchmark_setup = setup.format(key_length=key_length) + """
+bf = b.BloomFilter(num_items, probability_for({k}), double_hashing={double_hashing})
+for key in keys:
+    bf.add(key)
+""".format(k=num_hash_fns, double_hashing=double_hashing)
+                benchmark_execute = """
+for key in keys:
+    bf.{operation}(key)
+""".format(operation=operation)
+                timings.append(timeit.timeit(
+                    benchmark_execute, setup=benchmark_setup, number=1))
+
+        print('{: <6}{: <18.4f}{: <18.4f}{: <18.4f}{: <18.4f}'.format(num_hash_fns, *timings))
+
+#
+#
+# Check 100k present and 100k absent keys, standard vs blocked layout
+#
+#
+# Fill the filters up to their expected number of items, so they span several
+# megabytes and the false positive rates are meaningful.
+filter_num_items = 1000000
+stored_keys = ['present' + str(i) for i in range(filter_num_items)]
+checked_keys = stored_keys[:num_items] + ['absent' + str(i) for i in range(num_items)]
+
+print('\n100k present and 100k absent keys, filters holding 1 million keys')
+print('{: <10}{: <6}{: <18}{: <18}{: <18}{: <18}'.format(
+    'p', 'k', 'check (standard)', 'check (blocked)', 'fp (standard)', 'fp (blocked)'))
+
+for probability in [0.2, 0.05, 0.01, 0.001]:
+    timings, false_positive_rates = [], []
+    for filter_class in [b.BloomFilter, b.BlockedBloomFilter]:
+        bf = filter_class(filter_num_items, probability)
+        for key in stored_keys:
+            bf.add(key)
+
+        benchmark_setup = """
+from __main__ import bf, checked_keys
+"""
+        benchmark_execute = """
+for key in checked_keys:
+    bf.check(key)
+"""
+        timings.append(timeit.timeit(
+            benchmark_execute, setup=benchmark_setup, number=1))
+        false_positive_rates.append(
+            sum(bf.check(key) for key in checked_keys[num_items:]) / num_items)
+
+    print('{: <10}{: <6}{: <18.4f}{: <18.4f}{: <18.4f}{: <18.4f}'.format(
+        probability, bf.num_hash_fns, *timings, *false_positive_rates))
+
+#
+#
+# Add and check 100k keys one at a time vs in bulk
+#
+#
+print('\n100k keys of length 10, p = 0.01, one at a time vs in bulk')
+print('{: <16}{: <14}{: <14}{: <14}{: <14}'.format(
+    'filter', 'add', 'add_many', 'check', 'check_many'))
+
+filter_constructors = [
+    ('seeded', 'b.BloomFilter(num_items, 0.01)'),
+    ('double', 'b.BloomFilter(num_items, 0.01, double_hashing=True)'),
+    ('blocked', 'b.BlockedBloomFilter(num_items, 0.01)'),
+    ('scalable', 'b.ScalableBloomFilter(num_items // 10, 0.01)'),
+]
+
+for name, constructor in filter_constructors:
+    benchmark_setup = setup.format(key_length=10) + """
+bf = {constructor}
+""".format(constructor=constructor)
+    filled_setup = benchmark_setup + """
+bf.add_many(keys)
+keys = keys + [key.swapcase() for key in keys]
+"""
+
+    timings = [
+        timeit.timeit('for key in keys:\n    bf.add(key)', setup=benchmark_setup, number=1),
+        timeit.timeit('bf.add_many(keys)', setup=benchmark_setup, number=1),
+        timeit.timeit('for key in keys:\n    bf.check(key)', setup=filled_setup, number=1),
+        timeit.timeit('bf.check_many(keys)', setup=filled_setup, number=1),
+    ]
+    print('{: <16}{: <14.4f}{: <14.4f}{: <14.4f}{: <14.4f}'.format(name, *timings))
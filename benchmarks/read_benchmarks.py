@@ -114,6 +114,65 @@ print('10k misses, lots of segments on disk', timeit.timeit(
     number=1)
 )
 
+print()
+print("ROW CACHE")
+#
+#
+# Read 100k keys drawn from a Zipfian-like distribution over 100k keys spread
+# across many segments, without then with a row cache
+#
+#
+for filename in os.listdir(path):
+    os.remove(path + filename)
+
+db = s.LSMTree('test_file-1', path, 'bkup')
+db.set_threshold(100000)
+keys = [str(k).zfill(6) for k in range(100000)]
+for key in random.sample(keys, len(keys)):
+    db.db_set(key, key)
+db.wait_for_flush()
+hot_keys = [keys[int(random.paretovariate(1.1)) % len(keys)] for i in range(100000)]
+random.shuffle(hot_keys)
+
+for capacity in [0, 1000000]:
+    db.set_row_cache_size(capacity)
+    db.row_cache.hits = db.row_cache.misses = 0
+    seconds = min(timeit.repeat(
+        lambda: [db.db_get(key) for key in hot_keys], number=1, repeat=3))
+    print('100k Zipfian reads, row cache of {} bytes: {} (hit rate {:.3f})'.format(
+        capacity, seconds, db.row_cache.hit_rate()))
+db.close()
+
+print()
+print("MULTI GET")
+#
+#
+# Read 10k random keys, then 10k adjacent keys, out of 100k keys spread across
+# many segments of each format, with a db_get loop and with a single multi_get
+#
+#
+for segment_format in ['csv', 'sstable']:
+    for filename in os.listdir(path):
+        os.remove(path + filename)
+
+    db = s.LSMTree('test_file-1', path, 'bkup')
+    db.set_segment_format(segment_format)
+    db.set_threshold(100000)
+    db.set_sparsity_factor(1000)
+    for key in random.sample(keys, len(keys)):
+        db.db_set(key, key)
+    db.wait_for_flush()
+
+    start = random.randrange(len(keys) - 10000)
+    for name, batch in [('random', random.sample(keys, 10000)), ('adjacent', keys[start:start + 10000])]:
+        loop_seconds = min(timeit.repeat(
+            lambda: [db.db_get(key) for key in batch], number=1, repeat=3))
+        multi_get_seconds = min(timeit.repeat(
+            lambda: db.multi_get(batch), number=1, repeat=3))
+        print('10k {} keys, {}: db_get loop {}, multi_get {}'.format(
+            name, segment_format, loop_seconds, multi_get_seconds))
+    db.close()
+
 # Cleanup
 for filename in os.listdir(path):
     os.remove(path + filename)
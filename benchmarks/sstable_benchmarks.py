@@ -0,0 +1,133 @@
+import sys, os, timeit, random
+
+file_directory = sys.path[0]
+sys.path.insert(1, os.path.dirname(file_directory))
+from src import lsm_tree as s
+
+# SETUP
+path = file_directory + '/benchmark_segments/'
+
+# Keys share long prefixes, like tenant IDs followed by timestamps
+num_keys = 100000
+pairs = sorted(
+    ('tenant-{:04d}/2024-01-{:02d}T{:06d}'.format(i % 50, i % 28 + 1, i), 'value' + str(i))
+    for i in range(num_keys))
+lookups = [random.choice(pairs)[0] for i in range(20000)]
+
+setup = """
+from __main__ import db, segment, lookups
+"""
+
+print("SSTable benchmarks")
+
+#
+#
+# Write 100k keys to a single segment in each format, then measure its size and
+# the time taken by 20k random lookups through the read path
+#
+#
+print('{: <28}{: <16}{: <16}{: <16}'.format('format', 'bytes', 'write', '20k lookups'))
+for segment_format, restart_interval in [('csv', None), ('sstable', 1), ('sstable', 16)]:
+    db = s.LSMTree('test_file-1', path, 'bkup')
+    # Index a CSV key every 100 records, about as often as the tables' 4KB blocks
+    db.set_threshold(10000)
+    db.set_segment_format(segment_format)
+    if restart_interval is not None:
+        db.set_restart_interval(restart_interval)
+
+    segment = db.new_segment_name()
+    write_seconds = timeit.timeit(
+        lambda: db.write_segment(db.segment_path(segment), segment, iter(pairs)), number=1)
+
+    size = db.get_file_size(db.segment_path(segment))
+    if segment_format == 'csv':
+        size += db.get_file_size(db.index_path(db.segment_path(segment)))
+
+    read_seconds = min(timeit.repeat("""
+for key in lookups:
+    db.search_filtered_segment(key, segment)
+""", setup=setup, number=1, repeat=3))
+
+    name = segment_format if restart_interval is None else \
+        '{}, restart every {}'.format(segment_format, restart_interval)
+    print('{: <28}{: <16}{: <16.4f}{: <16.4f}'.format(name, size, write_seconds, read_seconds))
+
+    db.close()
+    for filename in os.listdir(path):
+        os.remove(path + filename)
+
+print()
+print("COMPRESSION")
+#
+#
+# Write 100k keys with compressible values to a single table with each block
+# compression, then measure its size and the time taken by 20k random lookups
+#
+#
+pairs = [
+    (key, '{{"id": {}, "status": "active", "region": "eu-west-1", "tags": ["a", "b"]}}'.format(i))
+    for i, (key, value) in enumerate(pairs)]
+
+print('{: <28}{: <16}{: <16}{: <16}'.format('compression', 'bytes', 'write', '20k lookups'))
+for compression, level in [('none', None), ('zlib', 1), ('zlib', 6), ('bz2', 9), ('lzma', 6)]:
+    db = s.LSMTree('test_file-1', path, 'bkup')
+    db.set_segment_format('sstable')
+    db.set_compression(compression, level)
+
+    segment = db.new_segment_name()
+    write_seconds = timeit.timeit(
+        lambda: db.write_segment(db.segment_path(segment), segment, iter(pairs)), number=1)
+    size = db.get_file_size(db.segment_path(segment))
+
+    read_seconds = min(timeit.repeat("""
+for key in lookups:
+    db.search_filtered_segment(key, segment)
+""", setup=setup, number=1, repeat=3))
+
+    name = compression if level is None else '{}, level {}'.format(compression, level)
+    print('{: <28}{: <16}{: <16.4f}{: <16.4f}'.format(name, size, write_seconds, read_seconds))
+
+    db.close()
+    for filename in os.listdir(path):
+        os.remove(path + filename)
+
+print()
+print("BLOCK CACHE")
+#
+#
+# Look up 20k uniformly random keys, then 20k keys skewed towards a hot set, in a
+# zlib compressed table with block caches of several sizes
+#
+#
+hot_lookups = [pairs[int(random.paretovariate(1.2)) % num_keys][0] for i in range(20000)]
+random.shuffle(hot_lookups)
+
+print('{: <28}{: <16}{: <16}{: <16}{: <16}'.format(
+    'block cache', 'uniform', 'hit rate', 'hot', 'hit rate'))
+for capacity in [0, 1000000, 8000000, 64000000]:
+    db = s.LSMTree('test_file-1', path, 'bkup')
+    db.set_segment_format('sstable')
+    db.set_compression('zlib')
+    db.set_block_cache_size(capacity)
+
+    segment = db.new_segment_name()
+    db.write_segment(db.segment_path(segment), segment, iter(pairs))
+
+    results = []
+    for keys in [lookups, hot_lookups]:
+        db.block_cache.hits = db.block_cache.misses = 0
+        results.append(min(timeit.repeat("""
+for key in keys:
+    db.search_filtered_segment(key, segment)
+""", setup=setup + 'from __main__ import keys', number=1, repeat=3)))
+        results.append(db.block_cache.hit_rate())
+
+    print('{: <28}{: <16.4f}{: <16.3f}{: <16.4f}{: <16.3f}'.format(
+        '{} bytes'.format(capacity), *results))
+
+    db.close()
+    for filename in os.listdir(path):
+        os.remove(path + filename)
+
+# Cleanup
+os.rmdir(path)
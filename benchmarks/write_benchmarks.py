@@ -1,4 +1,4 @@
-import sys, os, timeit, random, string
+import sys, os, time, timeit, random, string
 
 file_directory = sys.path[0]
 sys.path.insert(1, os.path.dirname(file_directory))
@@ -254,6 +254,174 @@ print(
         benchmark_execute, setup=benchmark_setup, number=1))
 )
 
+
+print()
+print("WRITE AMPLIFICATION")
+#
+#
+# Write 200k random keys out of 50k with each compaction strategy, low threshold.
+# Write amplification is the number of bytes written to segments for every byte
+# flushed from the memtable.
+#
+#
+amplification = []
+for strategy in ['leveled', 'size_tiered']:
+    benchmark_setup = setup + """
+from __main__ import amplification
+db.set_threshold(50000)
+db.set_compaction_strategy('{}')
+keys = [str(random.randrange(50000)) for i in range(200000)]
+""".format(strategy)
+    benchmark_execute = """
+for key in keys:
+    db.db_set(key, key)
+amplification.append((db.bytes_flushed + db.bytes_compacted) / db.bytes_flushed)
+"""
+    print(
+        'Random keys 200k times, threshold 50K bytes, {} compaction: {}'.format(
+            strategy, timeit.timeit(benchmark_execute, setup=benchmark_setup, number=1))
+    )
+    print('Write amplification, {} compaction: {:.2f}'.format(strategy, amplification[-1]))
+
+print()
+print("WAL SYNC POLICIES")
+#
+#
+# Write 5k unique keys with each write ahead log sync policy
+#
+#
+for policy, interval in [('none', 0), ('flush', 0), ('fsync_interval', 0.01), ('fdatasync', 0), ('fsync', 0)]:
+    benchmark_setup = setup + """
+db.set_wal_sync_policy('{}', {})
+pairs = [(str(k), str(k)) for k in range(5000)]
+""".format(policy, interval)
+    benchmark_execute = """
+for key, val in pairs:
+    db.db_set(key, val)
+"""
+    seconds = timeit.timeit(benchmark_execute, setup=benchmark_setup, number=1)
+    print('Write 5k keys, {} sync: {} ({:.0f} writes/sec)'.format(policy, seconds, 5000 / seconds))
+
+print()
+print("GROUP COMMIT")
+#
+#
+# Write 5k unique keys with every write ahead log write fsynced, grouping
+# more and more of them into each commit
+#
+#
+for max_batch, max_delay in [(1, 0), (8, 0.001), (64, 0.005), (512, 0.01)]:
+    benchmark_setup = setup + """
+db.set_wal_sync_policy('fsync')
+db.set_wal_group_commit({}, {})
+pairs = [(str(k), str(k)) for k in range(5000)]
+""".format(max_batch, max_delay)
+    benchmark_execute = """
+for key, val in pairs:
+    db.db_set(key, val)
+db.memtable_wal().commit()
+"""
+    seconds = timeit.timeit(benchmark_execute, setup=benchmark_setup, number=1)
+    print('Write 5k keys, fsync, batches of {} or {}s: {} ({:.0f} writes/sec)'.format(
+        max_batch, max_delay, seconds, 5000 / seconds))
+
+print()
+print("ASYNC WAL")
+#
+#
+# Write 20k unique keys with the write ahead log committed by the writing thread,
+# then by a dedicated writer thread, waiting for every write to be committed
+#
+#
+for policy in ['flush', 'fsync']:
+    for enabled in [False, True]:
+        benchmark_setup = setup + """
+db.set_wal_sync_policy('{}')
+db.set_wal_async({})
+pairs = [(str(k), str(k)) for k in range(20000)]
+""".format(policy, enabled)
+        benchmark_execute = """
+for key, val in pairs:
+    handle = db.db_set(key, val)
+handle.wait()
+db.set_wal_async(False)
+"""
+        seconds = timeit.timeit(benchmark_execute, setup=benchmark_setup, number=1)
+        print('Write 20k keys, {} sync, {} WAL writes: {} ({:.0f} writes/sec)'.format(
+            policy, 'async' if enabled else 'inline', seconds, 20000 / seconds))
+
+print()
+print("TAIL LATENCY")
+#
+#
+# Time each of 300k unique writes with flushes and compaction run inline and in
+# the background. The writes crossing the threshold make up the tail.
+#
+#
+for background in [False, True]:
+    for filename in os.listdir(path) if os.path.exists(path) else []:
+        os.remove(path + filename)
+
+    db = s.LSMTree('test_file-1', path, 'bkup')
+    db.set_threshold(100000)
+    db.set_background_compaction(background)
+    pairs = [(str(k), str(k)) for k in range(300000)]
+
+    latencies = []
+    for key, val in pairs:
+        start = time.perf_counter()
+        db.db_set(key, val)
+        latencies.append(time.perf_counter() - start)
+    db.wait_for_flush()
+
+    latencies.sort()
+    print('db_set latency, {} compaction: p50 {:.6f} p99.9 {:.6f} max {:.6f}'.format(
+        'background' if background else 'inline',
+        latencies[len(latencies) // 2],
+        latencies[len(latencies) * 999 // 1000],
+        latencies[-1]))
+
+print()
+print("STARTUP")
+#
+#
+# Restart a database whose write ahead log holds 200k writes to 20k keys, and
+# compare with inserting every record into the memtable one at a time
+#
+#
+for filename in os.listdir(path) if os.path.exists(path) else []:
+    os.remove(path + filename)
+
+db = s.LSMTree('test_file-1', path, 'bkup')
+db.set_threshold(100000000)
+db.set_wal_group_commit(1000, 1)
+for i in range(200000):
+    db.db_set('key' + str(random.randrange(20000)), random_string(10))
+db.close()
+
+benchmark_setup = """
+from __main__ import s, path
+"""
+benchmark_execute = """
+db = s.LSMTree('test_file-1', path, 'bkup')
+db.close()
+"""
+print('Restart with 200k logged writes to 20k keys: {}'.format(
+    min(timeit.repeat(benchmark_execute, setup=benchmark_setup, number=1, repeat=3))))
+
+benchmark_setup = """
+from __main__ import s, path
+from src.append_log import read_records
+from src.red_black_tree import RedBlackTree
+"""
+benchmark_execute = """
+memtable = RedBlackTree()
+for op, key, value in read_records(path + 'bkup-1')[0]:
+    memtable.add(key, value)
+"""
+print('Replay the same log record by record: {}'.format(
+    min(timeit.repeat(benchmark_execute, setup=benchmark_setup, number=1, repeat=3))))
+
 # Cleanup
 for filename in os.listdir(path):
     os.remove(path + filename)
@@ -12,11 +12,28 @@ def main():
         ['Commands: ', 'Explanation'],
         ['store {key} {data}', 'Store the key value vair in the DB'],
         ['get {key}', 'Retrieve the value for key. Returns None if it doesnt exist'],
+        ['multi_get {key} [key ...]', 'Retrieve the values for several keys at once'],
         ['\n\tConfiguration:', ''],
         ['set_threshold {number of bytes}', 'Set the threshold for the size of the memtable in bytes'],
         ['set_sparsity {value}', 'Set the sparsity factor for the DBs index'],
         ['set_bf_num_items {items}', 'Set the number of expected items to be stored in the Bloom Filter. Warning: this overrides it.'],
         ['set_bf_false_pos_prob {probability}', 'Set the desired false positive probability for the Bloom Filter. Warning: this overrides it.'],
+        ['set_bf_scalable {on|off}', 'Set whether the Bloom Filter grows past its expected num items. Warning: this overrides it.'],
+        ['set_bf_double_hashing {on|off}', 'Set whether the Bloom Filter hashes each key only once. Warning: this overrides it.'],
+        ['set_bf_blocked {on|off}', 'Set whether the Bloom Filter keeps the bits of each key in one block. Warning: this overrides it.'],
+        ['set_level0_max_segments {segments}', 'Set the number of flushed segments that triggers a compaction'],
+        ['set_level_size_ratio {ratio}', 'Set how many times larger each level can grow than the previous one'],
+        ['set_compaction {leveled|size_tiered}', 'Set the compaction strategy'],
+        ['set_tier_size {segments}', 'Set the number of similarly sized segments merged by size-tiered compaction'],
+        ['set_background_compaction {on|off}', 'Set whether flushes and compaction run in a background thread'],
+        ['set_segment_format {csv|sstable}', 'Set the format new segments are written in'],
+        ['set_block_size {number of bytes}', 'Set the size of the data blocks of new SSTable segments'],
+        ['set_restart_interval {keys}', 'Set how often SSTable blocks store a key in full'],
+        ['set_compression {none|zlib|lzma|bz2} [level]', 'Set how SSTable blocks are compressed'],
+        ['set_level_compression {level} {none|zlib|lzma|bz2} [level]', 'Set how SSTable blocks are compressed in one level'],
+        ['set_max_open_files {number of files}', 'Set how many segments are kept open for reads'],
+        ['set_block_cache_size {number of bytes}', 'Set how many bytes of SSTable blocks are cached'],
+        ['set_row_cache_size {number of bytes}', 'Set how many bytes of values read from disk are cached'],
         ['', ''],
         ['help', 'Print the usage message'],
         ['exit', 'Quit the program. Your instance will be saved to disk.']
@@ -38,6 +55,9 @@ def main():
         elif cmd[0] == 'get':
             key = cmd[1]
             print('Key "' + key + '" has value:', db.db_get(key))
+        elif cmd[0] == 'multi_get':
+            for key, value in zip(cmd[1:], db.multi_get(cmd[1:])):
+                print('Key "' + key + '" has value:', value)
         elif cmd[0] == 'set_threshold':
             arg = int(cmd[1])
 
@@ -64,11 +84,129 @@ def main():
             else:
                 db.set_bloom_filter_false_pos_prob(arg)
                 print('Set the BloomFilters desired probability of a false positive to', arg)
+        elif cmd[0] == 'set_bf_scalable':
+            if cmd[1] not in ('on', 'off'):
+                print('Invalid option. Please choose on or off.')
+            else:
+                db.set_bloom_filter_scalable(cmd[1] == 'on')
+                print('Set the BloomFilters scalable mode', cmd[1])
+        elif cmd[0] == 'set_bf_double_hashing':
+            if cmd[1] not in ('on', 'off'):
+                print('Invalid option. Please choose on or off.')
+            else:
+                db.set_bloom_filter_double_hashing(cmd[1] == 'on')
+                print('Set the BloomFilters double hashing mode', cmd[1])
+        elif cmd[0] == 'set_bf_blocked':
+            if cmd[1] not in ('on', 'off'):
+                print('Invalid option. Please choose on or off.')
+            else:
+                db.set_bloom_filter_blocked(cmd[1] == 'on')
+                print('Set the BloomFilters blocked layout', cmd[1])
+        elif cmd[0] == 'set_level0_max_segments':
+            arg = int(cmd[1])
+
+            if arg <= 0:
+                print("Invalid option, plase choose a value greater than 0")
+            else:
+                db.set_level0_max_segments(arg)
+                print('Set the number of segments that triggers a compaction to {}'.format(arg))
+        elif cmd[0] == 'set_level_size_ratio':
+            arg = int(cmd[1])
+
+            if arg <= 1:
+                print("Invalid option, plase choose a value greater than 1")
+            else:
+                db.set_level_size_ratio(arg)
+                print('Set the level size ratio to {}'.format(arg))
+        elif cmd[0] == 'set_compaction':
+            if cmd[1] not in ('leveled', 'size_tiered'):
+                print('Invalid option. Please choose leveled or size_tiered.')
+            else:
+                db.set_compaction_strategy(cmd[1])
+                print('Set the compaction strategy to', cmd[1])
+        elif cmd[0] == 'set_tier_size':
+            arg = int(cmd[1])
+
+            if arg <= 1:
+                print("Invalid option, plase choose a value greater than 1")
+            else:
+                db.set_tier_size(arg)
+                print('Set the tier size to {}'.format(arg))
+        elif cmd[0] == 'set_background_compaction':
+            if cmd[1] not in ('on', 'off'):
+                print('Invalid option. Please choose on or off.')
+            else:
+                db.set_background_compaction(cmd[1] == 'on')
+                print('Set background compaction', cmd[1])
+        elif cmd[0] == 'set_segment_format':
+            if cmd[1] not in ('csv', 'sstable'):
+                print('Invalid option. Please choose csv or sstable.')
+            else:
+                db.set_segment_format(cmd[1])
+                print('Set the segment format to', cmd[1])
+        elif cmd[0] == 'set_block_size':
+            arg = int(cmd[1])
+
+            if arg <= 0:
+                print("Invalid option, plase choose a value greater than 0")
+            else:
+                db.set_block_size(arg)
+                print('Set the block size to {}'.format(arg))
+        elif cmd[0] == 'set_restart_interval':
+            arg = int(cmd[1])
+
+            if arg <= 0:
+                print("Invalid option, plase choose a value greater than 0")
+            else:
+                db.set_restart_interval(arg)
+                print('Set the restart interval to {}'.format(arg))
+        elif cmd[0] == 'set_compression':
+            level = int(cmd[2]) if len(cmd) > 2 else None
+
+            if cmd[1] not in ('none', 'zlib', 'lzma', 'bz2'):
+                print('Invalid option. Please choose none, zlib, lzma or bz2.')
+            else:
+                db.set_compression(cmd[1], level)
+                print('Set the compression to', cmd[1])
+        elif cmd[0] == 'set_level_compression':
+            level = int(cmd[1])
+            compression_level = int(cmd[3]) if len(cmd) > 3 else None
+
+            if cmd[2] not in ('none', 'zlib', 'lzma', 'bz2'):
+                print('Invalid option. Please choose none, zlib, lzma or bz2.')
+            else:
+                db.set_level_compression(level, cmd[2], compression_level)
+                print('Set the compression of level {} to {}'.format(level, cmd[2]))
+        elif cmd[0] == 'set_max_open_files':
+            arg = int(cmd[1])
+
+            if arg <= 0:
+                print("Invalid option, plase choose a value greater than 0")
+            else:
+                db.set_max_open_files(arg)
+                print('Set the maximum number of open files to {}'.format(arg))
+        elif cmd[0] == 'set_block_cache_size':
+            arg = int(cmd[1])
+
+            if arg < 0:
+                print("Invalid option, plase choose a value of at least 0")
+            else:
+                db.set_block_cache_size(arg)
+                print('Set the block cache size to {}'.format(arg))
+        elif cmd[0] == 'set_row_cache_size':
+            arg = int(cmd[1])
+
+            if arg < 0:
+                print("Invalid option, plase choose a value of at least 0")
+            else:
+                db.set_row_cache_size(arg)
+                print('Set the row cache size to {}'.format(arg))
         elif cmd[0] == 'help':
             for row in usage_msg:
                 print("\t{: <40} {: <10}".format(*row))
         elif cmd[0] == 'exit':
             db.save_metadata()
+            db.close()
             break
         else:
             print('Invalid command.')
@@ -1,35 +1,402 @@
-class Singleton:
-    def __init__(self, decorated):
-        self._decorated = decorated
+from os import fsync as fsync_file, fstat
+from mmap import mmap, ACCESS_READ
+from threading import Condition, RLock, Thread, Timer
+from queue import SimpleQueue, Empty
+from zlib import crc32
+import struct
+import time
 
-    def instance(self, filename):
-        try:
-            return self._instance
-        except AttributeError:
-            self._instance = self._decorated(filename)
-            return self._instance
+try:
+    from os import fdatasync as fdatasync_file
+except ImportError:
+    # Not every platform has fdatasync, fsync is the closest match
+    fdatasync_file = fsync_file
+
+SYNC_POLICIES = ('none', 'flush', 'fsync', 'fdatasync', 'fsync_interval')
+
+# How durable each sync policy is, for when writes asking for different ones
+# share a commit
+SYNC_STRENGTH = {'none': 0, 'flush': 1, 'fsync_interval': 2, 'fdatasync': 3, 'fsync': 4}
+
+# The most writes the writer thread commits at once
+MAX_WRITER_BATCH = 4096
+
+# Each record is a header holding the CRC32 of the rest of the record, the number
+# of the log it was written to, the key and value lengths and the operation,
+# followed by the UTF-8 key and value.
+RECORD_HEADER = struct.Struct('<IIIIB')
+RECORD_BODY = struct.Struct('<IIIB')
+OP_SET = 1
+
+def encode_record(key, value, op=OP_SET, log_number=0):
+    ''' (str, str, int, int) -> bytes
+    Encodes an operation on key and value as a record of log number log_number.
+    '''
+    key, value = key.encode(), value.encode()
+    body = RECORD_BODY.pack(log_number, len(key), len(value), op) + key + value
+    return struct.pack('<I', crc32(body)) + body
+
+def read_records(filename, log_number=None):
+    ''' (str, int) -> ([(int, str, str)], int)
+    Reads the records of the log stored at filename, as (op, key, value) tuples,
+    and returns them along with the number of bytes they take up.
+
+    Reading stops at the first record that is cut short or fails its checksum,
+    such as one torn by a crash, so everything after it is left out. Given a
+    log_number, it also stops at the first record written to another log, which
+    is what is left past the end of a recycled log file.
+    '''
+    with open(filename, 'rb') as s:
+        size = fstat(s.fileno()).st_size
+        if size == 0:
+            return [], 0
+
+        # The log is memory mapped rather than read in, so pages are only loaded as
+        # the records on them are parsed
+        with mmap(s.fileno(), 0, access=ACCESS_READ) as data, memoryview(data) as view:
+            unpack = RECORD_HEADER.unpack_from
+            header_size = RECORD_HEADER.size
+
+            records = []
+            append = records.append
+            offset = 0
+            while offset + header_size <= size:
+                checksum, number, key_length, value_length, op = unpack(data, offset)
+                key_start = offset + header_size
+                key_end = key_start + key_length
+                end = key_end + value_length
+                if end > size or crc32(view[offset + 4:end]) != checksum:
+                    break
+                if log_number is not None and number != log_number:
+                    break
+
+                append((op, data[key_start:key_end].decode(), data[key_end:end].decode()))
+                offset = end
+
+    return records, offset
+
+def read_legacy_records(filename):
+    ''' (str) -> ([(int, str, str)], int)
+    Reads the records of a log written before logs held binary records, as (op,
+    key, value) tuples, and returns them along with the number of bytes they take
+    up. Such a log holds key,value text lines. Reading stops at the first line
+    that is cut short or can't be parsed.
+    '''
+    records = []
+    offset = 0
+    with open(filename, 'rb') as s:
+        for line in s:
+            # Only lines ended by a newline were fully written
+            if not line.endswith(b'\n'):
+                break
+
+            try:
+                key, value = line.decode().strip().split(',')
+            except ValueError:
+                break
 
-    def __call__(self):
-        raise TypeError('Singletons must be accessed through `instance()`.')
+            records.append((OP_SET, key, value))
+            offset += len(line)
 
-    def __instancecheck__(self, inst):
-        return isinstance(inst, self._decorated)
+    return records, offset
+
+class WriteHandle:
+    ''' Tracks a value written to an AppendLog until it is committed. '''
+    __slots__ = ('log', 'committed', 'error')
+
+    def __init__(self, log):
+        self.log = log
+        self.committed = False
+        # The exception the writer thread hit committing the value, if any
+        self.error = None
+
+    def wait(self, timeout=None):
+        ''' (self, float) -> bool
+        Blocks until the value is committed, or timeout seconds have passed, and
+        returns whether it is committed. Raises the exception the writer thread
+        hit if committing the value failed.
+        '''
+        if not self.committed and self.error is None:
+            self.log.wait_for(self, timeout)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.committed
 
-@Singleton
 class AppendLog:
-    def __init__(self, filename):
+    def __init__(self, filename, recycle=False):
         self.filename = filename
-        self.stream = open(filename, 'a')
+        # A recycled log reuses an old log file, already allocated on disk, and
+        # writes over it from the start rather than appending to it
+        self.stream = open(filename, 'r+b' if recycle else 'ab')
+
+        # Group commit. Writes are buffered until max_batch of them are pending or
+        # max_delay seconds, if not 0, have passed since the first one, then
+        # committed with a single write. The defaults commit every write.
+        self.max_batch = 1
+        self.max_delay = 0
+        self.pending = []
+        self.pending_handles = []
+        self.timer = None
+        self.lock = RLock()
+
+        # Asynchronous writes. Writes are queued for a dedicated writer thread,
+        # which commits everything queued at once, and callers wait on their
+        # handles when they need their writes committed.
+        self.writer = None
+        self.queue = None
+        self.committed = Condition()
+        # The last exception the writer thread hit, raised by the next commit
+        self.writer_error = None
+
+        # Sync policy, applied on each commit:
+        # - none: leave the data in Python's buffer
+        # - flush: flush it to the operating system
+        # - fsync / fdatasync: flush it, then force it to disk
+        # - fsync_interval: flush it, and fsync at most every sync_interval seconds
+        self.sync_policy = 'flush'
+        self.sync_interval = 0
+        self.last_sync = 0
+        self.sync_timer = None
+
+    def set_group_commit(self, max_batch, max_delay=0):
+        ''' (self, int, float) -> None
+        Sets how many writes can be coalesced into one commit, and how long in
+        seconds a write can wait for others before it's committed anyway. A
+        max_delay of 0 sets no time bound: writes wait until max_batch of them
+        are pending, or until the log is committed or closed.
+        '''
+        self.commit()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+    def set_sync_policy(self, policy, interval=0):
+        ''' (self, str, float) -> None
+        Sets how far each commit is pushed towards the disk: one of 'none', 'flush',
+        'fsync', 'fdatasync' or 'fsync_interval'. interval is the number of seconds
+        between fsyncs for the last one.
+        '''
+        if policy not in SYNC_POLICIES:
+            raise ValueError('Unknown sync policy: ' + str(policy))
+
+        self.commit()
+        self.sync_policy = policy
+        self.sync_interval = interval
+
+    def set_async(self, enabled):
+        ''' (self, bool) -> None
+        Sets whether writes are handed to a dedicated writer thread instead of
+        being committed by the thread writing them.
+        '''
+        if enabled and self.writer is None:
+            self.commit()
+            self.queue = SimpleQueue()
+            self.writer = Thread(target=self.write_queued)
+            self.writer.daemon = True
+            self.writer.start()
+        elif not enabled and self.writer is not None:
+            # The writer commits everything queued before it stops
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+            self.raise_writer_error()
+
+    def write(self, val, sync=None):
+        ''' (self, bytes, str) -> WriteHandle
+        Appends val to the log and returns a handle to wait for it to be committed.
+        If sync is given, val and every pending value are committed right away
+        with that sync policy instead of the log's. An unknown sync policy raises
+        a ValueError before val is appended.
+        '''
+        if sync is not None and sync not in SYNC_POLICIES:
+            raise ValueError('Unknown sync policy: ' + str(sync))
 
-    def write(self, val):
+        handle = WriteHandle(self)
+        if self.writer is not None:
+            self.queue.put((val, sync, handle))
+            return handle
+
+        with self.lock:
+            self.pending.append(val)
+            self.pending_handles.append(handle)
+            if sync is not None:
+                self.commit(sync)
+            elif len(self.pending) >= self.max_batch:
+                self.commit()
+            elif self.timer is None and self.max_delay > 0:
+                self.timer = Timer(self.max_delay, self.commit)
+                self.timer.daemon = True
+                self.timer.start()
+
+        return handle
+
+    def commit(self, sync=None):
+        ''' (self, str) -> None
+        Writes every pending value to the file at once, then applies the sync
+        policy, or sync if it's given. With a writer thread, waits for it to
+        commit everything queued so far.
+        '''
+        policy = sync or self.sync_policy
+        if policy not in SYNC_POLICIES:
+            raise ValueError('Unknown sync policy: ' + str(policy))
+
+        if self.writer is not None:
+            self.write(b'', sync).wait()
+            self.raise_writer_error()
+            return
+
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            if not self.pending:
+                return
+
+            self.write_through(b''.join(self.pending), policy)
+
+            for handle in self.pending_handles:
+                handle.committed = True
+            self.pending = []
+            self.pending_handles = []
+
+    def write_through(self, data, policy):
+        ''' (self, bytes, str) -> None
+        Writes data to the file, then applies the sync policy.
+        '''
         try:
-            self.stream.write(val)
-            self.stream.flush()
+            self.stream.write(data)
+            if policy != 'none':
+                self.stream.flush()
+
+            if policy == 'fsync':
+                fsync_file(self.stream.fileno())
+            elif policy == 'fdatasync':
+                fdatasync_file(self.stream.fileno())
+            elif policy == 'fsync_interval':
+                self.sync_periodically()
         except IOError:
             print("The file stream isn't currently open")
 
+    def write_queued(self):
+        ''' (self) -> None
+        Runs the writer thread: takes every write queued so far and commits them
+        at once, with the most durable sync policy any of them asks for, until a
+        None is queued.
+
+        An exception committing writes doesn't stop the thread: it is handed to
+        their handles, and kept to be raised by the next commit.
+        '''
+        queue = self.queue
+        while True:
+            writes = [queue.get()]
+            while writes[-1] is not None and len(writes) < MAX_WRITER_BATCH:
+                try:
+                    writes.append(queue.get_nowait())
+                except Empty:
+                    break
+
+            stop = writes[-1] is None
+            if stop:
+                writes.pop()
+
+            if writes:
+                error = None
+                try:
+                    policy = max(
+                        (sync or self.sync_policy for val, sync, handle in writes),
+                        key=SYNC_STRENGTH.get)
+
+                    with self.lock:
+                        self.write_through(b''.join([val for val, sync, handle in writes]), policy)
+                except Exception as e:
+                    error = self.writer_error = e
+
+                with self.committed:
+                    for val, sync, handle in writes:
+                        handle.committed = error is None
+                        handle.error = error
+                    self.committed.notify_all()
+
+            if stop:
+                return
+
+    def wait_for(self, handle, timeout=None):
+        ''' (self, WriteHandle, float) -> None
+        Blocks until the value behind handle is committed, or timeout seconds
+        have passed. Without a writer thread, commits it right away.
+        '''
+        if self.writer is None:
+            self.commit()
+            return
+
+        with self.committed:
+            self.committed.wait_for(lambda: handle.committed or handle.error is not None, timeout)
+
+    def raise_writer_error(self):
+        ''' (self) -> None
+        Raises, once, the last exception the writer thread hit, if any.
+        '''
+        error, self.writer_error = self.writer_error, None
+        if error is not None:
+            raise error
+
+    def sync_periodically(self):
+        ''' (self) -> None
+        Fsyncs the log if the last fsync is more than sync_interval seconds old.
+        Otherwise, makes sure one happens once it is.
+        '''
+        elapsed = time.monotonic() - self.last_sync
+        if elapsed >= self.sync_interval:
+            self.sync()
+        elif self.sync_timer is None:
+            self.sync_timer = Timer(self.sync_interval - elapsed, self.sync)
+            self.sync_timer.daemon = True
+            self.sync_timer.start()
+
+    def sync(self):
+        ''' (self) -> None
+        Flushes the log and forces it to disk.
+        '''
+        with self.lock:
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+
+            try:
+                self.stream.flush()
+                fsync_file(self.stream.fileno())
+            except (IOError, ValueError):
+                print("The file stream isn't currently open")
+
+            self.last_sync = time.monotonic()
+
     def clear(self):
-        self.stream.close()
-        # Clearing the stream should clear the current file contents
-        self.stream = open(self.filename, 'w')
+        # Pending values belong to the contents being cleared, but their handles
+        # are released before the file is emptied
+        self.commit('none')
 
+        with self.lock:
+            for timer in (self.timer, self.sync_timer):
+                if timer is not None:
+                    timer.cancel()
+            self.timer = self.sync_timer = None
+
+            self.stream.close()
+            # Clearing the stream should clear the current file contents
+            self.stream = open(self.filename, 'wb')
+
+    def close(self):
+        ''' (self) -> None
+        Commits every pending value and closes the log. Raises the last exception
+        the writer thread hit, if any, once the log is closed.
+        '''
+        try:
+            self.set_async(False)
+        finally:
+            with self.lock:
+                self.commit()
+                if self.sync_timer is not None:
+                    self.sync()
+                self.stream.close()
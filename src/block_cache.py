@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from threading import Lock
+
+class BlockCache():
+    def __init__(self, capacity=8 * 1024 * 1024):
+        ''' (self, int) -> BlockCache
+        Initializes an empty cache of decoded table blocks holding at most capacity
+        bytes of them, measured by the size of each block once decompressed.
+
+        Blocks are keyed by the path of their table and their number in it, so a
+        single cache can be shared by every tree in the process. Once the cache is
+        full, the least recently used blocks are evicted to make room.
+        '''
+        self.capacity = capacity
+        self.usage = 0
+        self.blocks = OrderedDict()
+        # The block numbers cached for each table, to drop them with the table
+        self.files = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, path, block):
+        ''' (self, str, int) -> object
+        Returns the decoded block numbered block of the table at path, marking it as
+        the most recently used, or None if it isn't cached.
+        '''
+        with self.lock:
+            entry = self.blocks.get((path, block))
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.blocks.move_to_end((path, block))
+            return entry[0]
+
+    def put(self, path, block, decoded, charge):
+        ''' (self, str, int, object, int) -> None
+        Caches decoded as the block numbered block of the table at path, taking up
+        charge bytes, and evicts the least recently used blocks past capacity.
+        Blocks larger than the whole cache aren't cached.
+        '''
+        if charge > self.capacity:
+            return
+
+        with self.lock:
+            previous = self.blocks.pop((path, block), None)
+            if previous is not None:
+                self.usage -= previous[1]
+
+            self.blocks[(path, block)] = (decoded, charge)
+            self.files.setdefault(path, set()).add(block)
+            self.usage += charge
+            self.shrink()
+
+    def erase_file(self, path):
+        ''' (self, str) -> None
+        Drops every block of the table at path, for when it is deleted or
+        written over.
+        '''
+        with self.lock:
+            for block in self.files.pop(path, ()):
+                self.usage -= self.blocks.pop((path, block))[1]
+
+    def set_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the number of bytes of blocks the cache can hold, evicting the least
+        recently used blocks past it.
+        '''
+        with self.lock:
+            self.capacity = capacity
+            self.shrink()
+
+    def hit_rate(self):
+        ''' (self) -> float
+        Returns the share of lookups the cache has answered, or 0 before any.
+        '''
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def shrink(self):
+        ''' (self) -> None
+        Evicts the least recently used blocks until they fit in capacity. The lock
+        must be held.
+        '''
+        while self.usage > self.capacity:
+            (path, block), (decoded, charge) = self.blocks.popitem(last=False)
+            self.usage -= charge
+            self.files[path].discard(block)
+            if not self.files[path]:
+                del self.files[path]
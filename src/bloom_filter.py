@@ -1,5 +1,5 @@
 from math import log
-from mmh3 import hash
+from mmh3 import hash, hash64
 from bitarray import bitarray 
   
 class BloomFilter:
@@ -9,17 +9,24 @@ class BloomFilter:
     # A condensed explanation can be found here:
     # https://stackoverflow.com/questions/658439/how-many-hash-functions-does-my-bloom-filter-need
 
-    def __init__(self, num_items, false_positive_prob): 
-        ''' (self, int, float) -> BloomFilter
+    # Filters pickled before double hashing was added hash with seeds
+    double_hashing = False
+
+    def __init__(self, num_items, false_positive_prob, double_hashing=False): 
+        ''' (self, int, float, bool) -> BloomFilter
         Creates a new BloomFilter. num_items represents the number of items 
         expected to be stored in the structure. fb_prob represents the 
         desired probability of a false positive, represented as a decimal value 
         between 0 and 1. 
+
+        If double_hashing is set, every bit position is derived from a single
+        128 bit MurmurHash3 digest instead of one hash per hash function.
         
         Note: A lower false positive probability comes at the expense of time 
         and computational power.
         '''
         self.false_positive_prob = false_positive_prob 
+        self.double_hashing = double_hashing
         self.bit_array_size = self.bit_array_size(num_items, false_positive_prob) 
         self.num_hash_fns = self.get_hash_count(self.bit_array_size, num_items) 
 
@@ -30,6 +37,13 @@ class BloomFilter:
         ''' (self, str) -> None
         Add item to the BloomFilter.
         '''
+        if self.double_hashing:
+            digest, step = self.double_hash(item)
+            for i in range(self.num_hash_fns):
+                self.bit_array[digest] = True
+                digest = (digest + step) % self.bit_array_size
+            return
+
         digests = [] 
         for seed in range(self.num_hash_fns):
             # each seed creates a different digest.
@@ -42,6 +56,14 @@ class BloomFilter:
         ''' (self, str) -> Boolean
         Check for existence of an item in filter 
         '''
+        if self.double_hashing:
+            digest, step = self.double_hash(item)
+            for i in range(self.num_hash_fns):
+                if self.bit_array[digest] == False:
+                    return False
+                digest = (digest + step) % self.bit_array_size
+            return True
+
         for seed in range(self.num_hash_fns): 
             digest = hash(item, seed) % self.bit_array_size 
             if self.bit_array[digest] == False: 
@@ -49,7 +71,81 @@ class BloomFilter:
                 return False
         return True
   
+    def add_many(self, items):
+        ''' (self, list) -> None
+        Add every item in items to the BloomFilter.
+
+        Equivalent to calling add() on each item, without paying for a method call
+        and attribute lookups per item. With seeded hashing, the digests of every
+        item are computed in bulk, one hash function at a time.
+        '''
+        bit_array, size, num_hash_fns = self.bit_array, self.bit_array_size, self.num_hash_fns
+
+        if self.double_hashing:
+            step_range = max(size - 1, 1)
+            for item in items:
+                h1, h2 = hash64(item)
+                digest, step = h1 % size, h2 % step_range + 1
+                for i in range(num_hash_fns):
+                    bit_array[digest] = True
+                    digest = (digest + step) % size
+            return
+
+        for seed in range(num_hash_fns):
+            for digest in [hash(item, seed) % size for item in items]:
+                bit_array[digest] = True
+
+    def check_many(self, items):
+        ''' (self, list) -> [Boolean]
+        Check for existence of each item of items in filter. Returns a list of
+        results, in the same order as items.
+
+        Equivalent to calling check() on each item, without paying for a method
+        call and attribute lookups per item.
+        '''
+        bit_array, size, num_hash_fns = self.bit_array, self.bit_array_size, self.num_hash_fns
+        results = []
+
+        if self.double_hashing:
+            step_range = max(size - 1, 1)
+            for item in items:
+                h1, h2 = hash64(item)
+                digest, step = h1 % size, h2 % step_range + 1
+                for i in range(num_hash_fns):
+                    if not bit_array[digest]:
+                        results.append(False)
+                        break
+                    digest = (digest + step) % size
+                else:
+                    results.append(True)
+            return results
+
+        for item in items:
+            for seed in range(num_hash_fns):
+                if not bit_array[hash(item, seed) % size]:
+                    results.append(False)
+                    break
+            else:
+                results.append(True)
+        return results
+
     # Helpers
+    def double_hash(self, item):
+        ''' (self, str) -> (int, int)
+        Returns the first bit position of item, and the step between each of its
+        bit positions, using Kirsch-Mitzenmacher double hashing: the two halves,
+        h1 and h2, of a single 128 bit MurmurHash3 digest are combined into
+        g_i = h1 + i * h2 for each hash function i.
+
+        The step is kept between 1 and the size of the bit array minus 1, since a
+        step of 0 would put every bit of item in the same position.
+
+        See Kirsch & Mitzenmacher, "Less Hashing, Same Performance: Building a
+        Better Bloom Filter" (2006).
+        '''
+        h1, h2 = hash64(item)
+        return h1 % self.bit_array_size, h2 % max(self.bit_array_size - 1, 1) + 1
+
     def bit_array_size(self, num_items, probability):
         ''' (self, int, float) -> int
         Return the required size of the bit array, m, as a function
@@ -77,3 +173,226 @@ class BloomFilter:
         digest for the same input.
         '''
         return int((bit_arr_size/num_items) * log(2))
+
+class BlockedBloomFilter(BloomFilter):
+    # A BloomFilter whose bit array is split into blocks the size of a cache line.
+    # All the bits of an item land in the same block, so checking it costs a single
+    # cache miss instead of one per hash function.
+
+    # See Putze et al., "Cache-, Hash- and Space-Efficient Bloom Filters" (2007).
+
+    BLOCK_BITS = 512
+
+    def __init__(self, num_items, false_positive_prob):
+        ''' (self, int, float) -> BlockedBloomFilter
+        Creates a new BlockedBloomFilter. The arguments are the same as for a
+        BloomFilter. The bit array is rounded up to a whole number of blocks.
+
+        Note: Since bits crowd into blocks, the false positive rate ends up higher
+        than that of a BloomFilter of the same size when the probability is low.
+        '''
+        self.false_positive_prob = false_positive_prob
+        size = self.bit_array_size(num_items, false_positive_prob)
+        self.num_hash_fns = self.get_hash_count(size, num_items)
+
+        self.num_blocks = max(-(-size // self.BLOCK_BITS), 1)
+        self.bit_array_size = self.num_blocks * self.BLOCK_BITS
+        self.bit_array = bitarray(self.bit_array_size)
+        self.bit_array.setall(0)
+
+    def add(self, item):
+        ''' (self, str) -> None
+        Add item to the BlockedBloomFilter.
+        '''
+        block, digest, step = self.block_hash(item)
+        for i in range(self.num_hash_fns):
+            self.bit_array[block + digest] = True
+            digest = (digest + step) % self.BLOCK_BITS
+
+    def check(self, item):
+        ''' (self, str) -> Boolean
+        Check for existence of an item in filter
+        '''
+        block, digest, step = self.block_hash(item)
+        for i in range(self.num_hash_fns):
+            if self.bit_array[block + digest] == False:
+                return False
+            digest = (digest + step) % self.BLOCK_BITS
+        return True
+
+    def add_many(self, items):
+        ''' (self, list) -> None
+        Add every item in items to the BlockedBloomFilter.
+
+        Equivalent to calling add() on each item, without paying for a method call
+        and attribute lookups per item.
+        '''
+        bit_array, num_blocks, num_hash_fns = self.bit_array, self.num_blocks, self.num_hash_fns
+        block_bits = self.BLOCK_BITS
+
+        for item in items:
+            h1, h2 = hash64(item)
+            block = (h1 % num_blocks) * block_bits
+            digest, step = h2 % block_bits, (h2 >> 9) % block_bits | 1
+            for i in range(num_hash_fns):
+                bit_array[block + digest] = True
+                digest = (digest + step) % block_bits
+
+    def check_many(self, items):
+        ''' (self, list) -> [Boolean]
+        Check for existence of each item of items in filter. Returns a list of
+        results, in the same order as items.
+        '''
+        bit_array, num_blocks, num_hash_fns = self.bit_array, self.num_blocks, self.num_hash_fns
+        block_bits = self.BLOCK_BITS
+        results = []
+
+        for item in items:
+            h1, h2 = hash64(item)
+            block = (h1 % num_blocks) * block_bits
+            digest, step = h2 % block_bits, (h2 >> 9) % block_bits | 1
+            for i in range(num_hash_fns):
+                if not bit_array[block + digest]:
+                    results.append(False)
+                    break
+                digest = (digest + step) % block_bits
+            else:
+                results.append(True)
+        return results
+
+    # Helpers
+    def block_hash(self, item):
+        ''' (self, str) -> (int, int, int)
+        Returns the position of the first bit of the block item belongs to, then
+        the first bit position of item within that block and the step between
+        each of its bit positions.
+
+        The first half of a 128 bit MurmurHash3 digest picks the block. The second
+        half is split in two to double hash the positions within it. The step is
+        odd, so that every position is distinct.
+        '''
+        h1, h2 = hash64(item)
+        block = (h1 % self.num_blocks) * self.BLOCK_BITS
+        return block, h2 % self.BLOCK_BITS, (h2 >> 9) % self.BLOCK_BITS | 1
+
+class ScalableBloomFilter:
+    # A stack of BloomFilters which grows as items are added, so that the false
+    # positive probability holds no matter how many items end up being stored.
+    # See Almeida et al., "Scalable Bloom Filters" (2007).
+
+    # Filters pickled before double hashing was added hash with seeds, and those
+    # pickled before the blocked layout was added stack plain filters
+    double_hashing = False
+    blocked = False
+
+    def __init__(self, initial_capacity, false_positive_prob, growth_factor=2, tightening_ratio=0.9,
+                 double_hashing=False, blocked=False):
+        ''' (self, int, float, int, float, bool, bool) -> ScalableBloomFilter
+        Creates a new ScalableBloomFilter. initial_capacity represents the number of
+        items the first filter can hold before a new one is stacked on top of it.
+        false_positive_prob represents the desired probability of a false positive
+        for the whole structure, as a decimal value between 0 and 1.
+
+        Each new filter holds growth_factor times more items than the previous one,
+        and its false positive probability is tightened by tightening_ratio. The
+        first filter is given false_positive_prob * (1 - tightening_ratio), so that
+        the compounded probability never exceeds false_positive_prob.
+
+        double_hashing is passed on to every filter in the stack. If blocked is set,
+        the stack is made of BlockedBloomFilters instead.
+        '''
+        self.false_positive_prob = false_positive_prob
+        self.growth_factor = growth_factor
+        self.tightening_ratio = tightening_ratio
+        self.double_hashing = double_hashing
+        self.blocked = blocked
+
+        self.filters = []
+        self.capacity = initial_capacity
+        self.count = 0
+        self.filters.append(self.new_filter(
+            initial_capacity, false_positive_prob * (1 - tightening_ratio)))
+
+    def add(self, item):
+        ''' (self, str) -> None
+        Add item to the ScalableBloomFilter, stacking a new filter on top
+        if the current one is full.
+        '''
+        # Don't let duplicates use up the current filter's capacity
+        if self.check(item):
+            return
+
+        if self.count >= self.capacity:
+            self.add_filter()
+
+        self.filters[-1].add(item)
+        self.count += 1
+
+    def check(self, item):
+        ''' (self, str) -> Boolean
+        Check for existence of an item in any of the filters
+        '''
+        for bloom_filter in reversed(self.filters):
+            if bloom_filter.check(item):
+                return True
+        return False
+
+    def add_many(self, items):
+        ''' (self, list) -> None
+        Add every item in items to the ScalableBloomFilter. Items are added in bulk
+        to the current filter, as many at a time as it has room for.
+        '''
+        # Don't let duplicates use up the current filter's capacity
+        items = list(dict.fromkeys(items))
+        items = [item for item, present in zip(items, self.check_many(items)) if not present]
+
+        while len(items):
+            if self.count >= self.capacity:
+                self.add_filter()
+
+            room = self.capacity - self.count
+            self.filters[-1].add_many(items[:room])
+            self.count += len(items[:room])
+            items = items[room:]
+
+    def check_many(self, items):
+        ''' (self, list) -> [Boolean]
+        Check for existence of each item of items in any of the filters. Returns a
+        list of results, in the same order as items.
+        '''
+        results = [False] * len(items)
+        remaining = list(range(len(items)))
+
+        # Only items that haven't been found yet move on to the next filter
+        for bloom_filter in reversed(self.filters):
+            found = bloom_filter.check_many([items[index] for index in remaining])
+
+            missing = []
+            for index, present in zip(remaining, found):
+                if present:
+                    results[index] = True
+                else:
+                    missing.append(index)
+            remaining = missing
+
+        return results
+
+    # Helpers
+    def add_filter(self):
+        ''' (self) -> None
+        Stack a new, larger and stricter, filter on top of the current one.
+        '''
+        self.capacity *= self.growth_factor
+        self.count = 0
+        self.filters.append(self.new_filter(
+            self.capacity,
+            self.filters[-1].false_positive_prob * self.tightening_ratio))
+
+    def new_filter(self, capacity, false_positive_prob):
+        ''' (self, int, float) -> BloomFilter
+        Returns a new filter to be stacked.
+        '''
+        if self.blocked:
+            return BlockedBloomFilter(capacity, false_positive_prob)
+
+        return BloomFilter(capacity, false_positive_prob, self.double_hashing)
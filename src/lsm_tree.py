@@ -1,8 +1,18 @@
 from pathlib import Path
-from os import remove as remove_file, rename as rename_file
+from os import remove as remove_file, rename as rename_file, truncate as truncate_file, \
+    fsync as fsync_file, listdir
 from .red_black_tree import RedBlackTree
-from .append_log import AppendLog
-from .bloom_filter import BloomFilter
+from .append_log import AppendLog, encode_record, read_records, read_legacy_records
+from .bloom_filter import BloomFilter, BlockedBloomFilter, ScalableBloomFilter
+from .sstable import SSTable, SSTableWriter, is_sstable, COMPRESSIONS
+from .table_cache import TableCache
+from .block_cache import BlockCache
+from .row_cache import RowCache
+from mmap import mmap, ACCESS_READ
+from operator import itemgetter
+from itertools import chain
+from threading import Thread, Lock
+import heapq
 import pickle
 
 class LSMTree():
@@ -23,15 +33,98 @@ class LSMTree():
         self.threshold = 1000000
         self.memtable = RedBlackTree()
 
-        # Index
-        self.index = RedBlackTree()
+        # Sparse indexes, one per segment. Each one is persisted next to its
+        # segment and loaded lazily.
+        self.indexes = {}
         self.sparsity_factor = 100
 
-        # Bloom Filter
+        # Segment format. New segments are written as CSV, or as binary tables of
+        # block_size byte blocks with their own index, whose keys are prefix
+        # compressed between restart points every restart_interval keys. Segments
+        # of either format can be read, whichever is configured.
+        self.segment_format = 'csv'
+        self.block_size = 4096
+        self.restart_interval = 16
+
+        # Table block compression, one of 'none', 'zlib', 'lzma' or 'bz2', at a
+        # compression level. level_compressions overrides both for some levels, so
+        # hot upper levels can stay uncompressed while the bottom is compressed hard.
+        self.compression = 'none'
+        self.compression_level = None
+        self.level_compressions = {}
+
+        # Open segments. Each segment read is memory mapped, and the mapping cached
+        # for the next reads, up to max_open_files of them; past that, the least
+        # recently used ones are dropped from the cache, and closed as soon as no
+        # read still holds them. Tables keep their block index with them.
+        self.table_cache = TableCache(max_open_files=1000)
+
+        # Decoded table blocks, up to 8MB of them, which trees can share
+        self.block_cache = BlockCache(capacity=8 * 1024 * 1024)
+
+        # Values read from disk, by key, for hot keys to skip the disk path. Off
+        # until given a capacity.
+        self.row_cache = RowCache(capacity=0)
+
+        # Bloom Filters. The first one covers every key on disk, the others
+        # each cover a single segment and are persisted next to it.
+        # Unless told otherwise, the first one grows past bf_num_items instead
+        # of saturating.
         self.bf_num_items = 1000000
         self.bf_false_pos_prob = 0.2
-        self.bloom_filter = BloomFilter(
-            self.bf_num_items, self.bf_false_pos_prob)
+        self.bf_scalable = True
+        self.bf_double_hashing = False
+        self.bf_blocked = False
+        self.bloom_filter = self.new_bloom_filter()
+        self.bloom_filters = {}
+
+        # The metadata is written on every flush and compaction, but the first
+        # bloom filter, which can be as large as a segment, only when the metadata
+        # is saved, tagged with the number of the metadata it matches
+        self.metadata_number = 0
+
+        # Leveled compaction. self.segments is level 0: flushed memtables, oldest
+        # first, whose key ranges may overlap. Each list in self.levels is a deeper
+        # level, sorted by key, whose segments never overlap. Level 0 is merged down
+        # once it holds level0_max_segments segments, and each deeper level once it
+        # grows past level_size_ratio times the size of the one above.
+        self.levels = []
+        self.key_ranges = {}
+        self.compaction_pointers = {}
+        self.level0_max_segments = 4
+        self.level_size_ratio = 10
+
+        # Size-tiered compaction keeps every segment in level 0 instead, and merges
+        # tier_size neighbouring segments of similar size into one.
+        self.compaction_strategy = 'leveled'
+        self.tier_size = 4
+
+        # Bytes written to segments by flushes and by compaction, to measure
+        # write amplification
+        self.bytes_flushed = 0
+        self.bytes_compacted = 0
+
+        # Background compaction. When enabled, a full memtable becomes immutable
+        # and is flushed, then compacted, by a worker thread while a fresh memtable
+        # takes writes. The lock guards the segment lists, which the worker swaps,
+        # and the segment files it deletes.
+        self.background_compaction = False
+        self.immutable_memtable = None
+        self.flush_thread = None
+        self.lock = Lock()
+
+        # Write ahead logs. Each memtable gets its own numbered log, and a log is only
+        # retired once its memtable's segment and the metadata listing it are safely
+        # on disk. Up to wal_recycle_limit retired logs are kept to be written over
+        # by later ones, instead of allocating a new file each time. The log settings
+        # are kept here so that each new log gets them too.
+        self.wal_number = 1
+        self.wal_recycle_limit = 0
+        self.wal_max_batch = 1
+        self.wal_max_delay = 0
+        self.wal_sync_policy = 'flush'
+        self.wal_sync_interval = 0
+        self.wal_async = False
 
         # Create the segments directory
         if not (Path(segments_directory).exists() and Path(segments_directory).is_dir):
@@ -41,68 +134,159 @@ class LSMTree():
         self.load_metadata()
         self.restore_memtable()
 
-    def db_set(self, key, value):
-        ''' (self, str, str) -> None
-        Stores a new key value pair in the DB
-        '''
-        log = self.to_log_entry(key, value)
+        # Each tree has its own write ahead log, opened once restored
+        self.wal = self.open_wal()
+
+    def db_set(self, key, value, sync=None):
+        ''' (self, str, str, str) -> WriteHandle
+        Stores a new key value pair in the DB. If sync is given, the write is
+        committed to the write ahead log right away with that sync policy.
 
+        Returns a handle whose wait() blocks until the write is committed to the
+        write ahead log.
+        '''
         # Check if we can save effort by updating the memtable in place
         node = self.memtable.find_node(key)
         if node:
-            self.memtable_wal().write(log)
+            record = encode_record(key, value, log_number=self.wal_number)
+            handle = self.memtable_wal().write(record, sync)
             node.value = value
-            return
+            if self.row_cache.capacity:
+                self.row_cache.erase(key)
+            return handle
 
         # Check if new segment needed
         additional_size = len(key) + len(value)
         if self.memtable.total_bytes + additional_size > self.threshold:
-            self.compact()
-            self.flush_memtable_to_disk(self.current_segment_path())
+            if self.background_compaction:
+                self.flush_in_background()
+            else:
+                self.flush_memtable_to_disk(self.current_segment_path())
 
-            # Update bookkeeping metadata
-            self.memtable = RedBlackTree()
-            self.memtable_wal().clear()
+                # Update bookkeeping metadata
+                self.memtable = RedBlackTree()
+                self.rotate_wal()
 
-            self.segments.append(self.current_segment)
-            new_seg_name = self.incremented_segment_name()
-            self.current_segment = new_seg_name
-            self.memtable.total_bytes = 0
+                self.segments.append(self.current_segment)
+                new_seg_name = self.incremented_segment_name()
+                self.current_segment = new_seg_name
+                self.memtable.total_bytes = 0
+
+                # The flushed memtable's log is only needed until the metadata
+                # listing its segment is on disk
+                self.write_metadata()
+                self.retire_wals(self.wal_number)
+
+                self.compact()
 
         # Write to memtable write ahead log in case of crash
-        self.memtable_wal().write(log)
+        record = encode_record(key, value, log_number=self.wal_number)
+        handle = self.memtable_wal().write(record, sync)
 
         # Write to memtable
         self.memtable.add(key, value)
         self.memtable.total_bytes += additional_size
+        if self.row_cache.capacity:
+            self.row_cache.erase(key)
+
+        return handle
 
     def db_get(self, key):
         ''' (self, str) -> None
         Retrieve the value associated with key in the db
         '''
+        # Hot keys are answered by the row cache. Writes erase the keys they
+        # write from it, so a cached value is always the latest one.
+        row_cache, generation = self.row_cache, None
+        if row_cache.capacity:
+            value = row_cache.get(key)
+            if value is not None:
+                return value
+            generation = row_cache.generation
+
         # Attempt to find the key in the memtable first
         memtable_result = self.memtable.find_node(key)
         if memtable_result:
             return memtable_result.value
 
+        # Then the memtable being flushed in the background, if any
+        immutable_memtable = self.immutable_memtable
+        if immutable_memtable is not None:
+            memtable_result = immutable_memtable.find_node(key)
+            if memtable_result:
+                return memtable_result.value
+
         # Check the bloom filter before searching disk
         if not self.bloom_filter.check(key):
             return None
 
-        # Check the index
-        floor_val = self.index.floor(key)
-        floor_node = self.index.find_node(floor_val)
+        with self.lock:
+            value = self.search_all_segments(key)
 
-        if floor_node:
-            path = self.segment_path(floor_node.segment)
-            with open(path, 'r') as s:
-                s.seek(floor_node.offset)
-                for line in s:
-                    k, v = line.strip().split(',')
-                    if k == key:
-                        return v.strip()
+        if generation is not None and value is not None:
+            row_cache.put(key, value, generation)
+        return value
 
-        return self.search_all_segments(key)
+    def multi_get(self, keys):
+        ''' (self, [str]) -> [str]
+        Retrieves the values associated with each of keys in the db, in the same
+        order, with None for the keys that aren't stored.
+
+        Keys in the row cache or in the memtables are answered first, and the db's
+        bloom filter rules out more. The rest are sorted and looked up segment by
+        segment, grouped by block, so every block is read once however many keys
+        it holds, instead of once per key.
+        '''
+        row_cache, generation = self.row_cache, None
+        if row_cache.capacity:
+            generation = row_cache.generation
+
+        found = {}
+        remaining = []
+        for key in set(keys):
+            if generation is not None:
+                value = row_cache.get(key)
+                if value is not None:
+                    found[key] = value
+                    continue
+
+            # The memtable comes first, as in db_get, so a background flush
+            # swapping them in between can't hide the newest value
+            memtable_result = self.memtable.find_node(key)
+            immutable_memtable = self.immutable_memtable
+            if not memtable_result and immutable_memtable is not None:
+                memtable_result = immutable_memtable.find_node(key)
+            if memtable_result:
+                found[key] = memtable_result.value
+            else:
+                remaining.append(key)
+
+        remaining = [
+            key for key, present in zip(remaining, self.bloom_filter.check_many(remaining))
+            if present]
+        remaining.sort()
+
+        with self.lock:
+            from_disk = self.multi_search_all_segments(remaining)
+
+        if generation is not None:
+            for key, value in from_disk.items():
+                row_cache.put(key, value, generation)
+        found.update(from_disk)
+
+        return [found.get(key) for key in keys]
+
+    def close(self):
+        ''' (self) -> None
+        Waits for any background flush, then commits and closes the write ahead
+        log and unmaps the segments. The tree can't be used afterwards. The bloom
+        filter is saved along the way, so the next session needn't rebuild it.
+        '''
+        self.wait_for_flush()
+        if Path(self.metadata_path()).exists():
+            self.write_bloom_filter()
+        self.memtable_wal().close()
+        self.table_cache.clear()
 
     # Configuration methods
     def set_threshold(self, threshold):
@@ -122,45 +306,370 @@ class LSMTree():
         '''
         self.sparsity_factor = factor
 
+    def set_background_compaction(self, enabled):
+        ''' (self, bool) -> None
+        Sets whether full memtables should be flushed and compacted by a background
+        thread, so that the write crossing the threshold doesn't wait for them.
+        '''
+        self.wait_for_flush()
+        self.background_compaction = enabled
+
+    def set_segment_format(self, segment_format):
+        ''' (self, str) -> None
+        Sets the format new segments are written in, either 'csv' or 'sstable'.
+        Tables are binary, so keys and values can hold commas and newlines, and are
+        searched through the block index stored inside them. Existing segments keep
+        their format until compaction rewrites them.
+        '''
+        if segment_format not in ('csv', 'sstable'):
+            raise ValueError('Unknown segment format: ' + str(segment_format))
+
+        self.segment_format = segment_format
+
+    def set_block_size(self, block_size):
+        ''' (self, int) -> None
+        Sets the size, in bytes, of the data blocks of new tables. A lookup reads a
+        single block, so smaller blocks make reads cheaper and the index larger.
+        '''
+        self.block_size = block_size
+
+    def set_restart_interval(self, interval):
+        ''' (self, int) -> None
+        Sets how often new tables store a key in full rather than as the suffix it
+        doesn't share with the previous key. Longer intervals make blocks smaller,
+        and lookups decode more keys within a block.
+        '''
+        self.restart_interval = interval
+
+    def set_compression(self, compression, level=None):
+        ''' (self, str, int) -> None
+        Sets how the blocks of new tables are compressed: 'none', 'zlib', 'lzma' or
+        'bz2', at level, or the compressor's default level if it isn't given.
+        Compressed blocks take less disk space and I/O, and cost CPU to read.
+        '''
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression: ' + str(compression))
+
+        self.compression = compression
+        self.compression_level = level
+
+    def set_level_compression(self, level, compression, compression_level=None):
+        ''' (self, int, str, int) -> None
+        Sets how the blocks of new tables in level are compressed, overriding
+        set_compression for that level. Level 0 holds flushed memtables.
+        '''
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression: ' + str(compression))
+
+        self.level_compressions[level] = (compression, compression_level)
+
+    def set_max_open_files(self, max_open_files):
+        ''' (self, int) -> None
+        Sets how many segments are kept open for reads. Past it, the least recently
+        read segments are dropped, closed as soon as no read still holds them, and
+        reopened when they are next read.
+        '''
+        self.table_cache.set_max_open_files(max_open_files)
+
+    def set_block_cache_size(self, capacity):
+        ''' (self, int) -> None
+        Sets how many bytes of decoded table blocks the block cache holds. 0 turns
+        it off.
+        '''
+        self.block_cache.set_capacity(capacity)
+
+    def set_block_cache(self, block_cache):
+        ''' (self, BlockCache) -> None
+        Sets the block cache the tree's tables are read through, so that several
+        trees can share one, bounding the memory they use for blocks together.
+        '''
+        self.block_cache = block_cache
+
+    def set_row_cache_size(self, capacity):
+        ''' (self, int) -> None
+        Sets how many bytes of keys and values read from disk the row cache holds.
+        0, the default, turns it off.
+        '''
+        self.row_cache.set_capacity(capacity)
+
+    def set_wal_group_commit(self, max_batch, max_delay=0):
+        ''' (self, int, float) -> None
+        Sets the write ahead log to coalesce up to max_batch writes, waiting at most
+        max_delay seconds, into a single commit. Writes are cheaper, but a crash can
+        lose those still waiting to be committed. Batches of more than one write
+        need a positive max_delay, or a lone write would wait for others forever.
+        '''
+        if max_batch > 1 and max_delay <= 0:
+            raise ValueError('Group commit needs a positive max_delay: ' + str(max_delay))
+
+        self.wal_max_batch, self.wal_max_delay = max_batch, max_delay
+        self.memtable_wal().set_group_commit(max_batch, max_delay)
+
+    def set_wal_async(self, enabled):
+        ''' (self, bool) -> None
+        Sets whether write ahead log writes are handed to a dedicated writer thread,
+        which commits everything queued at once. db_set then returns before its write
+        is committed; wait on the handle it returns when that matters.
+        '''
+        self.wal_async = enabled
+        self.memtable_wal().set_async(enabled)
+
+    def set_wal_sync_policy(self, policy, interval=0):
+        ''' (self, str, float) -> None
+        Sets how durable each commit of the write ahead log is, from cheapest to
+        safest: 'none' leaves it in Python's buffer, 'flush' hands it to the
+        operating system, 'fsync_interval' also fsyncs every interval seconds, and
+        'fdatasync' and 'fsync' force it to disk.
+        '''
+        self.memtable_wal().set_sync_policy(policy, interval)
+        self.wal_sync_policy, self.wal_sync_interval = policy, interval
+
+    def set_wal_recycle_limit(self, limit):
+        ''' (self, int) -> None
+        Sets how many retired write ahead logs are kept to be written over by new
+        ones. Recycling a log skips allocating a new file on every flush.
+        '''
+        self.wal_recycle_limit = limit
+
+    def set_compaction_strategy(self, strategy):
+        ''' (self, str) -> None
+        Sets the compaction strategy, either 'leveled' or 'size_tiered'. Leveled
+        compaction keeps reads cheap; size-tiered compaction rewrites less data,
+        which suits write-heavy workloads.
+        '''
+        if strategy not in ('leveled', 'size_tiered'):
+            raise ValueError('Unknown compaction strategy: ' + str(strategy))
+
+        self.compaction_strategy = strategy
+
+    def set_tier_size(self, num_segments):
+        ''' (self, int) -> None
+        Sets the number of similarly sized segments size-tiered compaction
+        merges at once.
+        '''
+        self.tier_size = num_segments
+
+    def set_level0_max_segments(self, max_segments):
+        ''' (self, int) -> None
+        Sets the number of flushed segments level 0 can hold before they are
+        merged into level 1.
+        '''
+        self.level0_max_segments = max_segments
+
+    def set_level_size_ratio(self, ratio):
+        ''' (self, int) -> None
+        Sets how many times larger each level is allowed to grow than the one
+        above it. Level 1 holds up to ratio times the threshold.
+        '''
+        self.level_size_ratio = ratio
+
     ### Helper methods
 
     def memtable_wal(self):
-        ''' (self) -> str
-        Returns an instance of the write ahead log.
+        ''' (self) -> AppendLog
+        Returns the tree's write ahead log.
         '''
-        return AppendLog.instance(self.memtable_wal_path())
+        return self.wal
 
     def search_all_segments(self, key):
         ''' (self, str) -> str
-        Searches all segments on disk for key.
+        Searches the segments on disk for key, from newest to oldest, so that the
+        most recent value is always the one returned: level 0 from its newest
+        segment back, then each deeper level in turn. Segments in a deeper level
+        don't overlap, so only the one whose key range covers key is searched.
         '''
-        segments = self.segments[:]
-        while len(segments):
-            segment = segments.pop()
+        for segment in reversed(self.segments):
+            value = self.search_filtered_segment(key, segment)
+            if value is not None:
+                return value
+
+        for level in self.levels:
+            segment = self.find_segment_in_level(key, level)
+            if segment is None:
+                continue
 
-            value = self.search_segment(key, segment)
-            if value != None:
+            value = self.search_filtered_segment(key, segment)
+            if value is not None:
                 return value
 
-    def search_segment(self, key, segment_name):
-        ''' (self, str) -> str
-        Returns the value associated with key in the segment represented
-        by segment_name, if it exists. Otherwise return None.
+    def multi_search_all_segments(self, keys):
+        ''' (self, [str]) -> {str: str}
+        Searches the segments on disk for keys, which must be sorted, in the same
+        order as search_all_segments, and returns the values of those found. Keys
+        are dropped once found, so only their most recent value is returned, and
+        the keys of each deeper level are grouped by the segment covering them.
         '''
-        with open(self.segment_path(segment_name), 'r') as s:
-            pairs = [line.strip() for line in s]
+        found = {}
+        for segment in reversed(self.segments):
+            if not keys:
+                return found
+
+            found.update(self.multi_search_filtered_segment(keys, segment))
+            keys = [key for key in keys if key not in found]
+
+        for level in self.levels:
+            segment_keys = {}
+            for key in keys:
+                segment = self.find_segment_in_level(key, level)
+                if segment is not None:
+                    segment_keys.setdefault(segment, []).append(key)
+
+            for segment in segment_keys:
+                found.update(self.multi_search_filtered_segment(segment_keys[segment], segment))
+            keys = [key for key in keys if key not in found]
+
+        return found
+
+    def multi_search_filtered_segment(self, keys, segment_name):
+        ''' (self, [str], str) -> {str: str}
+        Returns the values of those of keys, which must be sorted, stored in the
+        segment represented by segment_name. Keys its bloom filter rules out are
+        skipped, and the others are looked up block by block, reading each block
+        once.
+        '''
+        keys = [
+            key for key, present in
+            zip(keys, self.segment_bloom_filter(segment_name).check_many(keys)) if present]
+        if not keys:
+            return {}
 
-            while len(pairs):
-                ptr = (len(pairs) - 1) // 2
-                k, v = pairs[ptr].split(',')
+        table = self.segment_table(segment_name)
+        if table is not None:
+            return table.multi_get(keys, self.block_cache if self.block_cache.capacity else None)
 
-                if k == key:
-                    return v
+        return self.multi_search_indexed_segment(keys, segment_name)
+
+    def search_filtered_segment(self, key, segment_name):
+        ''' (self, str, str) -> str
+        Returns the value associated with key in the segment represented by
+        segment_name, if it exists. Otherwise return None. Segments whose bloom
+        filter rules the key out are skipped without touching disk.
+        '''
+        if not self.segment_bloom_filter(segment_name).check(key):
+            return None
+
+        table = self.segment_table(segment_name)
+        if table is not None:
+            return table.get(key, self.block_cache if self.block_cache.capacity else None)
+
+        return self.search_indexed_segment(key, segment_name)
+
+    def find_segment_in_level(self, key, level):
+        ''' (self, str, list) -> str
+        Returns the name of the segment in level whose key range covers key, or
+        None if there is none. The level's segments are sorted by key and don't
+        overlap, so it is binary searched.
+        '''
+        low, high = 0, len(level)
+        while low < high:
+            mid = (low + high) // 2
+            if self.segment_key_range(level[mid])[0] <= key:
+                low = mid + 1
+            else:
+                high = mid
+
+        if low == 0:
+            return None
+
+        segment = level[low - 1]
+        if key <= self.segment_key_range(segment)[1]:
+            return segment
+
+    def search_indexed_segment(self, key, segment_name):
+        ''' (self, str, str) -> str
+        Returns the value associated with key in the segment represented by
+        segment_name, if it exists. Otherwise return None.
+
+        The segment's sparse index gives the offsets of the closest indexed keys
+        around key, so at most one index block is ever searched, in place, by
+        binary searching the lines between them.
+        '''
+        index = self.segment_index(segment_name)
+        floor_key = index.floor(key)
+        start = index.find_node(floor_key).offset if floor_key is not None else 0
+
+        data = self.segment_reader(segment_name)
+        if floor_key == key:
+            end = data.find(b'\n', start) + 1 or len(data)
+        else:
+            ceil_key = index.ceil(key)
+            end = index.find_node(ceil_key).offset if ceil_key is not None else len(data)
+
+        return self.search_segment(key, segment_name, start, end)
+
+    def multi_search_indexed_segment(self, keys, segment_name):
+        ''' (self, [str], str) -> {str: str}
+        Returns the values of those of keys, which must be sorted, stored in the
+        segment represented by segment_name. Consecutive keys between the same two
+        indexed keys share an index block, whose bounds are only looked up once.
+        '''
+        index = self.segment_index(segment_name)
+        data = self.segment_reader(segment_name)
+
+        found = {}
+        end = next_key = None
+        for key in keys:
+            if end is None or (next_key is not None and key >= next_key):
+                floor_key = index.floor(key)
+                start = index.find_node(floor_key).offset if floor_key is not None else 0
+                # The block ends at the first indexed key after key, and no string
+                # sorts between key and key + '\x00'
+                next_key = index.ceil(key + '\x00')
+                end = index.find_node(next_key).offset if next_key is not None else len(data)
+
+            value = self.search_segment(key, segment_name, start, end)
+            if value is not None:
+                found[key] = value
+
+        return found
+
+    def search_segment(self, key, segment_name, low=0, high=None):
+        ''' (self, str, str, int, int) -> str
+        Returns the value associated with key in the segment represented
+        by segment_name, if it exists. Otherwise return None.
 
-                if key < k:
-                    pairs = pairs[0:ptr]
-                else:
-                    pairs = pairs[ptr+1:]
+        The segment is binary searched by byte offset: each probe jumps to the
+        middle of the remaining range, skips ahead to the start of the next line
+        and compares its key. Only O(log n) lines are ever decoded, in place.
+        The search can be limited to the lines between byte offsets low and high,
+        which must both be the start of a line or the end of the segment.
+        Tables are searched through their block index instead.
+        '''
+        table = self.segment_table(segment_name)
+        if table is not None:
+            return table.get(key, self.block_cache if self.block_cache.capacity else None)
+
+        data = self.segment_reader(segment_name)
+
+        # The record we're looking for, if present, starts in [low, high).
+        # low is always the start of a line.
+        if high is None:
+            high = len(data)
+
+        while low < high:
+            mid = (low + high) // 2
+
+            # Resync to the first line starting at or after mid
+            if mid == 0:
+                line_start = 0
+            else:
+                line_start = data.find(b'\n', mid - 1) + 1 or len(data)
+            if line_start >= high:
+                high = mid
+                continue
+
+            line_end = data.find(b'\n', line_start)
+            if line_end == -1:
+                line_end = len(data)
+            k, v = data[line_start:line_end].decode().strip().split(',')
+
+            if k == key:
+                return v
+
+            if key < k:
+                high = line_start
+            else:
+                low = line_end + 1
 
     # Metadata and initialization helpers
     def load_metadata(self):
@@ -173,37 +682,139 @@ class LSMTree():
                 metadata = pickle.load(s)
                 self.segments = metadata['segments']
                 self.current_segment = metadata['current_segment']
-                self.bloom_filter = metadata['bloom_filter']
                 self.bf_num_items = metadata['bf_num_items']
                 self.bf_false_pos_prob = metadata['bf_false_pos']
-                self.index = metadata['index']
+                self.levels = metadata.get('levels', [])
+                self.key_ranges = metadata.get('key_ranges', {})
+                self.compaction_pointers = metadata.get('compaction_pointers', {})
+                self.wal_number = metadata.get('wal_number', 1)
+                self.metadata_number = metadata.get('metadata_number', 0)
+
+            if 'bloom_filter' in metadata:
+                # Metadata written before the bloom filter was saved on its own
+                bloom_filter = metadata['bloom_filter']
+                self.bf_scalable = isinstance(bloom_filter, ScalableBloomFilter)
+                self.bf_double_hashing = getattr(bloom_filter, 'double_hashing', False)
+                self.bf_blocked = isinstance(bloom_filter, BlockedBloomFilter) or \
+                    getattr(bloom_filter, 'blocked', False)
+            else:
+                self.bf_scalable = metadata['bf_scalable']
+                self.bf_double_hashing = metadata['bf_double_hashing']
+                self.bf_blocked = metadata['bf_blocked']
+                bloom_filter = self.load_database_bloom_filter()
+
+            if bloom_filter is None:
+                self.rebuild_bloom_filter()
+            else:
+                self.bloom_filter = bloom_filter
 
     def save_metadata(self):
         ''' (self) -> None
         Save necessary bookkeeping information.
         '''
+        self.wait_for_flush()
+        self.memtable_wal().commit()
+        self.write_metadata()
+        self.write_bloom_filter()
+
+    def write_metadata(self):
+        ''' (self) -> None
+        Writes the bookkeeping information to disk, durably: it is written to a
+        temporary file and fsynced, which then replaces the previous metadata, so
+        a crash leaves either the old metadata or the new one.
+
+        The bloom filter isn't part of it, since this runs on every flush and
+        compaction; write_bloom_filter saves it.
+        '''
+        self.metadata_number += 1
         bookkeeping_info = {
             'current_segment': self.current_segment,
             'segments': self.segments,
-            'bloom_filter': self.bloom_filter,
             'bf_num_items': self.bf_num_items,
             'bf_false_pos': self.bf_false_pos_prob,
-            'index': self.index
+            'bf_scalable': self.bf_scalable,
+            'bf_double_hashing': self.bf_double_hashing,
+            'bf_blocked': self.bf_blocked,
+            'levels': self.levels,
+            'key_ranges': self.key_ranges,
+            'compaction_pointers': self.compaction_pointers,
+            'wal_number': self.wal_number,
+            'metadata_number': self.metadata_number
         }
 
-        with open(self.metadata_path(), 'wb') as s:
+        temporary_path = self.metadata_path() + '.tmp'
+        with open(temporary_path, 'wb') as s:
             pickle.dump(bookkeeping_info, s)
+            s.flush()
+            fsync_file(s.fileno())
+        rename_file(temporary_path, self.metadata_path())
 
     def restore_memtable(self):
         ''' (self) -> None
-        Re-populates the memtable from the disk backup.
+        Re-populates the memtable from the disk backup. Every write ahead log that
+        wasn't retired is replayed, oldest first, such as the log of a memtable whose
+        flush was interrupted, and the newest one is written to from then on.
+
+        A log whose last record was torn by a crash is truncated to the records
+        before it. A log none of whose records can be read is left as it is, in
+        case it was written in another format, and new writes go to a new log.
+
+        Only the last value written for each key is kept, and the memtable is then
+        built from them in one pass, in key order, instead of inserting every record.
         '''
-        if Path(self.memtable_wal_path()).exists():
-            with open(self.memtable_wal_path(), 'r') as s:
-                for line in s:
-                    key, value = line.strip().split(',')
-                    self.memtable.add(key, value)
-                    self.memtable.total_bytes += len(key) + len(value)
+        self.convert_legacy_wal()
+
+        latest = {}
+        wal_numbers = self.wal_numbers()
+        unreadable = False
+        for number in wal_numbers:
+            path = self.wal_path(number)
+            records, size = read_records(path, number)
+            unreadable = size == 0 and self.get_file_size(path) > 0
+            if 0 < size < self.get_file_size(path):
+                truncate_file(path, size)
+
+            latest.update((key, value) for op, key, value in records)
+
+        if latest:
+            self.memtable = RedBlackTree.from_sorted(sorted(latest.items()))
+            self.memtable.total_bytes = sum(len(key) + len(value) for key, value in latest.items())
+
+        self.wal_number = max(wal_numbers + [self.wal_number])
+        # Writes appended past records that can't be read couldn't be read either
+        if unreadable:
+            self.wal_number += 1
+
+    def convert_legacy_wal(self):
+        ''' (self) -> None
+        Converts the write ahead log written before logs held binary records, a
+        text log named after wal_basename alone, into a numbered log so that it is
+        replayed with the rest.
+
+        The numbered log is written to a temporary file and fsynced before it
+        replaces any file, so the old log is only removed once its records are
+        safely in it. An old log none of whose lines can be read is kept.
+        '''
+        path = self.legacy_wal_path()
+        if not Path(path).exists():
+            return
+
+        records, size = read_legacy_records(path)
+
+        # A numbered log can only exist alongside the old one if a crash
+        # interrupted its removal, after it was converted
+        if records and not self.wal_numbers():
+            temporary_path = self.memtable_wal_path() + '.tmp'
+            with open(temporary_path, 'wb') as s:
+                s.write(b''.join(
+                    encode_record(key, value, op, log_number=self.wal_number)
+                    for op, key, value in records))
+                s.flush()
+                fsync_file(s.fileno())
+            rename_file(temporary_path, self.memtable_wal_path())
+
+        if size > 0 or self.get_file_size(path) == 0:
+            remove_file(path)
 
     # Write helpers
 
@@ -211,8 +822,166 @@ class LSMTree():
         ''' (self, str) -> None
         Writes the contents of the current memtable to disk and wipes the current memtable.
 
-        Updates the index and adds keys to the bloom filter.
+        Builds the segment's sparse index and bloom filter, saving them next to the
+        segment, and adds keys to the database's bloom filter.
+        '''
+        pairs = ((node.key, node.value) for node in self.memtable.in_order())
+        keys = self.write_segment(path, self.current_segment, pairs)
+        self.bloom_filter.add_many(keys)
+        self.bytes_flushed += self.get_file_size(path)
+
+    def flush_in_background(self):
+        ''' (self) -> None
+        Makes the current memtable immutable and hands it to a background thread
+        to be flushed and compacted, while a fresh memtable and write ahead log
+        take writes. Only one memtable can be waiting to be flushed, so this first
+        waits for the previous flush to complete.
+        '''
+        self.wait_for_flush()
+
+        segment = self.current_segment
+        self.current_segment = self.incremented_segment_name()
+
+        # The full log is kept until its memtable is on disk
+        self.rotate_wal()
+
+        self.immutable_memtable = self.memtable
+        self.memtable = RedBlackTree()
+        self.memtable.total_bytes = 0
+
+        self.flush_thread = Thread(
+            target=self.flush_immutable_memtable, args=(segment, self.wal_number))
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def flush_immutable_memtable(self, segment_name, wal_number):
+        ''' (self, str, int) -> None
+        Writes the immutable memtable to a new segment called segment_name, retires
+        the write ahead logs older than log wal_number, then runs compaction. Readers
+        keep consulting the immutable memtable until the segment is in place.
+        '''
+        path = self.segment_path(segment_name)
+        pairs = ((node.key, node.value) for node in self.immutable_memtable.in_order())
+        keys = self.write_segment(path, segment_name, pairs)
+        self.bloom_filter.add_many(keys)
+        self.bytes_flushed += self.get_file_size(path)
+
+        with self.lock:
+            self.segments.append(segment_name)
+            self.immutable_memtable = None
+            self.write_metadata()
+
+        self.retire_wals(wal_number)
+        self.compact()
+
+    def wait_for_flush(self):
+        ''' (self) -> None
+        Blocks until the background flush and compaction, if any, is complete.
+        '''
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+
+    def open_wal(self):
+        ''' (self) -> AppendLog
+        Opens the current write ahead log with the tree's log settings. A new log
+        takes over a recycled one, if any, rather than a fresh file.
+        '''
+        path = self.memtable_wal_path()
+        recycled = self.recycled_wal_numbers()
+        recycle = bool(recycled) and not Path(path).exists()
+        if recycle:
+            rename_file(self.recycled_wal_path(recycled[0]), path)
+
+        wal = AppendLog(path, recycle)
+        wal.set_group_commit(self.wal_max_batch, self.wal_max_delay)
+        wal.set_sync_policy(self.wal_sync_policy, self.wal_sync_interval)
+        wal.set_async(self.wal_async)
+        return wal
+
+    def rotate_wal(self):
+        ''' (self) -> None
+        Closes the current write ahead log and moves on to the next one, for a fresh
+        memtable. The closed log stays on disk until it is retired.
+        '''
+        self.memtable_wal().close()
+        self.wal_number += 1
+        self.wal = self.open_wal()
+
+    def retire_wals(self, wal_number):
+        ''' (self, int) -> None
+        Retires the write ahead logs numbered below wal_number, whose memtables are
+        all on disk: they are kept to be recycled, up to wal_recycle_limit of them,
+        and deleted otherwise.
+        '''
+        num_recycled = len(self.recycled_wal_numbers())
+        for number in self.wal_numbers():
+            if number >= wal_number:
+                break
+
+            if num_recycled < self.wal_recycle_limit:
+                rename_file(self.wal_path(number), self.recycled_wal_path(number))
+                num_recycled += 1
+            else:
+                remove_file(self.wal_path(number))
+
+    def wal_numbers(self):
+        ''' (self) -> [int]
+        Returns the numbers of the write ahead logs on disk, in ascending order.
         '''
+        return self.numbered_files(self.wal_basename + '-')
+
+    def recycled_wal_numbers(self):
+        ''' (self) -> [int]
+        Returns the numbers of the retired write ahead logs kept to be recycled, in
+        ascending order.
+        '''
+        return self.numbered_files(self.wal_basename + '.recycle-')
+
+    def numbered_files(self, prefix):
+        ''' (self, str) -> [int]
+        Returns the numbers of the files in the segments directory named prefix
+        followed by a number, in ascending order.
+        '''
+        return sorted(
+            int(name[len(prefix):]) for name in listdir(self.segments_directory)
+            if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+    def write_segment(self, path, segment_name, pairs, max_bytes=None, level=0):
+        ''' (self, str, str, iterator, int, int) -> [str]
+        Writes the key value pairs, which must be sorted by key, to a segment of
+        level at path and returns the keys written. If max_bytes is given, stops
+        once the segment reaches that size, leaving the rest of pairs unconsumed.
+
+        Builds the segment's sparse index, bloom filter and key range, saving the
+        first two next to the segment. Tables carry their own index instead.
+        '''
+        # A mapping of a file written over would be left reading a truncated file,
+        # and cached blocks would be stale
+        self.table_cache.evict(segment_name)
+        self.block_cache.erase_file(path)
+
+        if self.segment_format == 'sstable':
+            keys = self.write_table(path, segment_name, pairs, max_bytes, level)
+        else:
+            keys = self.write_csv_segment(path, segment_name, pairs, max_bytes)
+
+        bloom_filter = self.new_segment_bloom_filter(len(keys))
+        bloom_filter.add_many(keys)
+
+        self.save_bloom_filter(bloom_filter, path)
+        self.bloom_filters[segment_name] = bloom_filter
+        self.key_ranges[segment_name] = (keys[0], keys[-1]) if keys else None
+
+        return keys
+
+    def write_csv_segment(self, path, segment_name, pairs, max_bytes=None):
+        ''' (self, str, str, iterator, int) -> [str]
+        Writes the key value pairs to a CSV segment at path, one key,value line each,
+        along with its sparse index, and returns the keys written.
+        '''
+        index = RedBlackTree()
+        keys = []
         sparsity_counter = self.sparsity()
 
         # We track the offset for each key ourself, instead of checking the file's size as we
@@ -220,21 +989,74 @@ class LSMTree():
         key_offset = 0
 
         with open(path, 'w') as s:
-            for node in self.memtable.in_order():
-                log = self.to_log_entry(node.key, node.value)
+            for key, value in pairs:
+                log = self.to_log_entry(key, value)
 
                 # Update sparse index
                 if sparsity_counter == 1:
-                    self.index.add(node.key, node.value,
-                                   offset=key_offset, segment=self.current_segment)
+                    index.add(key, offset=key_offset)
                     sparsity_counter = self.sparsity() + 1
 
-                # Add to bloom filters
-                self.bloom_filter.add(node.key)
                 s.write(log)
-                key_offset += len(log)
+                keys.append(key)
+                key_offset += len(log.encode())
                 sparsity_counter -= 1
 
+                if max_bytes is not None and key_offset >= max_bytes:
+                    break
+
+            # The segment must be on disk before the metadata listing it
+            s.flush()
+            fsync_file(s.fileno())
+
+        self.save_index(index, path)
+        self.indexes[segment_name] = index
+
+        return keys
+
+    def write_table(self, path, segment_name, pairs, max_bytes=None, level=0):
+        ''' (self, str, str, iterator, int, int) -> [str]
+        Writes the key value pairs to a table of level at path, compressed as
+        configured for that level, and returns the keys written. The table is
+        forced to disk before it is opened for reads.
+        '''
+        compression, compression_level = self.level_compressions.get(
+            level, (self.compression, self.compression_level))
+        writer = SSTableWriter(
+            path, self.block_size, self.restart_interval, compression, compression_level)
+        keys = []
+        for key, value in pairs:
+            writer.add(key, value)
+            keys.append(key)
+
+            if max_bytes is not None and writer.size() >= max_bytes:
+                break
+
+        writer.finish()
+        self.table_cache.put(segment_name, SSTable(path))
+
+        return keys
+
+    def write_segments(self, pairs, max_bytes=None, level=0):
+        ''' (self, iterator, int, int) -> [str]
+        Writes the key value pairs, which must be sorted by key, to as many new
+        segments of level, of about max_bytes, as needed, and returns their names.
+        Without max_bytes, a single segment is written.
+        '''
+        pairs = iter(pairs)
+        segment_names = []
+
+        pair = next(pairs, None)
+        while pair is not None:
+            segment = self.new_segment_name()
+            self.write_segment(
+                self.segment_path(segment), segment, chain([pair], pairs), max_bytes, level)
+            self.bytes_compacted += self.get_file_size(self.segment_path(segment))
+            segment_names.append(segment)
+            pair = next(pairs, None)
+
+        return segment_names
+
     def to_log_entry(self, key, value):
         '''(str, str) -> str
         Converts a key value pair into a comma seperated newline delimited
@@ -252,92 +1074,289 @@ class LSMTree():
 
         return '-'.join([name, new_number])
 
+    def new_segment_name(self):
+        ''' (self) -> str
+        Reserves a name for a segment written by compaction. Names are taken
+        from the same sequence as the segments flushed from the memtable.
+        '''
+        segment_name = self.current_segment
+        self.current_segment = self.incremented_segment_name()
+        return segment_name
+
     # Compact and merge
 
     def compact(self):
         ''' (self) -> None
-        Reads the keys from the memtable, determines which ones probably
-        have pre-existing records on disk and reclaims disk space accordingly.
+        Runs the configured compaction strategy.
 
-        Note: this will parse every segment in self.segments. It is intended to be
-        used BEFORE flushing the memtable to disk.
+        Note: It is intended to be used AFTER flushing the memtable to disk.
         '''
-        memtable_nodes = self.memtable.in_order()
+        if self.compaction_strategy == 'size_tiered':
+            self.compact_size_tiered()
+        else:
+            self.compact_leveled()
+
+    def compact_leveled(self):
+        ''' (self) -> None
+        Runs leveled compaction until every level is within its limits: level 0
+        holds fewer than level0_max_segments segments, and each deeper level is no
+        larger than max_level_size.
 
-        keys_on_disk = []
-        for node in memtable_nodes:
-            if self.bloom_filter.check(node.key):
-                keys_on_disk.append(node.key)
+        Each flush only writes its own segment, and a record is rewritten about once
+        per level as it sinks, rather than on every flush.
+        '''
+        if len(self.segments) >= self.level0_max_segments:
+            self.compact_level(0)
 
-        keys_on_disk = set(keys_on_disk)
+        level = 1
+        while level <= len(self.levels):
+            while self.level_size(level) > self.max_level_size(level):
+                self.compact_level(level)
+            level += 1
 
-        self.delete_keys_from_segments(keys_on_disk, self.segments)
+    def compact_level(self, level):
+        ''' (self, int) -> None
+        Merges segments of level into the level below it: all of level 0, or a
+        single segment of a deeper level, picked round robin across its key range.
 
-    def delete_keys_from_segments(self, deletion_keys, segment_names):
-        ''' (self, list) -> None
-        Deletes all keys stored in the set deletion_keys from each segment
-        listed in segment_names.
+        They are merged with every segment of the next level whose key range
+        overlaps theirs, the result is split into new segments of about threshold
+        bytes, and the merged segments are deleted.
+        '''
+        if level == 0:
+            inputs = self.segments[:]
+        else:
+            inputs = [self.segment_to_compact(level)]
+
+        if level == len(self.levels):
+            self.levels.append([])
+        next_level = self.levels[level]
+
+        key_ranges = [self.segment_key_range(segment) for segment in inputs]
+        key_ranges = [key_range for key_range in key_ranges if key_range is not None]
+
+        overlapping = []
+        if key_ranges:
+            first = min(key_range[0] for key_range in key_ranges)
+            last = max(key_range[1] for key_range in key_ranges)
+            overlapping = [
+                segment for segment in next_level
+                if self.segment_key_range(segment)[0] <= last and
+                    self.segment_key_range(segment)[1] >= first]
+
+            if level > 0:
+                self.compaction_pointers[level] = last
+
+        # The next level holds older records, so its segments go first
+        outputs = self.write_segments(
+            self.merge_segments(overlapping + inputs), self.threshold, level + 1)
+
+        with self.lock:
+            if level == 0:
+                self.segments = [segment for segment in self.segments if segment not in inputs]
+            else:
+                self.levels[level - 1] = [
+                    segment for segment in self.levels[level - 1] if segment not in inputs]
+
+            self.levels[level] = sorted(
+                [segment for segment in next_level if segment not in overlapping] + outputs,
+                key=lambda segment: self.segment_key_range(segment)[0])
+
+            # The merged segments are only deleted once the metadata no longer lists them
+            self.write_metadata()
+            for segment in inputs + overlapping:
+                self.remove_segment(segment)
+
+    def compact_size_tiered(self):
+        ''' (self) -> None
+        Runs size-tiered compaction: as long as level 0 holds tier_size neighbouring
+        segments of similar size, they are merged into a single segment, which takes
+        their place. Merged segments then form a larger tier of their own, so a record
+        is rewritten once per tier rather than once per level.
         '''
-        for segment in segment_names:
-            segment_path = self.segment_path(segment)
-            self.delete_keys_from_segment(deletion_keys, segment_path)
+        tier = self.similarly_sized_tier()
+        while tier is not None:
+            start, end = tier
+            inputs = self.segments[start:end]
+            outputs = self.write_segments(self.merge_segments(inputs))
+
+            with self.lock:
+                self.segments = self.segments[:start] + outputs + self.segments[end:]
+                self.write_metadata()
+                for segment in inputs:
+                    self.remove_segment(segment)
+
+            tier = self.similarly_sized_tier()
+
+    def similarly_sized_tier(self):
+        ''' (self) -> (int, int)
+        Returns the bounds of the first run of tier_size neighbouring level 0
+        segments whose sizes are all within half and one and a half times the
+        run's average, or None if there is none.
+
+        Only neighbours are merged, so the segments keep their age order.
+        '''
+        start, total = 0, 0
+        for end, segment in enumerate(self.segments):
+            size = self.get_file_size(self.segment_path(segment))
+            average = total / (end - start) if end > start else size
+            if not average / 2 <= size <= average * 3 / 2:
+                start, total = end, 0
+
+            total += size
+            if end + 1 - start == self.tier_size:
+                return start, end + 1
+
+        return None
+
+    def segment_to_compact(self, level):
+        ''' (self, int) -> str
+        Returns the name of the segment of level to merge into the next one: the
+        first one past the last key compacted from level, wrapping around to the
+        start of the level.
+        '''
+        segments = self.levels[level - 1]
+        pointer = self.compaction_pointers.get(level)
+
+        for segment in segments:
+            if pointer is None or self.segment_key_range(segment)[0] > pointer:
+                return segment
+
+        return segments[0]
 
-    def delete_keys_from_segment(self, deletion_keys, segment_path):
-        ''' (self, set(keys), str) -> None
-        Removes the lines with key in deletion_keys from the file stored at segment 
-        path.
+    def merge_segments(self, segment_names):
+        ''' (self, [str]) -> generator((str, str))
+        Merges the segments represented by segment_names, given from oldest to
+        newest, yielding their key value pairs sorted by key. When several segments
+        hold a key, only the newest value is kept.
 
-        The method achieves this by writing the desireable keys to a new 
-        temporary file, then deleting the old version and replacing it with the
-        temporary one. This strategy is chosen to avoid overloading memory.
+        Segments are streamed, so only one record per segment is held in memory.
         '''
-        temp_path = segment_path + '_temp'
+        # heapq.merge is stable, so for equal keys the newest segment comes first
+        streams = [self.segment_records(segment) for segment in reversed(segment_names)]
+
+        last_key = None
+        for key, value in heapq.merge(*streams, key=itemgetter(0)):
+            if key != last_key:
+                yield key, value
+                last_key = key
+
+    def segment_records(self, segment_name):
+        ''' (self, str) -> generator((str, str))
+        Yields the key value pairs stored in the segment represented by
+        segment_name, in order.
+        '''
+        table = self.segment_table(segment_name)
+        if table is not None:
+            yield from table.items()
+            return
 
-        with open(segment_path, "r") as input:
-            with open(temp_path, "w") as output:
-                for line in input:
-                    key, value = line.split(',')
-                    if not key in deletion_keys:
-                        output.write(line)
+        with open(self.segment_path(segment_name), 'r') as s:
+            for line in s:
+                key, value = line.strip().split(',')
+                yield key, value
+
+    def segment_key_range(self, segment_name):
+        ''' (self, str) -> (str, str)
+        Returns the first and last keys of the segment represented by segment_name,
+        or None if it is empty. It is recorded when the segment is written; segments
+        without one are parsed.
+        '''
+        if segment_name not in self.key_ranges and self.segment_table(segment_name) is not None:
+            table = self.segment_table(segment_name)
+            self.key_ranges[segment_name] = \
+                (table.first_key, table.last_key) if table.num_entries else None
 
-        remove_file(segment_path)
-        rename_file(temp_path, segment_path)
+        if segment_name not in self.key_ranges:
+            first = last = None
+            for key, value in self.segment_records(segment_name):
+                if first is None:
+                    first = key
+                last = key
 
-    def merge(self, segment1, segment2):
-        ''' (self, str, str) -> str
-        Concatenates the contents of the files represented byt segment1 and
-        segment2, erases the second segment file and returns the name of the
-        first segment. 
-        '''
-        path1 = self.segments_directory + segment1
-        path2 = self.segments_directory + segment2
-        new_path = self.segments_directory + 'temp'
-
-        with open(new_path, 'w') as s0:
-            with open(path1, 'r') as s1:
-                with open(path2, 'r') as s2:
-                    line1, line2 = s1.readline(), s2.readline()
-                    while not (line1 == '' and line2 == ''):
-                        # At the end of the file stream we'll get the empty str
-                        key1, key2 = line1.split(',')[0], line2.split(',')[0]
-
-                        if key1 == '' or key1 == key2:
-                            s0.write(line2)
-                            line1 = s1.readline()
-                            line2 = s2.readline()
-                        elif key2 == '' or key1 < key2:
-                            s0.write(line1)
-                            line1 = s1.readline()
-                        else:
-                            s0.write(line2)
-                            line2 = s2.readline()
-
-        # Remove old segments and replaced first segment with the new one
-        remove_file(path1)
-        remove_file(path2)
-        rename_file(new_path, path1)
-
-        return segment1
+            self.key_ranges[segment_name] = (first, last) if first is not None else None
+
+        return self.key_ranges[segment_name]
+
+    def level_size(self, level):
+        ''' (self, int) -> int
+        Returns the number of bytes stored in the segments of level, from 1 on.
+        '''
+        return sum(
+            self.get_file_size(self.segment_path(segment)) for segment in self.levels[level - 1])
+
+    def max_level_size(self, level):
+        ''' (self, int) -> int
+        Returns the number of bytes level, from 1 on, can hold before it is compacted.
+        '''
+        return self.threshold * self.level_size_ratio ** level
+
+    def remove_segment(self, segment_name):
+        ''' (self, str) -> None
+        Deletes the segment represented by segment_name, along with its sidecar
+        files and everything cached about it.
+        '''
+        self.table_cache.evict(segment_name)
+
+        path = self.segment_path(segment_name)
+        self.block_cache.erase_file(path)
+        for file_path in (path, self.index_path(path), self.bloom_filter_path(path)):
+            if Path(file_path).exists():
+                remove_file(file_path)
+
+        self.indexes.pop(segment_name, None)
+        self.bloom_filters.pop(segment_name, None)
+        self.key_ranges.pop(segment_name, None)
+
+    def segment_table(self, segment_name):
+        ''' (self, str) -> SSTable
+        Returns the table stored in the segment represented by segment_name, or None
+        if the segment is CSV.
+        '''
+        reader = self.segment_reader(segment_name)
+        return reader if isinstance(reader, SSTable) else None
+
+    def segment_reader(self, segment_name):
+        ''' (self, str) -> SSTable or mmap
+        Returns the open reader of the segment represented by segment_name: its
+        table, or a mapping of the whole file for CSV segments. Readers come from
+        the table cache, and are opened and cached on a miss.
+        '''
+        reader = self.table_cache.get(segment_name)
+        if reader is not None:
+            return reader
+
+        path = self.segment_path(segment_name)
+        if is_sstable(path):
+            reader = SSTable(path)
+        elif self.get_file_size(path) == 0:
+            # Empty files can't be mapped, and there's nothing to keep open
+            return b''
+        else:
+            with open(path, 'rb') as s:
+                reader = mmap(s.fileno(), 0, access=ACCESS_READ)
+
+        self.table_cache.put(segment_name, reader)
+        return reader
+
+    def all_segments(self):
+        ''' (self) -> [str]
+        Returns the names of every segment on disk, level by level.
+        '''
+        return self.segments + [segment for level in self.levels for segment in level]
+
+    def write_file(self, path, data):
+        ''' (self, str, bytes) -> None
+        Writes data to the file at path durably: it is written to a temporary file
+        and fsynced, which then replaces the file, so a crash leaves either the old
+        file or the new one, never a torn one.
+        '''
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as s:
+            s.write(data)
+            s.flush()
+            fsync_file(s.fileno())
+        rename_file(temporary_path, path)
 
     def get_file_size(self, path):
         return Path(path).stat().st_size
@@ -350,47 +1369,273 @@ class LSMTree():
         '''
         return self.threshold // self.sparsity_factor
 
+    def segment_index(self, segment_name):
+        ''' (self, str) -> RedBlackTree
+        Returns the sparse index of the segment represented by segment_name.
+
+        The index is loaded from the file saved next to the segment. If there is
+        none, the segment is parsed to build it.
+        '''
+        if segment_name in self.indexes:
+            return self.indexes[segment_name]
+
+        path = self.segment_path(segment_name)
+        index = None
+        if Path(self.index_path(path)).exists():
+            try:
+                index = self.load_index(path)
+            except ValueError:
+                # The file was torn by a crash while being saved
+                pass
+
+        if index is None:
+            index = self.index_segment(path)
+
+        self.indexes[segment_name] = index
+        return index
+
+    def index_segment(self, path):
+        ''' (self, str) -> RedBlackTree
+        Builds the sparse index for the segment stored at path by parsing it, then
+        saves it next to the segment.
+        '''
+        index = RedBlackTree()
+        counter = self.sparsity()
+        bytes = 0
+        with open(path, 'rb') as s:
+            for line in s:
+                key, val = line.decode().strip().split(',')
+                if counter == 1:
+                    index.add(key, offset=bytes)
+                    counter = self.sparsity() + 1
+
+                bytes += len(line)
+                counter -= 1
+
+        self.save_index(index, path)
+        self.indexes.pop(Path(path).name, None)
+        return index
+
+    def save_index(self, index, path):
+        ''' (self, RedBlackTree, str) -> None
+        Saves the sparse index of the segment stored at path next to it, as
+        one key,offset line per entry, durably.
+        '''
+        lines = (self.to_log_entry(node.key, str(node.offset)) for node in index.in_order())
+        self.write_file(self.index_path(path), ''.join(lines).encode())
+
+    def load_index(self, path):
+        ''' (self, str) -> RedBlackTree
+        Loads the sparse index saved next to the segment stored at path.
+        '''
+        index = RedBlackTree()
+        with open(self.index_path(path), 'r') as s:
+            for line in s:
+                key, offset = line.strip().split(',')
+                index.add(key, offset=int(offset))
+
+        return index
+
     def repopulate_index(self):
         '''(self) -> None
-        Repopulates the index stored in the database by parsing each segment
-        on disk.
+        Rebuilds the sparse index of each segment on disk by parsing it.
         '''
-        self.index = RedBlackTree()
-        for segment in self.segments:
-            path = self.segment_path(segment)
+        self.indexes = {}
+        for segment in self.all_segments():
+            if self.segment_table(segment) is None:
+                self.indexes[segment] = self.index_segment(self.segment_path(segment))
 
-            counter = self.sparsity()
-            bytes = 0
-            with open(path, 'r') as s:
-                for line in s:
-                    key, val = line.strip().split(',')
-                    if counter == 1:
-                        self.index.add(key, val, offset=bytes, segment=segment)
-                        counter = self.sparsity() + 1
+    # Bloom filter
+    def new_bloom_filter(self):
+        ''' (self) -> BloomFilter or ScalableBloomFilter
+        Returns a new, empty, bloom filter for the whole database, built
+        from the current configuration.
+        '''
+        if self.bf_scalable:
+            return ScalableBloomFilter(
+                self.bf_num_items, self.bf_false_pos_prob,
+                double_hashing=self.bf_double_hashing, blocked=self.bf_blocked)
 
-                    bytes += len(line)
-                    counter -= 1
+        if self.bf_blocked:
+            return BlockedBloomFilter(self.bf_num_items, self.bf_false_pos_prob)
+
+        return BloomFilter(self.bf_num_items, self.bf_false_pos_prob, self.bf_double_hashing)
+
+    def write_bloom_filter(self):
+        ''' (self) -> None
+        Saves the database's bloom filter next to the metadata, durably, tagged
+        with the number of the metadata it matches.
+        '''
+        self.write_file(
+            self.bloom_filter_path(self.metadata_path()),
+            pickle.dumps((self.metadata_number, self.bloom_filter)))
+
+    def load_database_bloom_filter(self):
+        ''' (self) -> BloomFilter or ScalableBloomFilter
+        Loads the database's bloom filter saved next to the metadata, or returns
+        None if there is none, or if segments were flushed or compacted since it
+        was saved.
+        '''
+        path = self.bloom_filter_path(self.metadata_path())
+        if not Path(path).exists():
+            return None
+
+        try:
+            with open(path, 'rb') as s:
+                metadata_number, bloom_filter = pickle.load(s)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+
+        return bloom_filter if metadata_number == self.metadata_number else None
+
+    def rebuild_bloom_filter(self):
+        ''' (self) -> None
+        Replaces the database's bloom filter with a new one built from the current
+        configuration, holding the keys of every segment on disk, for when the
+        configuration changes how keys are hashed, or the saved filter is missing
+        or out of date. Waits for a background flush,
+        if any, so the keys of its segment aren't left out.
+        '''
+        self.wait_for_flush()
+
+        bloom_filter = self.new_bloom_filter()
+        with self.lock:
+            for segment in self.all_segments():
+                bloom_filter.add_many([key for key, value in self.segment_records(segment)])
+
+            self.bloom_filter = bloom_filter
+
+    def new_segment_bloom_filter(self, num_items):
+        ''' (self, int) -> BloomFilter
+        Returns a new, empty, bloom filter for a segment holding num_items keys,
+        built from the current configuration.
+        '''
+        if self.bf_blocked:
+            return BlockedBloomFilter(max(num_items, 1), self.bf_false_pos_prob)
+
+        return BloomFilter(max(num_items, 1), self.bf_false_pos_prob, self.bf_double_hashing)
+
+    def segment_bloom_filter(self, segment_name):
+        ''' (self, str) -> BloomFilter
+        Returns the bloom filter of the segment represented by segment_name.
+
+        The filter is loaded from the file saved next to the segment. If there is
+        none, the segment is parsed to build it.
+        '''
+        if segment_name in self.bloom_filters:
+            return self.bloom_filters[segment_name]
+
+        path = self.segment_path(segment_name)
+        bloom_filter = None
+        if Path(self.bloom_filter_path(path)).exists():
+            try:
+                bloom_filter = self.load_bloom_filter(path)
+            except (EOFError, pickle.UnpicklingError):
+                # The file was torn by a crash while being saved
+                pass
+
+        if bloom_filter is None:
+            bloom_filter = self.filter_segment(path)
+
+        self.bloom_filters[segment_name] = bloom_filter
+        return bloom_filter
+
+    def filter_segment(self, path):
+        ''' (self, str) -> BloomFilter
+        Builds the bloom filter for the segment stored at path by parsing it, then
+        saves it next to the segment.
+
+        The segment is read twice, once to size the filter and once to fill it,
+        to avoid holding its keys in memory.
+        '''
+        table = self.segment_table(Path(path).name)
+        if table is not None:
+            bloom_filter = self.new_segment_bloom_filter(table.num_entries)
+            bloom_filter.add_many(list(table.keys()))
+            self.save_bloom_filter(bloom_filter, path)
+            self.bloom_filters.pop(Path(path).name, None)
+            return bloom_filter
+
+        with open(path, 'rb') as s:
+            num_items = sum(1 for line in s)
+
+        bloom_filter = self.new_segment_bloom_filter(num_items)
+        with open(path, 'rb') as s:
+            for line in s:
+                key, val = line.decode().strip().split(',')
+                bloom_filter.add(key)
+
+        self.save_bloom_filter(bloom_filter, path)
+        self.bloom_filters.pop(Path(path).name, None)
+        return bloom_filter
+
+    def save_bloom_filter(self, bloom_filter, path):
+        ''' (self, BloomFilter, str) -> None
+        Saves the bloom filter of the segment stored at path next to it, durably.
+        '''
+        self.write_file(self.bloom_filter_path(path), pickle.dumps(bloom_filter))
+
+    def load_bloom_filter(self, path):
+        ''' (self, str) -> BloomFilter
+        Loads the bloom filter saved next to the segment stored at path.
+        '''
+        with open(self.bloom_filter_path(path), 'rb') as s:
+            return pickle.load(s)
 
-    # Bloom filter
     def set_bloom_filter_num_items(self, num_items):
         ''' (self, int) -> None
-        Sets the number of expected item for the bloom filter.
+        Sets the number of expected item for the bloom filter. If the bloom filter
+        is scalable, this is the capacity of its first filter.
 
-        Warning - this operation re-initializes structure.
+        The bloom filter is rebuilt from the keys of every segment on disk.
         '''
         self.bf_num_items = num_items
-        self.bloom_filter = BloomFilter(
-            self.bf_num_items, self.bf_false_pos_prob)
+        self.rebuild_bloom_filter()
 
     def set_bloom_filter_false_pos_prob(self, probability):
         ''' (self, int) -> None
         Sets the desired probability of generating a false positive for the bloom filter.
+        Segments flushed from now on will use it for their own bloom filters.
 
-        Warning - this operation re-initializes the structure.
+        The database's bloom filter is rebuilt from the keys of every segment on disk.
         '''
         self.bf_false_pos_prob = probability
-        self.bloom_filter = BloomFilter(
-            self.bf_num_items, self.bf_false_pos_prob)
+        self.rebuild_bloom_filter()
+
+    def set_bloom_filter_scalable(self, scalable):
+        ''' (self, bool) -> None
+        Sets whether the bloom filter should grow as keys are added, keeping
+        its false positive probability past the expected number of items,
+        or be sized once from the expected number of items.
+
+        The bloom filter is rebuilt from the keys of every segment on disk.
+        '''
+        self.bf_scalable = scalable
+        self.rebuild_bloom_filter()
+
+    def set_bloom_filter_double_hashing(self, double_hashing):
+        ''' (self, bool) -> None
+        Sets whether bloom filters should derive all of their bit positions from
+        a single hash of each key, which makes adding and checking keys cheaper
+        when the false positive probability is low. Segments flushed from now on
+        will use it for their own bloom filters.
+
+        The database's bloom filter is rebuilt from the keys of every segment on disk.
+        '''
+        self.bf_double_hashing = double_hashing
+        self.rebuild_bloom_filter()
+
+    def set_bloom_filter_blocked(self, blocked):
+        ''' (self, bool) -> None
+        Sets whether bloom filters should use a blocked layout, where all the bits
+        of a key land in the same cache line sized block. Checks get cheaper, at the
+        cost of a higher false positive rate when the probability is low. Segments
+        flushed from now on will use it for their own bloom filters.
+
+        The database's bloom filter is rebuilt from the keys of every segment on disk.
+        '''
+        self.bf_blocked = blocked
+        self.rebuild_bloom_filter()
 
     # Path generators
     def current_segment_path(self):
@@ -400,14 +1645,46 @@ class LSMTree():
         ''' (self) -> str
         Returns the path to the memtable write ahead log.
         '''
+        return self.wal_path(self.wal_number)
+
+    def wal_path(self, number):
+        ''' (self, int) -> str
+        Returns the path to the write ahead log numbered number.
+        '''
+        return self.segments_directory + self.wal_basename + '-' + str(number)
+
+    def legacy_wal_path(self):
+        ''' (self) -> str
+        Returns the path of the text write ahead log written before logs held
+        binary records.
+        '''
         return self.segments_directory + self.wal_basename
 
+    def recycled_wal_path(self, number):
+        ''' (self, int) -> str
+        Returns the path a retired write ahead log numbered number is kept at
+        until it is recycled.
+        '''
+        return self.segments_directory + self.wal_basename + '.recycle-' + str(number)
+
     def segment_path(self, segment_name):
         ''' (self, str) -> str
         Returns the path to the given segment_name.
         '''
         return self.segments_directory + segment_name
 
+    def index_path(self, segment_path):
+        ''' (self, str) -> str
+        Returns the path to the sparse index of the segment stored at segment_path.
+        '''
+        return segment_path + '.index'
+
+    def bloom_filter_path(self, segment_path):
+        ''' (self, str) -> str
+        Returns the path to the bloom filter of the segment stored at segment_path.
+        '''
+        return segment_path + '.filter'
+
     def metadata_path(self):
         ''' (self) -> str
         Returns the path to the metadata backup file.
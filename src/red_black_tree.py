@@ -89,6 +89,37 @@ class RedBlackTree:
             return list()
         yield from self.root.__iter__()
 
+    @classmethod
+    def from_sorted(cls, pairs):
+        ''' ([(str, str)]) -> RedBlackTree
+        Builds a tree holding the key value pairs, which must be sorted by key and
+        have unique keys, in linear time and without any rebalancing.
+
+        Each subtree is rooted at the middle of its pairs, so every path ends at the
+        deepest level or the one above it. Nodes on the deepest level are red and the
+        others black, which gives every path the same number of black nodes.
+        '''
+        tree = cls()
+        height = len(pairs).bit_length()
+        nil_leaf = cls.NIL_LEAF
+
+        def build(low, high, depth, parent):
+            if low >= high:
+                return nil_leaf
+
+            mid = (low + high) // 2
+            key, value = pairs[mid]
+            color = RED if depth == height - 1 and depth > 0 else BLACK
+            node = Node(key, color=color, parent=parent, value=value)
+            node.left = build(low, mid, depth + 1, node)
+            node.right = build(mid + 1, high, depth + 1, node)
+            return node
+
+        if pairs:
+            tree.root = build(0, len(pairs), 0, None)
+        tree.count = len(pairs)
+        return tree
+
     def add(self, key, value=None, offset=None, segment=None):
         # add the node
         if not self.root:
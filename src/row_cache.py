@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from threading import Lock
+
+class RowCache():
+    def __init__(self, capacity=0):
+        ''' (self, int) -> RowCache
+        Initializes an empty cache of values read from disk, keyed by their key,
+        holding at most capacity bytes of keys and values. A capacity of 0 turns
+        the cache off.
+
+        Once the cache is full, the least recently read keys are evicted to make
+        room. Writes erase the key they write, and bump the cache's generation:
+        a value read from disk is only cached if no write happened since the read
+        started, so a read racing a write can't cache the value it replaced.
+        '''
+        self.capacity = capacity
+        self.usage = 0
+        self.rows = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        ''' (self, str) -> str
+        Returns the cached value of key, marking it as the most recently read, or
+        None if it isn't cached.
+        '''
+        with self.lock:
+            value = self.rows.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.rows.move_to_end(key)
+            return value
+
+    def put(self, key, value, generation):
+        ''' (self, str, str, int) -> None
+        Caches value as the value of key, read from disk when the cache was at
+        generation, and evicts the least recently read keys past capacity. Nothing
+        is cached if a write happened since.
+        '''
+        charge = len(key) + len(value)
+        if charge > self.capacity:
+            return
+
+        with self.lock:
+            if generation != self.generation or key in self.rows:
+                return
+
+            self.rows[key] = value
+            self.usage += charge
+            self.shrink()
+
+    def erase(self, key):
+        ''' (self, str) -> None
+        Drops the cached value of key, for when it is written.
+        '''
+        with self.lock:
+            self.generation += 1
+            value = self.rows.pop(key, None)
+            if value is not None:
+                self.usage -= len(key) + len(value)
+
+    def set_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the number of bytes of keys and values the cache can hold, evicting
+        the least recently read keys past it.
+        '''
+        with self.lock:
+            self.capacity = capacity
+            self.shrink()
+
+    def hit_rate(self):
+        ''' (self) -> float
+        Returns the share of lookups the cache has answered, or 0 before any.
+        '''
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def shrink(self):
+        ''' (self) -> None
+        Evicts the least recently read keys until they fit in capacity. The lock
+        must be held.
+        '''
+        while self.usage > self.capacity:
+            key, value = self.rows.popitem(last=False)
+            self.usage -= len(key) + len(value)
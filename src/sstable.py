@@ -0,0 +1,459 @@
+from bisect import bisect_left, bisect_right
+from os import fsync as fsync_file
+from mmap import mmap, ACCESS_READ
+from sys import getsizeof
+import struct
+import zlib
+import lzma
+import bz2
+
+# A table is laid out as:
+#
+#   data blocks | index block | meta block | footer
+#
+# Each data block holds entries sorted by key. Keys are prefix compressed: an
+# entry stores the length of the prefix its key shares with the previous key, the
+# lengths of the rest of the key and of the value, then the rest of the UTF-8 key
+# and the value. Every restart_interval entries, a restart point stores its key
+# in full. The block ends with the offsets of its restart points and their count,
+# so it can be binary searched over them. A block is closed once it reaches the
+# table's block size, then compressed, and is stored followed by a byte naming
+# its compression.
+#
+# The index block holds, for each data block, its offset, its size and its last
+# key, and the meta block the number of entries and the first and last keys. The
+# fixed size footer locates both, and ends with the format version and a magic
+# number.
+ENTRY_HEADER = struct.Struct('<III')
+RESTART = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<QII')
+META_HEADER = struct.Struct('<QII')
+FOOTER = struct.Struct('<QIQII8s')
+
+# Segments written as CSV always end with a newline, the magic number never does
+MAGIC = b'\x89LSMSST\x1a'
+VERSION = 1
+
+# Block compressions, by the byte stored after each block
+COMPRESSIONS = ('none', 'zlib', 'lzma', 'bz2')
+
+# How many times a cached block is read before it is decoded whole
+DECODE_AFTER = 4
+
+def compress_block(data, compression, level=None):
+    ''' (bytes, str, int) -> bytes
+    Compresses data with compression at level, or the compressor's default level.
+    '''
+    if compression == 'zlib':
+        return zlib.compress(data, -1 if level is None else level)
+    if compression == 'lzma':
+        return lzma.compress(data, preset=level)
+    if compression == 'bz2':
+        return bz2.compress(data, 9 if level is None else level)
+
+    return data
+
+def decompress_block(data, compression):
+    ''' (bytes, str) -> bytes
+    Decompresses data compressed with compression.
+    '''
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    if compression == 'lzma':
+        return lzma.decompress(data)
+    if compression == 'bz2':
+        return bz2.decompress(data)
+
+    return data
+
+def decoded_size(entries):
+    ''' ({str: str}) -> int
+    Returns an estimate of the memory taken up by a decoded block: its dictionary
+    along with the key and value strings it holds.
+    '''
+    return getsizeof(entries) + sum(getsizeof(key) + getsizeof(value) for key, value in entries.items())
+
+def is_sstable(path):
+    ''' (str) -> bool
+    Returns whether the file at path is a table, rather than a CSV segment.
+    '''
+    with open(path, 'rb') as s:
+        s.seek(0, 2)
+        if s.tell() < FOOTER.size:
+            return False
+
+        s.seek(-len(MAGIC), 2)
+        return s.read() == MAGIC
+
+class SSTableWriter:
+    def __init__(self, path, block_size=4096, restart_interval=16, compression='none',
+            compression_level=None):
+        ''' (self, str, int, int, str, int) -> SSTableWriter
+        Creates a writer for a new table at path, whose data blocks are closed once
+        they hold block_size bytes, and which stores a key in full every
+        restart_interval keys. Blocks are compressed with compression, one of
+        COMPRESSIONS, at compression_level. Pairs must be added in key order.
+        '''
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression: ' + str(compression))
+
+        self.stream = open(path, 'wb')
+        self.block_size = block_size
+        self.restart_interval = restart_interval
+        self.compression = compression
+        self.compression_level = compression_level
+        self.block = bytearray()
+        self.block_last_key = None
+        self.restarts = []
+        self.restart_counter = 0
+        self.offset = 0
+        self.index = []
+        self.num_entries = 0
+        self.first_key = None
+        self.last_key = None
+
+    def add(self, key, value):
+        ''' (self, str, str) -> None
+        Adds a key value pair to the table, after every key added so far.
+        '''
+        encoded_key, encoded_value = key.encode(), value.encode()
+
+        shared = 0
+        if self.restart_counter == 0:
+            self.restarts.append(len(self.block))
+            self.restart_counter = self.restart_interval
+        else:
+            # Binary search the shared prefix length, comparing slices rather than
+            # single bytes
+            previous_key = self.block_last_key
+            high = min(len(previous_key), len(encoded_key))
+            while shared < high:
+                mid = (shared + high + 1) // 2
+                if previous_key[:mid] == encoded_key[:mid]:
+                    shared = mid
+                else:
+                    high = mid - 1
+        self.restart_counter -= 1
+
+        self.block += ENTRY_HEADER.pack(shared, len(encoded_key) - shared, len(encoded_value))
+        self.block += encoded_key[shared:]
+        self.block += encoded_value
+        self.block_last_key = encoded_key
+
+        if self.first_key is None:
+            self.first_key = encoded_key
+        self.last_key = encoded_key
+        self.num_entries += 1
+
+        if len(self.block) + RESTART.size * (len(self.restarts) + 1) >= self.block_size:
+            self.flush_block()
+
+    def size(self):
+        ''' (self) -> int
+        Returns the number of bytes of data added so far.
+        '''
+        return self.offset + len(self.block)
+
+    def flush_block(self):
+        ''' (self) -> None
+        Writes the current data block and records it in the index. Blocks that
+        don't shrink by at least an eighth when compressed are stored as they are.
+        '''
+        if not self.block:
+            return
+
+        for restart in self.restarts:
+            self.block += RESTART.pack(restart)
+        self.block += RESTART.pack(len(self.restarts))
+
+        compression, data = self.compression, self.block
+        if compression != 'none':
+            data = compress_block(self.block, compression, self.compression_level)
+            if len(data) > len(self.block) - len(self.block) // 8:
+                compression, data = 'none', self.block
+        data += bytes([COMPRESSIONS.index(compression)])
+
+        self.stream.write(data)
+        self.index.append((self.offset, len(data), self.block_last_key))
+        self.offset += len(data)
+        self.block = bytearray()
+        self.restarts = []
+        self.restart_counter = 0
+
+    def finish(self):
+        ''' (self) -> None
+        Writes the last data block, the index and meta blocks and the footer, then
+        forces the table to disk and closes it.
+        '''
+        self.flush_block()
+
+        index_block = bytearray()
+        for offset, size, last_key in self.index:
+            index_block += INDEX_ENTRY.pack(offset, size, len(last_key))
+            index_block += last_key
+
+        first_key, last_key = self.first_key or b'', self.last_key or b''
+        meta_block = META_HEADER.pack(self.num_entries, len(first_key), len(last_key))
+        meta_block += first_key + last_key
+
+        index_offset = self.offset
+        meta_offset = index_offset + len(index_block)
+        self.stream.write(index_block)
+        self.stream.write(meta_block)
+        self.stream.write(FOOTER.pack(
+            index_offset, len(index_block), meta_offset, len(meta_block), VERSION, MAGIC))
+
+        self.stream.flush()
+        fsync_file(self.stream.fileno())
+        self.stream.close()
+
+class SSTable:
+    def __init__(self, path):
+        ''' (self, str) -> SSTable
+        Opens the table stored at path, loading its index and meta blocks. Raises
+        a ValueError if the file isn't a table of a known version.
+
+        The file is memory mapped once, and every read is served from the mapping:
+        blocks that aren't compressed are searched in place, without being copied
+        or the file being opened again.
+        '''
+        self.path = path
+
+        with open(path, 'rb') as s:
+            self.data = mmap(s.fileno(), 0, access=ACCESS_READ)
+        data = self.data
+
+        index_offset, index_size, meta_offset, meta_size, version, magic = \
+            FOOTER.unpack_from(data, len(data) - FOOTER.size)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('Not an SSTable: ' + path)
+        if version != VERSION:
+            self.close()
+            raise ValueError('Unsupported SSTable version: ' + str(version))
+
+        # The index is kept as parallel lists, so it can be bisected by last key
+        self.block_offsets = []
+        self.block_sizes = []
+        self.block_last_keys = []
+        offset, index_end = index_offset, index_offset + index_size
+        while offset < index_end:
+            block_offset, block_size, key_length = INDEX_ENTRY.unpack_from(data, offset)
+            offset += INDEX_ENTRY.size
+            self.block_offsets.append(block_offset)
+            self.block_sizes.append(block_size)
+            self.block_last_keys.append(data[offset:offset + key_length].decode())
+            offset += key_length
+
+        self.num_entries, first_length, last_length = META_HEADER.unpack_from(data, meta_offset)
+        keys_start = meta_offset + META_HEADER.size
+        self.first_key = data[keys_start:keys_start + first_length].decode() \
+            if self.num_entries else None
+        self.last_key = data[keys_start + first_length:keys_start + first_length + last_length] \
+            .decode() if self.num_entries else None
+
+    def close(self):
+        ''' (self) -> None
+        Unmaps the table. It can't be read afterwards.
+        '''
+        self.data.close()
+
+    def get(self, key, block_cache=None):
+        ''' (self, str, BlockCache) -> str
+        Returns the value associated with key in the table, or None if it isn't in
+        it. The index gives the only block that can hold key, which is the only one
+        read.
+        '''
+        block = bisect_left(self.block_last_keys, key)
+        if block == len(self.block_last_keys):
+            return None
+
+        if block_cache is None:
+            data, start, end = self.block(block)
+            return self.search_block(data, start, end, key)
+
+        contents = self.cached_block(block, block_cache)
+        if isinstance(contents, dict):
+            return contents.get(key)
+        return self.search_block(*contents, key)
+
+    def multi_get(self, keys, block_cache=None):
+        ''' (self, [str], BlockCache) -> {str: str}
+        Returns the values of those of keys, which must be sorted, that are in the
+        table. Keys falling in the same block are looked up in it together, so each
+        block is read, and decompressed, at most once.
+        '''
+        found = {}
+        i, block = 0, 0
+        while i < len(keys):
+            block = bisect_left(self.block_last_keys, keys[i], block)
+            if block == len(self.block_last_keys):
+                break
+
+            # Every key up to the block's last key falls in it
+            j = bisect_right(keys, self.block_last_keys[block], i)
+            if block_cache is None:
+                contents = self.block(block)
+            else:
+                contents = self.cached_block(block, block_cache)
+
+            for key in keys[i:j]:
+                if isinstance(contents, dict):
+                    value = contents.get(key)
+                else:
+                    value = self.search_block(*contents, key)
+                if value is not None:
+                    found[key] = value
+            i = j
+
+        return found
+
+    def cached_block(self, block, block_cache):
+        ''' (self, int, BlockCache) -> dict or (bytes, int, int)
+        Reads the data block numbered block through block_cache. Returns either a
+        dictionary of its pairs, or the buffer holding it, decompressed, along with
+        the offsets at which it starts and ends in it.
+
+        A block is cached decompressed the first time it is read, so the next reads
+        skip decompression. Once it has been read DECODE_AFTER times, it is decoded
+        whole and cached as a dictionary of its pairs, which answers lookups without
+        searching the block at all. Decoding costs several searches, so blocks
+        evicted before they are read that often, as when the cache is too small for
+        the blocks being read, don't pay for it. A decoded block is charged the
+        memory its dictionary takes up, several times its size in bytes, and one
+        too large for the cache stays cached as bytes.
+        '''
+        cached = block_cache.get(self.path, block)
+        if cached is None:
+            data, start, end = self.block(block)
+            if data is self.data:
+                data = data[start:end]
+            block_cache.put(self.path, block, [data, 1], len(data))
+            return data, 0, len(data)
+
+        if isinstance(cached, dict):
+            return cached
+
+        # The block is cached along with the number of times it was read
+        data = cached[0]
+        cached[1] += 1
+        if cached[1] < DECODE_AFTER:
+            return data, 0, len(data)
+
+        entries = dict(self.block_entries(data, 0, len(data)))
+        charge = decoded_size(entries)
+        if charge > block_cache.capacity:
+            # Start counting again rather than decode it on every read
+            cached[1] = 0
+        else:
+            block_cache.put(self.path, block, entries, charge)
+        return entries
+
+    def block(self, block):
+        ''' (self, int) -> (bytes, int, int)
+        Returns the buffer holding the data block numbered block, decompressed,
+        along with the offsets at which the block starts and ends in it. Blocks
+        that aren't compressed are left in the mapping.
+        '''
+        start = self.block_offsets[block]
+        end = start + self.block_sizes[block]
+
+        # The last byte of the block names its compression
+        compression = COMPRESSIONS[self.data[end - 1]]
+        if compression == 'none':
+            return self.data, start, end - 1
+
+        with memoryview(self.data) as view:
+            data = decompress_block(view[start:end - 1], compression)
+        return data, 0, len(data)
+
+    def block_compression(self, block):
+        ''' (self, int) -> str
+        Returns the compression of the data block numbered block.
+        '''
+        return COMPRESSIONS[self.data[self.block_offsets[block] + self.block_sizes[block] - 1]]
+
+    def search_block(self, data, start, end, key):
+        ''' (self, bytes, int, int, str) -> str
+        Returns the value associated with key in the data block between start and
+        end in data, or None.
+
+        The restart points are binary searched for the last one whose key is at
+        most key, and only the entries from there to the next one are decoded.
+        '''
+        encoded_key = key.encode()
+        restarts, entries_end = self.block_restarts(data, start, end)
+        unpack = ENTRY_HEADER.unpack_from
+        header_size = ENTRY_HEADER.size
+
+        # Keys at restart points are stored in full. UTF-8 bytes sort like the
+        # strings they encode, so they are compared without being decoded.
+        low, high = 0, len(restarts) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            shared, unshared, value_length = unpack(data, restarts[mid])
+            key_start = restarts[mid] + header_size
+            if data[key_start:key_start + unshared] <= encoded_key:
+                low = mid
+            else:
+                high = mid - 1
+
+        offset = restarts[low]
+        run_end = restarts[low + 1] if low + 1 < len(restarts) else entries_end
+        k = b''
+        while offset < run_end:
+            shared, unshared, value_length = unpack(data, offset)
+            key_end = offset + header_size + unshared
+            k = k[:shared] + data[offset + header_size:key_end]
+            if k == encoded_key:
+                return data[key_end:key_end + value_length].decode()
+            if k > encoded_key:
+                return None
+            offset = key_end + value_length
+
+    def block_restarts(self, data, start, end):
+        ''' (self, bytes, int, int) -> ([int], int)
+        Returns the offsets in data of the restart points of the data block between
+        start and end, and the offset at which its entries end.
+        '''
+        num_restarts = RESTART.unpack_from(data, end - RESTART.size)[0]
+        entries_end = end - RESTART.size * (num_restarts + 1)
+        restarts = struct.unpack_from('<' + str(num_restarts) + 'I', data, entries_end)
+        return [start + restart for restart in restarts], entries_end
+
+    def items(self):
+        ''' (self) -> generator((str, str))
+        Yields the key value pairs stored in the table, in key order.
+        '''
+        for block in range(len(self.block_offsets)):
+            data, start, end = self.block(block)
+            # A scan reads every entry, so slicing a block out of the mapping once
+            # is cheaper than slicing each entry out of it
+            if data is self.data:
+                data, start, end = data[start:end], 0, end - start
+            yield from self.block_entries(data, start, end)
+
+    def keys(self):
+        ''' (self) -> generator(str)
+        Yields the keys stored in the table, in order.
+        '''
+        for key, value in self.items():
+            yield key
+
+    def block_entries(self, data, start, end):
+        ''' (self, bytes, int, int) -> generator((str, str))
+        Yields the key value pairs stored in the data block between start and end
+        in data, in order.
+        '''
+        restarts, entries_end = self.block_restarts(data, start, end)
+        unpack = ENTRY_HEADER.unpack_from
+        header_size = ENTRY_HEADER.size
+        offset = start
+        key = b''
+        while offset < entries_end:
+            shared, unshared, value_length = unpack(data, offset)
+            key_end = offset + header_size + unshared
+            key = key[:shared] + data[offset + header_size:key_end]
+            entry_end = key_end + value_length
+            yield key.decode(), data[key_end:entry_end].decode()
+            offset = entry_end
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from threading import Lock
+
+class TableCache():
+    def __init__(self, max_open_files=1000):
+        ''' (self, int) -> TableCache
+        Initializes an empty cache of open segment readers, keyed by segment name,
+        holding at most max_open_files of them.
+
+        Readers are kept in least recently used order. Once the cache is full, the
+        least recently used reader is evicted to make room for a new one. Evicted
+        readers aren't closed here: a reader still in use, by a compaction scanning
+        it for instance, stays open until its last user drops it, and its mapping
+        and file are closed then, when it is garbage collected.
+        '''
+        self.max_open_files = max_open_files
+        self.readers = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.readers)
+
+    def __contains__(self, segment_name):
+        return segment_name in self.readers
+
+    def get(self, segment_name):
+        ''' (self, str) -> object
+        Returns the reader of the segment represented by segment_name, marking it
+        as the most recently used, or None if it isn't cached.
+        '''
+        with self.lock:
+            reader = self.readers.get(segment_name)
+            if reader is not None:
+                self.readers.move_to_end(segment_name)
+
+            return reader
+
+    def put(self, segment_name, reader):
+        ''' (self, str, object) -> None
+        Caches reader as the reader of the segment represented by segment_name,
+        evicting the least recently used readers past max_open_files.
+        '''
+        with self.lock:
+            self.readers[segment_name] = reader
+            self.readers.move_to_end(segment_name)
+            self.shrink()
+
+    def evict(self, segment_name):
+        ''' (self, str) -> None
+        Removes the reader of the segment represented by segment_name from the cache
+        and closes it, for when its file is deleted.
+        '''
+        with self.lock:
+            reader = self.readers.pop(segment_name, None)
+
+        if reader is not None:
+            reader.close()
+
+    def set_max_open_files(self, max_open_files):
+        ''' (self, int) -> None
+        Sets the number of readers the cache can hold, evicting the least recently
+        used ones past it.
+        '''
+        with self.lock:
+            self.max_open_files = max_open_files
+            self.shrink()
+
+    def clear(self):
+        ''' (self) -> None
+        Closes and removes every reader in the cache.
+        '''
+        with self.lock:
+            readers = list(self.readers.values())
+            self.readers.clear()
+
+        for reader in readers:
+            reader.close()
+
+    def shrink(self):
+        ''' (self) -> None
+        Evicts the least recently used readers until at most max_open_files remain.
+        The lock must be held.
+        '''
+        while len(self.readers) > self.max_open_files:
+            self.readers.popitem(last=False)
@@ -1,22 +1,41 @@
 import unittest
-from os import remove
-from src.append_log import AppendLog
+import time
+import os
+from unittest.mock import patch
+from src.append_log import AppendLog, encode_record, read_records, read_legacy_records, OP_SET
 
 FILENAME = 'testfile'
 
 class AppendLogTests(unittest.TestCase):
     def tearDown(self):
-        AppendLog.instance(FILENAME).clear()
+        for log in self.logs:
+            log.clear()
+            log.close()
+
+        for filename in os.listdir('.'):
+            if filename.startswith(FILENAME):
+                os.remove(filename)
+
+    def setUp(self):
+        self.logs = []
+
+    def open_log(self, filename=FILENAME):
+        '''
+        Opens a log that is closed when the test ends.
+        '''
+        log = AppendLog(filename)
+        self.logs.append(log)
+        return log
 
     def test_write_writes_value_to_disk(self):
         '''
         Tests that a single value can be written to disk.
         '''
-        output = 'test,test string\n'
-        a = AppendLog.instance(FILENAME)
+        output = b'test,test string\n'
+        a = self.open_log()
         a.write(output)
 
-        with open(FILENAME, 'r') as s:
+        with open(FILENAME, 'rb') as s:
             input = s.readline()
         
         self.assertEqual(output, input)
@@ -25,13 +44,13 @@ class AppendLogTests(unittest.TestCase):
         '''
         Tests that mutliple values can be written to disk.
         '''
-        output1 = 'test,test string\n'
-        output2 = 'write,writer\n'
-        a = AppendLog.instance(FILENAME)
+        output1 = b'test,test string\n'
+        output2 = b'write,writer\n'
+        a = self.open_log()
         a.write(output1)
         a.write(output2)
 
-        with open(FILENAME, 'r') as s:
+        with open(FILENAME, 'rb') as s:
             input = s.readlines()
 
         self.assertEqual(output1, input[0])
@@ -41,25 +60,334 @@ class AppendLogTests(unittest.TestCase):
         '''
         Tests that the disk contents can be cleared.
         '''
-        a = AppendLog.instance(FILENAME)
-        a.write('test1,test2\n')
-        a.write('test3,test4\n')
-        a.write('test5,test6\n')
+        a = self.open_log()
+        a.write(b'test1,test2\n')
+        a.write(b'test3,test4\n')
+        a.write(b'test5,test6\n')
         a.clear()
 
-        with open(FILENAME, 'r') as s:
+        with open(FILENAME, 'rb') as s:
             input = s.readlines()
 
         self.assertTrue(len(input) == 0)
 
-    def test_singleton_returns_same_instance(self):
+    def test_logs_write_to_their_own_files(self):
+        '''
+        Tests that logs opened on different files don't share a stream.
+        '''
+        a = self.open_log()
+        b = self.open_log(FILENAME + '-2')
+        a.write(b'test1,test2\n')
+        b.write(b'test3,test4\n')
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n'])
+
+        with open(FILENAME + '-2', 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test3,test4\n'])
+
+    def test_close_commits_pending_values(self):
+        '''
+        Tests that closing a log writes the values waiting to be committed.
+        '''
+        a = AppendLog(FILENAME)
+        a.set_group_commit(100)
+        a.write(b'test1,test2\n')
+        a.close()
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n'])
+
+    def test_group_commit_writes_full_batches(self):
+        '''
+        Tests that with group commit, values reach disk once a batch is full.
+        '''
+        a = self.open_log()
+        a.set_group_commit(3)
+        a.write(b'test1,test2\n')
+        a.write(b'test3,test4\n')
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [])
+
+        a.write(b'test5,test6\n')
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n', b'test3,test4\n', b'test5,test6\n'])
+
+    def test_group_commit_writes_after_max_delay(self):
+        '''
+        Tests that with group commit, a partial batch reaches disk after the delay.
+        '''
+        a = self.open_log()
+        a.set_group_commit(100, max_delay=0.01)
+        a.write(b'test1,test2\n')
+
+        deadline = time.time() + 5
+        while a.pending and time.time() < deadline:
+            time.sleep(0.01)
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n'])
+
+    def test_clear_drops_pending_values(self):
+        '''
+        Tests that clearing the log empties it, values waiting to be committed
+        included.
+        '''
+        a = self.open_log()
+        a.set_group_commit(3)
+        a.write(b'test1,test2\n')
+        a.clear()
+        a.commit()
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [])
+
+    def test_sync_policy_none_leaves_values_buffered(self):
+        '''
+        Tests that with no sync, values stay in Python's buffer until a
+        write asks for a flush.
+        '''
+        a = self.open_log()
+        a.set_sync_policy('none')
+        a.write(b'test1,test2\n')
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [])
+
+        a.write(b'test3,test4\n', sync='flush')
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n', b'test3,test4\n'])
+
+    def test_sync_policy_fsync_fsyncs_each_commit(self):
+        '''
+        Tests that the fsync and fdatasync policies force every commit to disk.
+        '''
+        a = self.open_log()
+        for policy, function in [('fsync', 'fsync_file'), ('fdatasync', 'fdatasync_file')]:
+            a.set_sync_policy(policy)
+            with patch('src.append_log.' + function) as sync:
+                a.write(b'test1,test2\n')
+                a.write(b'test3,test4\n')
+
+            self.assertEqual(sync.call_count, 2)
+
+    def test_sync_policy_fsync_interval_limits_fsyncs(self):
+        '''
+        Tests that the interval policy fsyncs at most once per interval.
+        '''
+        a = self.open_log()
+        a.set_sync_policy('fsync_interval', interval=60)
+        with patch('src.append_log.fsync_file') as sync:
+            a.write(b'test1,test2\n')
+            a.write(b'test3,test4\n')
+            a.write(b'test5,test6\n')
+
+        self.assertLessEqual(sync.call_count, 1)
+        self.assertIsNotNone(a.sync_timer)
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(len(s.readlines()), 3)
+
+    def test_write_sync_overrides_sync_policy(self):
+        '''
+        Tests that a write can ask for a stronger sync than the log's, committing
+        every pending value along with it.
+        '''
+        a = self.open_log()
+        a.set_group_commit(100)
+        with patch('src.append_log.fsync_file') as sync:
+            a.write(b'test1,test2\n')
+            a.write(b'test3,test4\n', sync='fsync')
+
+        self.assertEqual(sync.call_count, 1)
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n', b'test3,test4\n'])
+
+    def test_set_sync_policy_rejects_unknown_policy(self):
+        '''
+        Tests that only known sync policies can be selected.
+        '''
+        a = self.open_log()
+        with self.assertRaises(ValueError):
+            a.set_sync_policy('sometimes')
+
+        self.assertEqual(a.sync_policy, 'flush')
+
+    def test_write_rejects_unknown_sync_policy(self):
+        '''
+        Tests that a write asking for an unknown sync policy fails without being
+        appended, so later commits don't write it.
+        '''
+        a = self.open_log()
+        with self.assertRaises(ValueError):
+            a.write(b'test1,test2\n', sync='sometimes')
+
+        a.write(b'test3,test4\n')
+        a.close()
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test3,test4\n'])
+
+    def test_read_records_reads_encoded_records(self):
+        '''
+        Tests that records survive encoding, including values holding
+        commas, newlines and non ASCII characters.
+        '''
+        a = self.open_log()
+        a.write(encode_record('chris', 'lessard'))
+        a.write(encode_record('comma', 'a,b\nc'))
+        a.write(encode_record('clé', 'valeur'))
+
+        records, size = read_records(FILENAME)
+
+        self.assertEqual(records, [
+            (OP_SET, 'chris', 'lessard'), (OP_SET, 'comma', 'a,b\nc'), (OP_SET, 'clé', 'valeur')])
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(size, len(s.read()))
+
+    def test_read_records_stops_at_torn_record(self):
+        '''
+        Tests that reading stops cleanly at a record cut short, or one whose
+        checksum doesn't match.
+        '''
+        a = self.open_log()
+        first = encode_record('chris', 'lessard')
+        a.write(first)
+        a.write(encode_record('daniel', 'lessard')[:-3])
+
+        self.assertEqual(read_records(FILENAME), ([(OP_SET, 'chris', 'lessard')], len(first)))
+
+        a.clear()
+        corrupt = bytearray(encode_record('daniel', 'lessard'))
+        corrupt[-1] ^= 1
+        a.write(first + bytes(corrupt))
+
+        self.assertEqual(read_records(FILENAME), ([(OP_SET, 'chris', 'lessard')], len(first)))
+
+    def test_read_legacy_records_reads_text_lines(self):
+        '''
+        Tests that a log of key,value lines, as written before logs held records,
+        is read up to its last complete line.
+        '''
+        with open(FILENAME, 'wb') as s:
+            s.write(b'chris,lessard\ndaniel,lessard\nsteve,torn')
+
+        records, size = read_legacy_records(FILENAME)
+
+        self.assertEqual(records, [(OP_SET, 'chris', 'lessard'), (OP_SET, 'daniel', 'lessard')])
+        self.assertEqual(size, len(b'chris,lessard\ndaniel,lessard\n'))
+
+    def test_recycled_log_writes_over_old_records(self):
+        '''
+        Tests that a recycled log writes from the start of the file, and that
+        reading it by log number stops at the records left from its last use.
+        '''
+        a = self.open_log()
+        a.write(encode_record('chris', 'lessard', log_number=1))
+        a.write(encode_record('green', 'green', log_number=1))
+        a.close()
+
+        b = AppendLog(FILENAME, recycle=True)
+        self.logs.append(b)
+        first = encode_record('daniel', 'lessar', log_number=2)
+        b.write(first)
+
+        self.assertEqual(read_records(FILENAME, 2), ([(OP_SET, 'daniel', 'lessar')], len(first)))
+        self.assertEqual(read_records(FILENAME)[0], [
+            (OP_SET, 'daniel', 'lessar'), (OP_SET, 'green', 'green')])
+
+    def test_write_handle_waits_for_group_commit(self):
+        '''
+        Tests that waiting on the handle of a value waiting in a group commits it.
+        '''
+        a = self.open_log()
+        a.set_group_commit(100)
+        handle = a.write(b'test1,test2\n')
+
+        self.assertFalse(handle.committed)
+        self.assertTrue(handle.wait())
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n'])
+
+    def test_async_writes_are_committed_by_writer_thread(self):
+        '''
+        Tests that with a writer thread, queued values are committed in order
+        and their handles released.
+        '''
+        a = self.open_log()
+        a.set_async(True)
+        handles = [a.write(('test' + str(i) + '\n').encode()) for i in range(1000)]
+
+        self.assertTrue(handles[-1].wait(timeout=5))
+        self.assertTrue(all(handle.committed for handle in handles))
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [('test' + str(i) + '\n').encode() for i in range(1000)])
+
+    def test_async_writes_use_most_durable_sync_policy(self):
+        '''
+        Tests that the writer thread honours a write asking for an fsync.
+        '''
+        a = self.open_log()
+        a.set_async(True)
+        with patch('src.append_log.fsync_file') as sync:
+            a.write(b'test1,test2\n')
+            a.write(b'test3,test4\n', sync='fsync').wait(timeout=5)
+
+        self.assertGreaterEqual(sync.call_count, 1)
+
+    def test_async_write_rejects_unknown_sync_policy(self):
+        '''
+        Tests that with a writer thread, a write asking for an unknown sync policy
+        fails before being queued, and later writes are still committed.
+        '''
+        a = self.open_log()
+        a.set_async(True)
+        with self.assertRaises(ValueError):
+            a.write(b'test1,test2\n', sync='sometimes')
+
+        self.assertTrue(a.write(b'test3,test4\n').wait(timeout=5))
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test3,test4\n'])
+
+    def test_writer_thread_survives_failed_commit(self):
+        '''
+        Tests that an exception committing queued values is raised to their
+        handles and to the next commit, and that the writer thread keeps
+        committing later values.
+        '''
+        a = self.open_log()
+        a.set_async(True)
+        with patch.object(a, 'write_through', side_effect=OSError('disk full')):
+            handle = a.write(b'test1,test2\n')
+            with self.assertRaises(OSError):
+                handle.wait(timeout=5)
+
+        self.assertFalse(handle.committed)
+        with self.assertRaises(OSError):
+            a.commit()
+
+        self.assertTrue(a.write(b'test3,test4\n').wait(timeout=5))
+        a.commit()
+
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test3,test4\n'])
+
+    def test_set_async_off_commits_queued_values(self):
         '''
-        Tests that each instance is identitcal.
+        Tests that stopping the writer thread commits everything queued.
         '''
-        a = AppendLog.instance(FILENAME)
-        b = AppendLog.instance(FILENAME)
-        c = AppendLog.instance(FILENAME)
+        a = self.open_log()
+        a.set_async(True)
+        handle = a.write(b'test1,test2\n')
+        a.set_async(False)
 
-        self.assertEqual(id(a), id(b))
-        self.assertEqual(id(a), id(c))
-        self.assertEqual(id(b), id(c))
+        self.assertTrue(handle.committed)
+        self.assertIsNone(a.writer)
+        with open(FILENAME, 'rb') as s:
+            self.assertEqual(s.readlines(), [b'test1,test2\n'])
@@ -0,0 +1,91 @@
+import unittest
+from src.block_cache import BlockCache
+
+class BlockCacheTests(unittest.TestCase):
+    def test_get_counts_hits_and_misses(self):
+        '''
+        Tests that cached blocks are found by table and block number, and that
+        every lookup is counted as a hit or a miss.
+        '''
+        cache = BlockCache(100)
+        cache.put('table1', 0, b'block', 10)
+
+        self.assertEqual(cache.get('table1', 0), b'block')
+        self.assertIsNone(cache.get('table1', 1))
+        self.assertIsNone(cache.get('table2', 0))
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+        self.assertAlmostEqual(cache.hit_rate(), 1 / 3)
+
+    def test_put_evicts_least_recently_used_past_capacity(self):
+        '''
+        Tests that the cache holds at most capacity bytes of blocks, evicting the
+        ones read the longest ago.
+        '''
+        cache = BlockCache(100)
+        cache.put('table1', 0, 'a', 40)
+        cache.put('table1', 1, 'b', 40)
+        cache.get('table1', 0)
+        cache.put('table2', 0, 'c', 40)
+
+        self.assertEqual(cache.usage, 80)
+        self.assertIsNone(cache.get('table1', 1))
+        self.assertEqual(cache.get('table1', 0), 'a')
+        self.assertEqual(cache.get('table2', 0), 'c')
+
+    def test_put_replaces_block(self):
+        '''
+        Tests that caching a block again replaces it, and its charge.
+        '''
+        cache = BlockCache(100)
+        cache.put('table1', 0, 'a', 40)
+        cache.put('table1', 0, 'b', 60)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.usage, 60)
+        self.assertEqual(cache.get('table1', 0), 'b')
+
+    def test_put_skips_blocks_larger_than_cache(self):
+        '''
+        Tests that a block larger than the whole cache doesn't evict everything else.
+        '''
+        cache = BlockCache(100)
+        cache.put('table1', 0, 'a', 40)
+        cache.put('table1', 1, 'b', 200)
+
+        self.assertEqual(cache.get('table1', 0), 'a')
+        self.assertIsNone(cache.get('table1', 1))
+
+    def test_erase_file_drops_its_blocks(self):
+        '''
+        Tests that erasing a table drops all of its blocks, and only those.
+        '''
+        cache = BlockCache(100)
+        cache.put('table1', 0, 'a', 10)
+        cache.put('table1', 1, 'b', 10)
+        cache.put('table2', 0, 'c', 10)
+
+        cache.erase_file('table1')
+        cache.erase_file('table3')
+
+        self.assertEqual(cache.usage, 10)
+        self.assertIsNone(cache.get('table1', 0))
+        self.assertEqual(cache.get('table2', 0), 'c')
+
+    def test_set_capacity_shrinks_cache(self):
+        '''
+        Tests that lowering the capacity evicts the least recently used blocks.
+        '''
+        cache = BlockCache(100)
+        for block in range(5):
+            cache.put('table1', block, block, 20)
+
+        cache.set_capacity(40)
+
+        self.assertEqual(cache.usage, 40)
+        self.assertEqual(list(cache.blocks), [('table1', 3), ('table1', 4)])
+        self.assertEqual(cache.files, {'table1': {3, 4}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
-from src.bloom_filter import BloomFilter
+import pickle
+from src.bloom_filter import BloomFilter, BlockedBloomFilter, ScalableBloomFilter
 
 class BloomFilterTests(unittest.TestCase):
     def test_add_item_one_item(self):
@@ -140,3 +141,254 @@ class BloomFilterTests(unittest.TestCase):
         prob = 0.02
         bf = BloomFilter(num_items, prob)
         self.assertEqual(bf.bit_array_size, 81423)
+
+class ScalableBloomFilterTests(unittest.TestCase):
+    def test_add_item_multiple_items(self):
+        '''
+        Tests that multiple items can be added to the Scalable Bloom Filter.
+        '''
+        bf = ScalableBloomFilter(4, 0.05)
+        bf.add('christian')
+        bf.add('daniel')
+        bf.add('debra')
+        bf.add('charles-adrian')
+
+        self.assertTrue(bf.check('christian'))
+        self.assertTrue(bf.check('daniel'))
+        self.assertTrue(bf.check('debra'))
+        self.assertTrue(bf.check('charles-adrian'))
+        self.assertEqual(len(bf.filters), 1)
+
+    def test_add_past_capacity_stacks_new_filters(self):
+        '''
+        Tests that adding more items than the initial capacity stacks new,
+        larger and stricter filters.
+        '''
+        bf = ScalableBloomFilter(10, 0.1)
+        for i in range(100):
+            bf.add(str(i))
+
+        self.assertEqual(len(bf.filters), 4)
+        self.assertEqual(bf.capacity, 80)
+        for lower, upper in zip(bf.filters, bf.filters[1:]):
+            self.assertGreater(upper.bit_array_size, lower.bit_array_size)
+            self.assertLess(upper.false_positive_prob, lower.false_positive_prob)
+
+        for i in range(100):
+            self.assertTrue(bf.check(str(i)))
+
+    def test_add_ignores_duplicates(self):
+        '''
+        Tests that adding the same item repeatedly doesn't use up capacity.
+        '''
+        bf = ScalableBloomFilter(2, 0.1)
+        for i in range(10):
+            bf.add('christian')
+
+        self.assertEqual(bf.count, 1)
+        self.assertEqual(len(bf.filters), 1)
+
+    def test_false_positive_rate_holds_past_initial_capacity(self):
+        '''
+        Tests that the false positive rate stays under the configured probability
+        when storing far more items than the initial capacity.
+        '''
+        bf = ScalableBloomFilter(100, 0.05)
+        for i in range(10000):
+            bf.add('present' + str(i))
+
+        false_positives = sum(bf.check('absent' + str(i)) for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.05)
+
+class DoubleHashingBloomFilterTests(unittest.TestCase):
+    def test_add_item_multiple_items(self):
+        '''
+        Tests that multiple items can be added to a double hashing Bloom Filter.
+        '''
+        bf = BloomFilter(4, 0.05, double_hashing=True)
+        bf.add('christian')
+        bf.add('daniel')
+        bf.add('debra')
+        bf.add('charles-adrian')
+
+        self.assertTrue(bf.check('christian'))
+        self.assertTrue(bf.check('daniel'))
+        self.assertTrue(bf.check('debra'))
+        self.assertTrue(bf.check('charles-adrian'))
+
+    def test_add_sets_one_bit_per_hash_function(self):
+        '''
+        Tests that adding a single item sets, at most, as many bits as there
+        are hash functions.
+        '''
+        bf = BloomFilter(1000, 0.001, double_hashing=True)
+        bf.add('christian')
+
+        self.assertGreater(bf.bit_array.count(1), 1)
+        self.assertLessEqual(bf.bit_array.count(1), bf.num_hash_fns)
+
+    def test_small_filters_spread_bits_of_every_item(self):
+        '''
+        Tests that in a filter of a few bits, the step between the bit positions
+        of an item is never 0, which would set a single bit per item.
+        '''
+        bf = BloomFilter(2, 0.05, double_hashing=True)
+        for i in range(1000):
+            digest, step = bf.double_hash('item' + str(i))
+            self.assertNotEqual(step % bf.bit_array_size, 0)
+
+        bf.add_many(['christian'])
+        self.assertGreater(bf.bit_array.count(1), 1)
+
+    def test_false_positive_rate_matches_seeded_hashing(self):
+        '''
+        Tests that the false positive rate of double hashing stays close to
+        the configured probability.
+        '''
+        bf = BloomFilter(10000, 0.05, double_hashing=True)
+        for i in range(10000):
+            bf.add('present' + str(i))
+
+        false_positives = sum(bf.check('absent' + str(i)) for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.07)
+
+    def test_filters_pickled_before_double_hashing_hash_with_seeds(self):
+        '''
+        Tests that filters pickled before double hashing was added, which lack
+        the setting, can still be used once unpickled.
+        '''
+        for bf in [BloomFilter(100, 0.05), ScalableBloomFilter(100, 0.05)]:
+            bf.add('christian')
+            del bf.double_hashing
+            bf = pickle.loads(pickle.dumps(bf))
+
+            self.assertTrue(bf.check('christian'))
+            bf.add('daniel')
+            self.assertTrue(bf.check('daniel'))
+            self.assertEqual(bf.check_many(['christian', 'daniel']), [True, True])
+
+    def test_scalable_filters_pickled_before_blocked_layout_stack_plain_filters(self):
+        '''
+        Tests that scalable filters pickled before the blocked layout was added,
+        which lack the setting, can still grow once unpickled.
+        '''
+        bf = ScalableBloomFilter(10, 0.05)
+        del bf.blocked
+        bf = pickle.loads(pickle.dumps(bf))
+
+        for i in range(100):
+            bf.add('present' + str(i))
+
+        self.assertGreater(len(bf.filters), 1)
+        self.assertNotIsInstance(bf.filters[-1], BlockedBloomFilter)
+        self.assertTrue(all(bf.check('present' + str(i)) for i in range(100)))
+
+class BlockedBloomFilterTests(unittest.TestCase):
+    def test_add_item_multiple_items(self):
+        '''
+        Tests that multiple items can be added to the Blocked Bloom Filter.
+        '''
+        bf = BlockedBloomFilter(4, 0.05)
+        bf.add('christian')
+        bf.add('daniel')
+        bf.add('debra')
+        bf.add('charles-adrian')
+
+        self.assertTrue(bf.check('christian'))
+        self.assertTrue(bf.check('daniel'))
+        self.assertTrue(bf.check('debra'))
+        self.assertTrue(bf.check('charles-adrian'))
+
+    def test_bit_array_size_is_rounded_up_to_whole_blocks(self):
+        '''
+        Tests that the bit array is made of whole blocks.
+        '''
+        bf = BlockedBloomFilter(1000, 0.25)
+        self.assertEqual(bf.num_blocks, 6)
+        self.assertEqual(bf.bit_array_size, 3072)
+        self.assertEqual(len(bf.bit_array), 3072)
+
+        bf = BlockedBloomFilter(1, 0.05)
+        self.assertEqual(bf.num_blocks, 1)
+
+    def test_add_sets_bits_in_a_single_block(self):
+        '''
+        Tests that all the bits of an item are set within the same block.
+        '''
+        bf = BlockedBloomFilter(10000, 0.01)
+        bf.add('christian')
+
+        positions = [i for i, bit in enumerate(bf.bit_array) if bit]
+        blocks = set(position // bf.BLOCK_BITS for position in positions)
+
+        self.assertEqual(len(positions), bf.num_hash_fns)
+        self.assertEqual(len(blocks), 1)
+
+    def test_false_positive_rate_stays_close_to_probability(self):
+        '''
+        Tests that the false positive rate stays close to the configured
+        probability.
+        '''
+        bf = BlockedBloomFilter(10000, 0.05)
+        for i in range(10000):
+            bf.add('present' + str(i))
+
+        false_positives = sum(bf.check('absent' + str(i)) for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.07)
+
+class BatchedBloomFilterTests(unittest.TestCase):
+    def filters(self):
+        return [
+            BloomFilter(1000, 0.05),
+            BloomFilter(1000, 0.05, double_hashing=True),
+            BlockedBloomFilter(1000, 0.05),
+            ScalableBloomFilter(100, 0.05),
+        ]
+
+    def test_add_many_matches_add(self):
+        '''
+        Tests that adding items in bulk sets the same bits as adding them
+        one by one.
+        '''
+        items = ['item' + str(i) for i in range(1000)]
+        for bf, expected in zip(self.filters(), self.filters()[:3]):
+            bf.add_many(items)
+            for item in items:
+                expected.add(item)
+
+            self.assertEqual(bf.bit_array, expected.bit_array)
+
+    def test_add_many_then_check_finds_every_item(self):
+        '''
+        Tests that every item added in bulk can be checked, including when a
+        scalable filter has to grow in the middle of a batch.
+        '''
+        items = ['item' + str(i) for i in range(1000)]
+        for bf in self.filters():
+            bf.add_many(items)
+            for item in items:
+                self.assertTrue(bf.check(item))
+
+    def test_check_many_matches_check(self):
+        '''
+        Tests that checking items in bulk gives the same results, in the same
+        order, as checking them one by one.
+        '''
+        items = ['item' + str(i) for i in range(1000)]
+        checked = ['item' + str(i) for i in range(0, 2000, 3)]
+        for bf in self.filters():
+            bf.add_many(items)
+            self.assertEqual(bf.check_many(checked), [bf.check(item) for item in checked])
+            self.assertEqual(bf.check_many([]), [])
+
+    def test_scalable_add_many_ignores_duplicates(self):
+        '''
+        Tests that duplicates within and across batches don't use up the
+        capacity of a scalable filter.
+        '''
+        bf = ScalableBloomFilter(10, 0.05)
+        bf.add_many(['christian'] * 20)
+        bf.add_many(['christian', 'daniel'])
+
+        self.assertEqual(bf.count, 2)
+        self.assertEqual(len(bf.filters), 1)
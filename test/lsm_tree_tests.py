@@ -1,9 +1,16 @@
 import unittest
 import os
+import shutil
 import pickle
+import weakref
+from unittest.mock import patch
 from pathlib import Path
 from src.lsm_tree import LSMTree
 from src.red_black_tree import RedBlackTree
+from src.append_log import encode_record, read_records, OP_SET
+from src.sstable import is_sstable
+from src.block_cache import BlockCache
+from src.bloom_filter import BloomFilter, BlockedBloomFilter, ScalableBloomFilter
 
 TEST_FILENAME = 'test_file-1'
 TEST_BASEPATH = 'test-segments/'
@@ -64,19 +71,13 @@ class TestDatabase(unittest.TestCase):
         '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
 
-        # The singleton instance will persist throughout the suite.
-        # We need to clear the instance explicitely in order to make sure that values from old tests don't persist.
-        db.memtable_wal().clear()
-        open(TEST_BASEPATH + BKUP_NAME, 'w').close()
-
         db.db_set('chris', 'lessard')
         db.db_set('daniel', 'lessard')
 
-        self.assertEqual(Path(TEST_BASEPATH + BKUP_NAME).exists(), True)
-        with open(TEST_BASEPATH + BKUP_NAME, 'r') as s:
-            lines = s.readlines()
+        self.assertEqual(Path(TEST_BASEPATH + BKUP_NAME + '-1').exists(), True)
+        records, size = read_records(TEST_BASEPATH + BKUP_NAME + '-1')
 
-        self.assertEqual(len(lines), 2)
+        self.assertEqual(records, [(OP_SET, 'chris', 'lessard'), (OP_SET, 'daniel', 'lessard')])
 
     def test_db_set_key_update_does_not_increment_memtable_total_bytes(self):
         '''
@@ -116,6 +117,39 @@ class TestDatabase(unittest.TestCase):
         expected_lines = ['chris,lessard\n', 'daniel,lessard\n']
         self.assertEqual(lines, expected_lines)
 
+    def test_flush_memtable_to_disk_saves_bloom_filter_next_to_segment(self):
+        '''
+        Tests that flushing the memtable builds a bloom filter for the new segment
+        and saves it next to the segment.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable.add('chris', 'lessard')
+        db.memtable.add('daniel', 'lessard')
+        db.flush_memtable_to_disk(TESTPATH)
+
+        self.assertTrue(Path(db.bloom_filter_path(TESTPATH)).exists())
+
+        db.bloom_filters = {}
+        bloom_filter = db.segment_bloom_filter(TEST_FILENAME)
+        self.assertTrue(bloom_filter.check('chris'))
+        self.assertTrue(bloom_filter.check('daniel'))
+
+    def test_segment_bloom_filter_builds_missing_filter_from_segment(self):
+        '''
+        Tests that a segment without a saved bloom filter gets one built from
+        its contents.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        with open(TESTPATH, 'w') as s:
+            s.write('blue,2\n')
+            s.write('red,1\n')
+
+        bloom_filter = db.segment_bloom_filter(TEST_FILENAME)
+
+        self.assertTrue(bloom_filter.check('blue'))
+        self.assertTrue(bloom_filter.check('red'))
+        self.assertTrue(Path(db.bloom_filter_path(TESTPATH)).exists())
+
     # db_get
     def test_db_get_does_single_val_retrieval(self):
         '''
@@ -260,13 +294,56 @@ class TestDatabase(unittest.TestCase):
         
         self.assertEqual(db.search_segment('steve', TEST_FILENAME), None)
 
+    def test_search_segment_finds_every_key_in_sorted_segment(self):
+        '''
+        Tests that the on-disk binary search finds every key in a segment,
+        regardless of line lengths, and misses keys that aren't stored.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        pairs = [(str(k).zfill(k % 7 + 3), 'v' * (k % 5 + 1)) for k in range(200)]
+        pairs.sort()
+
+        with open(TEST_BASEPATH + TEST_FILENAME, 'w') as s:
+            for key, val in pairs:
+                s.write(key + ',' + val + '\n')
+
+        for key, val in pairs:
+            self.assertEqual(db.search_segment(key, TEST_FILENAME), val)
+
+        self.assertEqual(db.search_segment('', TEST_FILENAME), None)
+        self.assertEqual(db.search_segment('0000000000a', TEST_FILENAME), None)
+        self.assertEqual(db.search_segment('zzz', TEST_FILENAME), None)
+
+    def test_search_segment_searches_within_byte_range(self):
+        '''
+        Tests that the binary search can be limited to the lines between two byte
+        offsets, missing keys stored outside of them.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        lines = [str(k).zfill(3) + ',' + 'v' * (k % 5 + 1) + '\n' for k in range(100)]
+
+        with open(TEST_BASEPATH + TEST_FILENAME, 'w') as s:
+            s.write(''.join(lines))
+
+        low = sum(len(line) for line in lines[:40])
+        high = low + sum(len(line) for line in lines[40:60])
+        for k in range(100):
+            value = db.search_segment(str(k).zfill(3), TEST_FILENAME, low, high)
+            self.assertEqual(value, 'v' * (k % 5 + 1) if 40 <= k < 60 else None)
+
+    def test_search_segment_handles_empty_segment(self):
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        open(TEST_BASEPATH + TEST_FILENAME, 'w').close()
+
+        self.assertEqual(db.search_segment('chris', TEST_FILENAME), None)
+
     # Merging algorithm
-    def test_merge_merges_two_segments(self):
+    def test_merge_segments_merges_segments(self):
         '''
-        Tests that the merge algorithm merges two segments on disk,
+        Tests that the merge algorithm merges segments on disk,
         respecting the order of keys and drops redundancies.
         '''
-        segments = ['test_file-1', 'test_file-2']
+        segments = ['test_file-1', 'test_file-2', 'test_file-3']
         with open(TEST_BASEPATH + segments[0], 'w') as s:
             s.write('1,test1\n')
             s.write('2,test2\n')
@@ -277,19 +354,15 @@ class TestDatabase(unittest.TestCase):
             s.write('2,test6\n')
             s.write('3,test5\n')
 
-        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.segments = segments
+        with open(TEST_BASEPATH + segments[2], 'w') as s:
+            s.write('2,test7\n')
 
-        db.merge(segments[0], segments[1])
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
 
-        with open(TEST_BASEPATH + 'test_file-1', 'r') as s:
-            segment_lines = s.readlines()
-        
-        expected_contents = ['1,test5\n', '2,test6\n', '3,test5\n', '4,test6\n']
-        self.assertEqual(segment_lines, expected_contents)
+        merged = list(db.merge_segments(segments))
 
-        # Check that the second file was deleted
-        self.assertEqual(os.path.exists(TEST_BASEPATH + segments[1]), False)
+        expected_contents = [('1', 'test5'), ('2', 'test7'), ('3', 'test5'), ('4', 'test6')]
+        self.assertEqual(merged, expected_contents)
 
     def test_set_threshold_sets_thresholds(self):
         '''
@@ -322,7 +395,7 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(metadata['segments'], segments)
         self.assertEqual(metadata['bf_false_pos'], 0.5)
         self.assertEqual(metadata['bf_num_items'], 100)
-        self.assertIsNotNone(metadata['index'])
+        self.assertNotIn('index', metadata)
 
     def test_load_metadata_loads_segments_at_init_time(self):
         '''
@@ -337,7 +410,6 @@ class TestDatabase(unittest.TestCase):
         db.db_set('daniel', 'lessard')
         db.bf_false_pos_prob = 0.5
         db.bf_num_items = 100
-        db.index.add('john', offset=5, segment='segment-1')
         db.save_metadata() # pickle will be saved
         del db
 
@@ -348,7 +420,153 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(db.current_segment, segments[-1])
         self.assertEqual(db.bf_false_pos_prob, 0.5)
         self.assertEqual(db.bf_num_items, 100)
-        self.assertTrue(db.index.contains('john'))
+
+    def test_flush_leaves_bloom_filter_out_of_metadata(self):
+        '''
+        Tests that the metadata written on flush doesn't hold the bloom filter,
+        which is rebuilt on restart if segments changed since it was saved, and
+        loaded as saved otherwise.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        for i in range(20):
+            db.db_set('key' + str(i), 'value' + str(i))
+
+        with open(db.metadata_path(), 'rb') as s:
+            self.assertNotIn('bloom_filter', pickle.load(s))
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual([db.db_get('key' + str(i)) for i in range(20)], ['value' + str(i) for i in range(20)])
+        db.close()
+
+        with patch.object(LSMTree, 'rebuild_bloom_filter') as rebuild:
+            db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        rebuild.assert_not_called()
+        self.assertEqual([db.db_get('key' + str(i)) for i in range(20)], ['value' + str(i) for i in range(20)])
+
+    def test_set_bloom_filter_scalable_switches_bloom_filter_mode(self):
+        '''
+        Tests that the database's bloom filter is scalable by default, that it
+        can be switched back to a fixed size one, and that the mode survives
+        a restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertIsInstance(db.bloom_filter, ScalableBloomFilter)
+
+        db.set_bloom_filter_scalable(False)
+        self.assertIsInstance(db.bloom_filter, BloomFilter)
+        db.save_metadata()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertFalse(db.bf_scalable)
+        self.assertIsInstance(db.bloom_filter, BloomFilter)
+
+    def test_set_bloom_filter_scalable_keeps_keys_on_disk(self):
+        '''
+        Tests that switching the bloom filter mode keeps the keys already on disk
+        readable, before and after a restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        for i in range(20):
+            db.db_set('key' + str(i), 'value' + str(i))
+
+        db.set_bloom_filter_scalable(False)
+        self.assertEqual(db.db_get('key0'), 'value0')
+        db.save_metadata()
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual([db.db_get('key' + str(i)) for i in range(20)], ['value' + str(i) for i in range(20)])
+
+    def test_set_bloom_filter_size_keeps_keys_on_disk(self):
+        '''
+        Tests that changing the expected number of items or the false positive
+        probability keeps the keys already on disk readable, before and after a
+        restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        for i in range(20):
+            db.db_set('key' + str(i), 'value' + str(i))
+
+        db.set_bloom_filter_num_items(50)
+        self.assertEqual(db.db_get('key0'), 'value0')
+        db.set_bloom_filter_false_pos_prob(0.01)
+        self.assertEqual(db.db_get('key1'), 'value1')
+        db.save_metadata()
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual([db.db_get('key' + str(i)) for i in range(20)], ['value' + str(i) for i in range(20)])
+
+    def test_set_bloom_filter_double_hashing_applies_to_segment_filters(self):
+        '''
+        Tests that enabling double hashing applies to the database's bloom filter
+        and to the bloom filters of segments flushed afterwards.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_bloom_filter_double_hashing(True)
+        self.assertTrue(db.bloom_filter.double_hashing)
+
+        db.memtable.add('chris', 'lessard')
+        db.flush_memtable_to_disk(TESTPATH)
+
+        bloom_filter = db.segment_bloom_filter(TEST_FILENAME)
+        self.assertTrue(bloom_filter.double_hashing)
+        self.assertTrue(bloom_filter.check('chris'))
+        self.assertEqual(db.db_get('chris'), 'lessard')
+
+    def test_set_bloom_filter_double_hashing_keeps_keys_on_disk(self):
+        '''
+        Tests that switching double hashing on keeps the keys already on disk
+        readable, before and after a restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        for i in range(20):
+            db.db_set('key' + str(i), 'value' + str(i))
+
+        db.set_bloom_filter_double_hashing(True)
+        self.assertEqual(db.db_get('key0'), 'value0')
+        db.save_metadata()
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual([db.db_get('key' + str(i)) for i in range(20)], ['value' + str(i) for i in range(20)])
+
+    def test_set_bloom_filter_blocked_applies_to_segment_filters(self):
+        '''
+        Tests that enabling the blocked layout applies to the database's bloom
+        filter and to the bloom filters of segments flushed afterwards.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_bloom_filter_blocked(True)
+        self.assertIsInstance(db.bloom_filter.filters[0], BlockedBloomFilter)
+
+        db.memtable.add('chris', 'lessard')
+        db.flush_memtable_to_disk(TESTPATH)
+
+        db.bloom_filters = {}
+        bloom_filter = db.segment_bloom_filter(TEST_FILENAME)
+        self.assertIsInstance(bloom_filter, BlockedBloomFilter)
+        self.assertTrue(bloom_filter.check('chris'))
+        self.assertEqual(db.db_get('chris'), 'lessard')
+
+    def test_set_bloom_filter_blocked_keeps_keys_on_disk(self):
+        '''
+        Tests that switching to the blocked layout keeps the keys already on disk
+        readable, before and after a restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        for i in range(20):
+            db.db_set('key' + str(i), 'value' + str(i))
+
+        db.set_bloom_filter_blocked(True)
+        self.assertEqual(db.db_get('key0'), 'value0')
+        db.save_metadata()
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual([db.db_get('key' + str(i)) for i in range(20)], ['value' + str(i) for i in range(20)])
 
     def test_restore_memtable_loads_memtable_from_wal(self):
         '''
@@ -356,9 +574,6 @@ class TestDatabase(unittest.TestCase):
         '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
 
-        # The singleton instance will persist throughout the suite.
-        # We need to clear the instance explicitely in order to make sure that values from old tests don't persist.
-        db.memtable_wal().clear()
         db.db_set('sad', 'mad')
         db.db_set('pad', 'tad')
 
@@ -378,18 +593,14 @@ class TestDatabase(unittest.TestCase):
         '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
 
-        # The singleton instance will persist throughout the suite.
-        # We need to clear the instance explicitely in order to make sure that values from old tests don't persist.
-        db.memtable_wal().clear()
         db.db_set('chris', 'lessard')
         db.db_set('chris', 'hemsworth')
 
-        with open(db.memtable_wal_path(), 'r') as s:
-            lines = s.readlines()
-        
-        self.assertEqual(len(lines), 2)
-        self.assertEqual(lines[0], 'chris,lessard\n')
-        self.assertEqual(lines[1], 'chris,hemsworth\n')
+        records, size = read_records(db.memtable_wal_path())
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0], (OP_SET, 'chris', 'lessard'))
+        self.assertEqual(records[1], (OP_SET, 'chris', 'hemsworth'))
 
         del db
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
@@ -402,13 +613,198 @@ class TestDatabase(unittest.TestCase):
         self.assertTrue(db.memtable.contains('chris'), True)
         self.assertEqual(db.db_get('chris'), 'hemsworth')
 
+    def test_restore_memtable_keeps_last_value_of_each_key(self):
+        '''
+        Tests that replaying a write-ahead-log full of overwrites keeps the last
+        value of each key, and only counts those towards the memtable's size.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        for i in range(100):
+            db.db_set('key' + str(i % 10), str(i))
+        db.close()
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertEqual(
+            [(node.key, node.value) for node in db.memtable.in_order()],
+            [('key' + str(i), str(90 + i)) for i in range(10)])
+        self.assertEqual(db.memtable.total_bytes, 10 * len('key0' + '90'))
+
+        db.db_set('key10', 'new')
+        self.assertEqual(db.db_get('key10'), 'new')
+        self.assertEqual(db.db_get('key3'), '93')
+
+    def test_restore_memtable_truncates_torn_record(self):
+        '''
+        Tests that a record torn by a crash is dropped from the write-ahead-log
+        instead of failing the restore.
+        '''
+        with open(TEST_BASEPATH + BKUP_NAME + '-1', 'wb') as s:
+            s.write(encode_record('sad', 'mad', log_number=1))
+            s.write(encode_record('pad', 'ta,d\n', log_number=1))
+            s.write(encode_record('bad', 'torn', log_number=1)[:-2])
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertEqual(db.db_get('sad'), 'mad')
+        self.assertEqual(db.db_get('pad'), 'ta,d\n')
+        self.assertEqual(db.db_get('bad'), None)
+        self.assertEqual(
+            db.get_file_size(TEST_BASEPATH + BKUP_NAME + '-1'),
+            len(encode_record('sad', 'mad', log_number=1) +
+                encode_record('pad', 'ta,d\n', log_number=1)))
+
+    def test_restore_memtable_keeps_unreadable_log(self):
+        '''
+        Tests that a write-ahead-log none of whose records can be read is left as
+        it is, and new writes go to a new log.
+        '''
+        with open(TEST_BASEPATH + BKUP_NAME + '-1', 'wb') as s:
+            s.write(b'sad,mad\n')
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('pad', 'tad')
+
+        self.assertEqual(db.get_file_size(TEST_BASEPATH + BKUP_NAME + '-1'), len(b'sad,mad\n'))
+        self.assertEqual(db.memtable_wal_path(), TEST_BASEPATH + BKUP_NAME + '-2')
+
+    def test_restore_memtable_replays_legacy_log(self):
+        '''
+        Tests that a write-ahead-log of text lines, written before logs held
+        binary records, is replayed and moved into a numbered log, which outlives
+        a flush and a restart.
+        '''
+        with open(TEST_BASEPATH + BKUP_NAME, 'w') as s:
+            s.write(''.join('k' + str(i) + ',old\n' for i in range(50, 60)))
+            s.write('k55,new\nk60,new\n')
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertFalse(Path(TEST_BASEPATH + BKUP_NAME).exists())
+        self.assertEqual(db.db_get('k50'), 'old')
+        self.assertEqual(db.db_get('k55'), 'new')
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.db_get('k59'), 'old')
+        self.assertEqual(db.db_get('k60'), 'new')
+
+        db.flush_memtable_to_disk(db.current_segment_path())
+        db.save_metadata()
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertEqual([db.db_get('k' + str(i)) for i in range(50, 53)], ['old'] * 3)
+        self.assertEqual(db.db_get('k55'), 'new')
+
+    def test_save_metadata_commits_wal_group(self):
+        '''
+        Tests that writes waiting in a write ahead log group commit reach disk
+        when the database is saved.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_wal_group_commit(100, 60)
+
+        db.db_set('chris', 'lessard')
+        db.db_set('green', 'green')
+
+        self.assertEqual(read_records(db.memtable_wal_path()), ([], 0))
+
+        db.save_metadata()
+
+        records, size = read_records(db.memtable_wal_path())
+        self.assertEqual(records, [(OP_SET, 'chris', 'lessard'), (OP_SET, 'green', 'green')])
+
+    def test_db_set_rejects_unknown_sync_policy(self):
+        '''
+        Tests that a write asking for an unknown sync policy is neither stored nor
+        logged, so it doesn't come back on restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        with self.assertRaises(ValueError):
+            db.db_set('chris', 'lessard', sync='sometimes')
+
+        db.close()
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertIsNone(db.db_get('chris'))
+
+    def test_set_wal_group_commit_requires_max_delay(self):
+        '''
+        Tests that group commit of more than one write needs a time bound, so a
+        lone write can't wait for others forever.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        with self.assertRaises(ValueError):
+            db.set_wal_group_commit(100)
+
+        db.set_wal_group_commit(1)
+        db.db_set('chris', 'lessard')
+        self.assertEqual(read_records(db.memtable_wal_path())[0], [(OP_SET, 'chris', 'lessard')])
+
+    def test_trees_keep_their_own_wal(self):
+        '''
+        Tests that two trees in the same process write to, and restore from,
+        their own write-ahead-logs.
+        '''
+        other_basepath = 'test-segments-2/'
+        self.addCleanup(shutil.rmtree, other_basepath)
+
+        db1 = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db2 = LSMTree(TEST_FILENAME, other_basepath, BKUP_NAME)
+        db1.db_set('chris', 'lessard')
+        db2.db_set('green', 'green')
+        db1.close()
+        db2.close()
+
+        self.assertEqual(read_records(db1.memtable_wal_path())[0], [(OP_SET, 'chris', 'lessard')])
+        self.assertEqual(read_records(db2.memtable_wal_path())[0], [(OP_SET, 'green', 'green')])
+
+        db2 = LSMTree(TEST_FILENAME, other_basepath, BKUP_NAME)
+        self.assertEqual(db2.db_get('green'), 'green')
+        self.assertEqual(db2.db_get('chris'), None)
+        db2.close()
+
+    def test_db_set_returns_handle_with_async_wal(self):
+        '''
+        Tests that with an asynchronous write-ahead-log, db_set returns a handle
+        to wait for its write, and that the log can be replayed.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_wal_async(True)
+
+        for i in range(100):
+            handle = db.db_set('key' + str(i), str(i))
+        handle = db.db_set('key0', 'updated')
+
+        self.assertTrue(handle.wait(timeout=5))
+        records, size = read_records(db.memtable_wal_path())
+        self.assertEqual(len(records), 101)
+
+        db.close()
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.db_get('key0'), 'updated')
+        self.assertEqual(db.db_get('key99'), '99')
+
+    def test_db_set_sync_overrides_wal_sync_policy(self):
+        '''
+        Tests that a single write can be committed with its own sync policy.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_wal_sync_policy('none')
+
+        db.db_set('chris', 'lessard')
+
+        self.assertEqual(read_records(db.memtable_wal_path()), ([], 0))
+
+        db.db_set('green', 'green', sync='flush')
+
+        records, size = read_records(db.memtable_wal_path())
+        self.assertEqual(records, [(OP_SET, 'chris', 'lessard'), (OP_SET, 'green', 'green')])
+
     def test_init_loads_metadata_and_memtable(self):
         '''
         Tests that initializing a new instance of the database loads
         metadata and memtable info.
         '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.memtable_wal().clear()
 
         segments = ['segment1', 'segment2', 'segment3', 'segment4', 'segment5']
         db.segments = segments
@@ -479,10 +875,56 @@ class TestDatabase(unittest.TestCase):
 
         db.flush_memtable_to_disk(TESTPATH)
 
-        in_order = db.index.in_order()
+        index = db.segment_index(TEST_FILENAME)
+        in_order = index.in_order()
         self.assertEqual(len(in_order), 2)
-        self.assertTrue(db.index.contains('jkl'))
-        self.assertTrue(db.index.contains('vwx'))
+        self.assertTrue(index.contains('jkl'))
+        self.assertTrue(index.contains('vwx'))
+
+    def test_flush_memtable_to_disk_saves_index_next_to_segment(self):
+        '''
+        Tests that flushing the memtable to disk saves the segment's sparse
+        index next to it, and that it can be loaded back.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        db.set_sparsity_factor(25)
+
+        for key, val in [('abc', '123'), ('def', '456'), ('ghi', '789'), ('jkl', '012')]:
+            db.db_set(key, val)
+
+        db.flush_memtable_to_disk(TESTPATH)
+
+        with open(db.index_path(TESTPATH), 'r') as s:
+            lines = s.readlines()
+
+        self.assertEqual(lines, ['jkl,24\n'])
+
+        db.indexes = {}
+        index = db.segment_index(TEST_FILENAME)
+        self.assertEqual(index.find_node('jkl').offset, 24)
+
+    def test_segment_index_rebuilds_torn_index(self):
+        '''
+        Tests that an index file torn by a crash is rebuilt from its segment
+        instead of failing the read.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        db.set_sparsity_factor(25)
+
+        for key, val in [('abc', '123'), ('def', '456'), ('ghi', '789'), ('jkl', '012')]:
+            db.db_set(key, val)
+
+        db.flush_memtable_to_disk(TESTPATH)
+        with open(db.index_path(TESTPATH), 'w') as s:
+            s.write('jk')
+
+        db.indexes = {}
+        index = db.segment_index(TEST_FILENAME)
+        self.assertEqual(index.find_node('jkl').offset, 24)
+        with open(db.index_path(TESTPATH), 'r') as s:
+            self.assertEqual(s.readlines(), ['jkl,24\n'])
 
     def test_flush_memtable_to_disk_writes_most_recent_keys(self):
         '''
@@ -509,10 +951,10 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(lines[1], 'def,DEF\n')
         self.assertEqual(lines[2], 'ghi,GHI\n')
 
-    def test_flush_memtable_to_disk_stores_segment_in_index(self):
+    def test_flush_memtable_to_disk_gives_each_segment_its_own_index(self):
         '''
-        Tests that flushing the memtable to disk populates the index and stores
-        the current segments within each node.s
+        Tests that flushing the memtable to disk populates an index belonging to
+        the current segment only.
         '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
         db.set_threshold(100)
@@ -524,6 +966,7 @@ class TestDatabase(unittest.TestCase):
         db.db_set('jkl', '012')
 
         db.flush_memtable_to_disk(TESTPATH)
+        db.memtable = RedBlackTree()
 
         db.db_set('mno', '345')
         db.db_set('pqr', '678')
@@ -533,13 +976,15 @@ class TestDatabase(unittest.TestCase):
         # Simulate crossing threshold
         db.segments = ['test_file-1', 'test_file-2']
         db.current_segment = 'test_file-2'
-        db.flush_memtable_to_disk(TESTPATH)
+        db.flush_memtable_to_disk(TEST_BASEPATH + 'test_file-2')
 
-        segment1 = db.index.find_node('jkl').segment
-        segment2 = db.index.find_node('vwx').segment
-        
-        self.assertEqual(segment1, 'test_file-1')
-        self.assertEqual(segment2, 'test_file-2')
+        index1 = db.segment_index('test_file-1')
+        index2 = db.segment_index('test_file-2')
+
+        self.assertTrue(index1.contains('jkl'))
+        self.assertFalse(index1.contains('vwx'))
+        self.assertTrue(index2.contains('vwx'))
+        self.assertFalse(index2.contains('jkl'))
 
     def test_flush_memtable_to_disk_stores_correct_index_offsets(self):
         '''
@@ -561,8 +1006,8 @@ class TestDatabase(unittest.TestCase):
 
         db.flush_memtable_to_disk(TESTPATH)
 
-        offset1 = db.index.find_node('jkl').offset
-        offset2 = db.index.find_node('vwx').offset
+        offset1 = db.segment_index(TEST_FILENAME).find_node('jkl').offset
+        offset2 = db.segment_index(TEST_FILENAME).find_node('vwx').offset
 
         self.assertEqual(offset1, 24)
         self.assertEqual(offset2, 56)
@@ -577,6 +1022,27 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(line2, 'vwx,234\n')
 
     # Index
+    def test_search_indexed_segment_finds_every_key(self):
+        '''
+        Tests that keys are found whether or not they are indexed, including in
+        the last index block, and that keys prefixing stored ones aren't.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(100)
+        db.set_sparsity_factor(25)
+        pairs = [('key' + str(i).zfill(3), str(i) * (i % 4 + 1)) for i in range(0, 60, 2)]
+
+        segment = db.new_segment_name()
+        db.write_segment(db.segment_path(segment), segment, iter(pairs))
+
+        for key, value in pairs:
+            self.assertEqual(db.search_indexed_segment(key, segment), value)
+        for i in range(1, 61, 2):
+            self.assertIsNone(db.search_indexed_segment('key' + str(i).zfill(3), segment))
+        self.assertIsNone(db.search_indexed_segment('key', segment))
+        self.assertIsNone(db.search_indexed_segment('key00', segment))
+        self.assertIsNone(db.search_indexed_segment('a', segment))
+
     def test_retrieve_value_from_index(self):
         '''
         Tests that indexed values can be retrieved appropriately
@@ -593,7 +1059,7 @@ class TestDatabase(unittest.TestCase):
 
         db.flush_memtable_to_disk(TESTPATH)
 
-        offset1 = db.index.find_node('jkl').offset
+        offset1 = db.segment_index(TEST_FILENAME).find_node('jkl').offset
 
         with open(TESTPATH, 'r') as s:
             s.seek(offset1)
@@ -626,25 +1092,24 @@ class TestDatabase(unittest.TestCase):
         db.db_set('stu', '901')
         db.db_set('vwx', '234')
 
-        db.flush_memtable_to_disk(TESTPATH)
-        'test_file-2'
+        db.current_segment = 'test_file-2'
+        db.flush_memtable_to_disk(TEST_BASEPATH + 'test_file-2')
 
         # First segment
-        segment1 = db.index.find_node('jkl').segment
-        offset1 = db.index.find_node('jkl').offset
+        segment1 = 'test_file-1'
+        offset1 = db.segment_index(segment1).find_node('jkl').offset
 
         with open(TEST_BASEPATH + segment1, 'r') as s:
             s.seek(offset1)
             line1 = s.readline()
 
-        segment1 = db.index.find_node('jkl').segment
         key, value = line1.strip().split(',')
         self.assertEqual(key, 'jkl')
         self.assertEqual(value, '012')
 
         # Second segment
-        segment2 = db.index.find_node('vwx').segment
-        offset2 = db.index.find_node('vwx').offset
+        segment2 = 'test_file-2'
+        offset2 = db.segment_index(segment2).find_node('vwx').offset
 
         with open(TEST_BASEPATH + segment2, 'r') as s:
             s.seek(offset2)
@@ -662,7 +1127,10 @@ class TestDatabase(unittest.TestCase):
         with open(TEST_BASEPATH + 'segment2', 'w') as s:
             s.write('chris,lessard\n')
 
-        db.index.add('chris', 'lessard', offset=0, segment='segment2')
+        index = RedBlackTree()
+        index.add('chris', offset=0)
+        db.indexes['segment2'] = index
+        db.segments = ['segment2']
 
         self.assertEqual(db.db_get('chris'), 'lessard')
 
@@ -679,19 +1147,58 @@ class TestDatabase(unittest.TestCase):
             s.write('christian,dior\n')
             s.write('daniel,lessard\n')
 
-        db.index.add('chris', 'lessard', offset=0, segment='segment2')
+        index = RedBlackTree()
+        index.add('chris', offset=0)
+        db.indexes['segment2'] = index
+        db.segments = ['segment2']
 
         self.assertEqual(db.db_get('christian'), 'dior')
         self.assertEqual(db.db_get('daniel'), 'lessard')
 
+    def test_db_get_skips_segments_ruled_out_by_their_bloom_filter(self):
+        '''
+        Tests that db_get doesn't search segments whose own bloom filter
+        says the key isn't there.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.bloom_filter.add('chris')
+
+        with open(TEST_BASEPATH + 'segment1', 'w') as s:
+            s.write('chris,lessard\n')
+
+        db.segments = ['segment1']
+        self.assertEqual(db.db_get('chris'), 'lessard')
+
+        db.bloom_filters['segment1'] = BloomFilter(1, 0.01)
+        self.assertEqual(db.db_get('chris'), None)
+
+    def test_db_get_prefers_newest_segment(self):
+        '''
+        Tests that db_get consults segments from newest to oldest, each through
+        its own index, so the most recent value is returned.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.bloom_filter.add('chris')
+        db.bloom_filter.add('daniel')
+
+        with open(TEST_BASEPATH + 'segment1', 'w') as s:
+            s.write('chris,lessard\n')
+            s.write('daniel,lessard\n')
+
+        with open(TEST_BASEPATH + 'segment2', 'w') as s:
+            s.write('chris,martinez\n')
+
+        db.segments = ['segment1', 'segment2']
+
+        self.assertEqual(db.db_get('chris'), 'martinez')
+        self.assertEqual(db.db_get('daniel'), 'lessard')
+
     def test_repopulate_index_stores_correst_offsets(self):
         '''
         Tests that the repopulate_index method correctly stores
         offsets to locations of the records on disk.
         '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.index.add('chris', offset=10)
-        db.index.add('lessard', offset=52)
         db.segments = ['segment1', 'segment2']
 
         # Write every two records
@@ -712,19 +1219,19 @@ class TestDatabase(unittest.TestCase):
 
         db.repopulate_index()
 
-        blue_node = db.index.find_node('blue')
+        blue_node = db.segment_index('segment1').find_node('blue')
         self.assertEqual(blue_node.offset, 6)
 
-        with open(TEST_BASEPATH + blue_node.segment, 'r') as s:
+        with open(TEST_BASEPATH + 'segment1', 'r') as s:
             s.seek(blue_node.offset)
             line = s.readline()
 
         self.assertEqual(line, 'blue,2\n')
 
-        magenta_node = db.index.find_node('magenta')
+        magenta_node = db.segment_index('segment2').find_node('magenta')
         self.assertEqual(magenta_node.offset, 7)
 
-        with open(TEST_BASEPATH + magenta_node.segment, 'r') as s:
+        with open(TEST_BASEPATH + 'segment2', 'r') as s:
             s.seek(magenta_node.offset)
             line = s.readline()
 
@@ -736,8 +1243,6 @@ class TestDatabase(unittest.TestCase):
         calling the db's repopulate_index method.
         '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.index.add('chris', offset=10)
-        db.index.add('lessard', offset=52)
         db.segments = ['segment1', 'segment2']
 
         # Write every two records
@@ -758,177 +1263,163 @@ class TestDatabase(unittest.TestCase):
 
         db.repopulate_index()
 
-        blue_node = db.index.find_node('blue')
+        index1 = db.segment_index('segment1')
+        index2 = db.segment_index('segment2')
+
+        blue_node = index1.find_node('blue')
         self.assertIsNotNone(blue_node)
         self.assertEqual(blue_node.key, 'blue')
 
-        magenta_node = db.index.find_node('magenta')
+        magenta_node = index2.find_node('magenta')
         self.assertIsNotNone(magenta_node)
         self.assertEqual(magenta_node.key, 'magenta')
 
-        self.assertFalse(db.index.contains('red'))
-        self.assertFalse(db.index.contains('green'))
-        self.assertFalse(db.index.contains('cyan'))
-        self.assertFalse(db.index.contains('yellow'))
+        self.assertFalse(index1.contains('red'))
+        self.assertFalse(index1.contains('green'))
+        self.assertFalse(index2.contains('cyan'))
+        self.assertFalse(index2.contains('yellow'))
 
     # compaction
-    def test_delete_keys_from_segment_deletes_one_key_from_file(self):
+    def write_level0(self, db, segments):
         '''
-        Tests that individual keys can be deleted from a given segment file.
+        Writes each list of lines in segments to a new level 0 segment of db.
         '''
-        lines = ['red,1\n', 'blue,2\n', 'green,3\n', 'yellow,4\n',]
-        keys = set(['green'])
-        file = TEST_BASEPATH + 'test_file-1'
+        for lines in segments:
+            segment = db.new_segment_name()
+            with open(TEST_BASEPATH + segment, 'w') as s:
+                s.writelines(lines)
+            db.segments.append(segment)
 
-        with open(file, 'w') as s:
             for line in lines:
-                s.write(line)
+                key, val = line.split(',')
+                db.bloom_filter.add(key)
 
+    def test_compact_leaves_level0_under_its_limit(self):
+        '''
+        Tests that the compaction algorithm does nothing until level 0 holds
+        level0_max_segments segments.
+        '''
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.delete_keys_from_segment(keys, file)
+        self.write_level0(db, [['red,1\n'], ['blue,2\n'], ['green,3\n']])
+        segments = db.segments[:]
 
-        with open(file, 'r') as s:
-            altered_lines = s.readlines()
+        db.compact()
 
-        self.assertTrue(altered_lines == ['red,1\n', 'blue,2\n', 'yellow,4\n', ])
+        self.assertEqual(db.segments, segments)
+        self.assertEqual(db.levels, [])
 
-    def test_delete_keys_from_segment_deletes_multiple_keys_from_file(self):
+    def test_compact_merges_level0_into_level1(self):
         '''
-        Tests that individual keys can be deleted from a given segment file.
+        Tests that the compaction algorithm merges every level 0 segment into
+        level 1, keeping the newest value of each key and deleting the inputs.
         '''
-        lines = ['red,1\n', 'blue,2\n', 'green,3\n', 'yellow,4\n', ]
-        keys = set(['green', 'blue'])
-        file = TEST_BASEPATH + 'test_file-1'
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.write_level0(db, [
+            ['blue,2\n', 'green,3\n', 'red,1\n'],
+            ['green,5\n', 'yellow,4\n'],
+            ['blue,6\n'],
+            ['red,7\n'],
+        ])
+        segments = db.segments[:]
 
-        with open(file, 'w') as s:
-            for line in lines:
-                s.write(line)
+        db.compact()
 
-        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.delete_keys_from_segment(keys, file)
+        self.assertEqual(db.segments, [])
+        self.assertEqual(len(db.levels), 1)
+        self.assertEqual(len(db.levels[0]), 1)
+        for segment in segments:
+            self.assertFalse(os.path.exists(TEST_BASEPATH + segment))
 
-        with open(file, 'r') as s:
-            altered_lines = s.readlines()
+        with open(TEST_BASEPATH + db.levels[0][0], 'r') as s:
+            lines = s.readlines()
 
-        self.assertTrue(altered_lines == ['red,1\n', 'yellow,4\n', ])
+        self.assertEqual(lines, ['blue,6\n', 'green,5\n', 'red,7\n', 'yellow,4\n'])
+        self.assertEqual(db.segment_key_range(db.levels[0][0]), ('blue', 'yellow'))
 
-    def test_delete_keys_from_segments_deletes_one_key(self):
+    def test_compact_only_merges_overlapping_segments_of_next_level(self):
         '''
-        Tests that delete_keys_from_segments deletes a single key 
-        from multiple segments.
+        Tests that level 1 segments whose key range doesn't overlap level 0
+        are left untouched.
         '''
-        lines = ['red,1\n', 'blue,2\n', 'green,3\n', 'yellow,4\n', ]
-        files = ['test_file-1', 'test_file-2', 'test_file-3']
-        keys = set(['green'])
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_level0_max_segments(1)
+        self.write_level0(db, [['apple,1\n', 'banana,2\n']])
+        db.compact()
+        self.write_level0(db, [['melon,3\n', 'peach,4\n']])
+        db.compact()
 
-        for file in files:
-            with open(TEST_BASEPATH + file, 'w') as s:
-                for line in lines:
-                    s.write(line)
+        self.assertEqual(len(db.levels[0]), 2)
+        first = db.levels[0][0]
+        inode = os.stat(TEST_BASEPATH + first).st_ino
 
-        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.delete_keys_from_segments(keys, files)
+        self.write_level0(db, [['orange,5\n']])
+        db.compact()
 
-        expected_lines = [
-            'red,1\n',
-            'blue,2\n',
-            'yellow,4\n',
-        ]
-        for file in files:
-            with open(TEST_BASEPATH + file, 'r') as s:
-                l = s.readlines()
-                self.assertEqual(l, expected_lines)
+        self.assertEqual(db.levels[0][0], first)
+        self.assertEqual(os.stat(TEST_BASEPATH + first).st_ino, inode)
+        self.assertEqual(db.db_get('orange'), '5')
+        self.assertEqual(db.db_get('apple'), '1')
 
-    def test_delete_keys_from_segments_deletes_many_keys(self):
+    def test_compact_splits_output_into_threshold_sized_segments(self):
         '''
-            Tests that delete_keys_from_segments deletes a single key
-            from multiple segments.
-            '''
-        lines = ['red,1\n', 'blue,2\n', 'green,3\n', 'yellow,4\n', ]
-        files = ['test_file-1', 'test_file-2', 'test_file-3']
-        keys = set(['red', 'green'])
+        Tests that merging writes segments of about threshold bytes whose key
+        ranges don't overlap.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(20)
+        db.set_level_size_ratio(100)
+        keys = ['key' + str(i).zfill(3) for i in range(40)]
+        self.write_level0(db, [[key + ',v\n' for key in keys[i::4]] for i in range(4)])
 
-        for file in files:
-            with open(TEST_BASEPATH + file, 'w') as s:
-                for line in lines:
-                    s.write(line)
+        db.compact()
 
-        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.delete_keys_from_segments(keys, files)
+        level = db.levels[0]
+        self.assertGreater(len(level), 1)
+        for segment in level:
+            self.assertLess(db.get_file_size(TEST_BASEPATH + segment), 20 + len('key000,v\n'))
 
-        expected_lines = [
-            'blue,2\n',
-            'yellow,4\n',
-        ]
-        for file in files:
-            with open(TEST_BASEPATH + file, 'r') as s:
-                l = s.readlines()
-                self.assertEqual(l, expected_lines)
+        for previous, segment in zip(level, level[1:]):
+            self.assertLess(db.segment_key_range(previous)[1], db.segment_key_range(segment)[0])
+
+        for key in keys:
+            self.assertEqual(db.db_get(key), 'v')
 
-    def test_compact_dropes_one_key(self):
+    def test_compact_pushes_oversized_levels_down(self):
         '''
-        Tests that the compaction algorithm can drop a single redundant key from segments on disk.
+        Tests that a level larger than its limit is merged into the next one.
         '''
-        # Prepare the values on disk
-        lines = ['red,1\n', 'blue,2\n', 'green,3\n', 'yellow,4\n',]
-        files = ['test_file-1', 'test_file-2', 'test_file-3']
-
-        for file in files:
-            with open(TEST_BASEPATH + file, 'w') as s:
-                for line in lines:
-                    s.write(line)
-
-        # Mock the database instance
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.segments = files[:]
+        db.set_threshold(20)
+        db.set_level_size_ratio(2)
 
-        for line in lines:
-            key, val = line.split(',')
-            db.bloom_filter.add(key)
+        for i in range(200):
+            db.db_set('key' + str(i % 50).zfill(2), str(i))
 
-        db.memtable.add('green', '5')
+        self.assertGreater(len(db.levels), 1)
+        for level in range(1, len(db.levels)):
+            self.assertLessEqual(db.level_size(level), db.max_level_size(level))
 
-        # Test
-        db.compact()
-        expected_lines = ['red,1\n', 'blue,2\n', 'yellow,4\n']
-        for file in files:
-            with open(TEST_BASEPATH + file, 'r') as s:
-                l = s.readlines()
-                self.assertEqual(l, expected_lines)
+        for i in range(150, 200):
+            self.assertEqual(db.db_get('key' + str(i % 50).zfill(2)), str(i))
 
-    def test_compact_drops_multiple_keys(self):
+    def test_db_set_does_not_rewrite_flushed_segments(self):
         '''
-        Tests that the compaction algorithm can drop multiple redundant keys
-        from segments on disk.
+        Tests that flushing the memtable leaves the segments already on disk alone.
         '''
-        # Prepare the values on disk
-        lines = ['red,1\n', 'blue,2\n', 'green,3\n', 'yellow,4\n', ]
-        files = ['test_file-1', 'test_file-2', 'test_file-3']
-
-        for file in files:
-            with open(TEST_BASEPATH + file, 'w') as s:
-                for line in lines:
-                    s.write(line)
-
-        # Mock the database instance
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
-        db.segments = files[:]
+        db.set_threshold(10)
 
-        for line in lines:
-            key, val = line.split(',')
-            db.bloom_filter.add(key)
+        db.db_set('green', 'green')
+        db.db_set('sides', 'seeds')
+        inode = os.stat(TESTPATH).st_ino
 
-        db.memtable.add('green', '5')
-        db.memtable.add('blue', '5')
-        db.memtable.add('red', '5')
+        db.db_set('green', 'boots')
+        db.db_set('scrap', 'pracs')
 
-        # Test
-        db.compact()
-        expected_lines = ['yellow,4\n']
-        for file in files:
-            with open(TEST_BASEPATH + file, 'r') as s:
-                l = s.readlines()
-                self.assertEqual(l, expected_lines)
+        with open(TESTPATH, 'r') as s:
+            self.assertEqual(s.readlines(), ['green,green\n'])
+        self.assertEqual(os.stat(TESTPATH).st_ino, inode)
+        self.assertEqual(db.db_get('green'), 'boots')
 
     def test_db_set_calls_compaction_algorithm(self):
         '''
@@ -952,10 +1443,524 @@ class TestDatabase(unittest.TestCase):
 
         db.db_set('scoon', 'coons')
 
-        with open(TEST_BASEPATH + 'test_file-2') as s:
+        self.assertEqual(db.segments, [])
+        self.assertEqual(db.levels, [['test_file-5', 'test_file-6', 'test_file-7', 'test_file-8']])
+
+        lines = []
+        for segment in db.levels[0]:
+            with open(TEST_BASEPATH + segment) as s:
+                lines += s.readlines()
+
+        self.assertEqual(lines, [
+            'fring,boots\n', 'green,green\n', 'harps,sterm\n', 'meant,rents\n',
+            'scoop,merps\n', 'scrap,pracs\n', 'sides,seeds\n'])
+
+    def test_load_metadata_loads_levels(self):
+        '''
+        Tests that the levels and their key ranges survive a restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_level0_max_segments(1)
+        self.write_level0(db, [['blue,2\n', 'red,1\n']])
+        db.compact()
+        db.save_metadata()
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.segments, [])
+        self.assertEqual(db.levels, [['test_file-2']])
+        self.assertEqual(db.key_ranges, {'test_file-2': ('blue', 'red')})
+        self.assertEqual(db.db_get('red'), '1')
+
+    def test_compact_size_tiered_merges_similarly_sized_segments(self):
+        '''
+        Tests that size-tiered compaction merges tier_size neighbouring segments
+        of similar size into one, keeping the newest values, and leaves the
+        others alone.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_compaction_strategy('size_tiered')
+        self.write_level0(db, [
+            ['key' + str(i).zfill(2) + ',1\n' for i in range(10)],
+            ['blue,2\n', 'green,3\n'],
+            ['green,5\n', 'olive,4\n'],
+            ['blue,6\n', 'peach,7\n'],
+            ['olive,8\n', 'red,7\n'],
+            ['white,9\n'],
+        ])
+        segments = db.segments[:]
+
+        db.compact()
+
+        self.assertEqual(len(db.segments), 3)
+        self.assertEqual(db.segments[0], segments[0])
+        self.assertEqual(db.segments[2], segments[5])
+        for segment in segments[1:5]:
+            self.assertFalse(os.path.exists(TEST_BASEPATH + segment))
+
+        with open(TEST_BASEPATH + db.segments[1], 'r') as s:
             lines = s.readlines()
 
-        self.assertEqual(lines, ['sides,seeds\n'])
+        self.assertEqual(lines, ['blue,6\n', 'green,5\n', 'olive,8\n', 'peach,7\n', 'red,7\n'])
+        self.assertEqual(db.levels, [])
+
+    def test_db_set_size_tiered_keeps_newest_values(self):
+        '''
+        Tests that reads see the newest value of every key as size-tiered
+        compaction merges tiers into larger ones.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(20)
+        db.set_compaction_strategy('size_tiered')
+
+        for i in range(300):
+            db.db_set('key' + str(i % 40).zfill(2), str(i))
+
+        self.assertEqual(db.levels, [])
+        self.assertLess(len(db.segments), 300 // 2)
+        for i in range(260, 300):
+            self.assertEqual(db.db_get('key' + str(i % 40).zfill(2)), str(i))
+
+    def test_set_compaction_strategy_rejects_unknown_strategy(self):
+        '''
+        Tests that only known compaction strategies can be selected.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        with self.assertRaises(ValueError):
+            db.set_compaction_strategy('tiered')
+
+        self.assertEqual(db.compaction_strategy, 'leveled')
+
+    def test_compaction_tracks_bytes_written(self):
+        '''
+        Tests that bytes written by flushes and by compaction are counted apart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(10)
+
+        for key in ['green', 'sides', 'scrap', 'fring', 'harps']:
+            db.db_set(key, key)
+
+        self.assertEqual(db.bytes_flushed, 4 * len('green,green\n'))
+        self.assertEqual(db.bytes_compacted, 4 * len('green,green\n'))
+
+    # background compaction
+    def test_db_set_flushes_in_background(self):
+        '''
+        Tests that with background compaction, a full memtable is flushed by a
+        worker while reads are served from the immutable memtable.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(10)
+        db.set_background_compaction(True)
+
+        # Holding the lock keeps the worker from putting the segment in place
+        with db.lock:
+            db.db_set('green', 'green')
+            db.db_set('sides', 'seeds')
+
+            self.assertEqual(db.db_get('green'), 'green')
+            self.assertIsNotNone(db.immutable_memtable)
+            self.assertEqual(db.segments, [])
+            self.assertEqual(db.current_segment, 'test_file-2')
+            self.assertFalse(db.memtable.contains('green'))
+
+        db.wait_for_flush()
+
+        self.assertIsNone(db.immutable_memtable)
+        self.assertEqual(db.segments, ['test_file-1'])
+        self.assertEqual(db.wal_numbers(), [2])
+        self.assertEqual(db.db_get('green'), 'green')
+        self.assertEqual(db.db_get('sides'), 'seeds')
+
+    def test_db_set_background_compaction_keeps_newest_values(self):
+        '''
+        Tests that reads see the newest value of every key while flushes and
+        compactions run in the background.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(20)
+        db.set_background_compaction(True)
+
+        for i in range(300):
+            key = 'key' + str(i % 40).zfill(2)
+            db.db_set(key, str(i))
+            self.assertEqual(db.db_get(key), str(i))
+
+        db.wait_for_flush()
+
+        self.assertNotEqual(db.levels, [])
+        for i in range(260, 300):
+            self.assertEqual(db.db_get('key' + str(i % 40).zfill(2)), str(i))
+
+    def test_restore_memtable_replays_interrupted_flush(self):
+        '''
+        Tests that the log of a memtable whose flush was interrupted is replayed
+        before the current log, which is written to from then on.
+        '''
+        with open(TEST_BASEPATH + BKUP_NAME + '-1', 'wb') as s:
+            s.write(encode_record('green', 'green', log_number=1))
+            s.write(encode_record('sides', 'seeds', log_number=1))
+
+        with open(TEST_BASEPATH + BKUP_NAME + '-2', 'wb') as s:
+            s.write(encode_record('green', 'boots', log_number=2))
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertEqual(db.db_get('green'), 'boots')
+        self.assertEqual(db.db_get('sides'), 'seeds')
+        self.assertEqual(db.memtable_wal_path(), TEST_BASEPATH + BKUP_NAME + '-2')
+
+    # WAL rotation
+    def test_flush_rotates_wal(self):
+        '''
+        Tests that each memtable gets its own write-ahead-log, and that a flushed
+        memtable's log is deleted once the metadata listing its segment is saved.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(10)
+
+        db.db_set('green', 'green')
+        self.assertEqual(db.wal_numbers(), [1])
+
+        db.db_set('sides', 'seeds')
+
+        self.assertEqual(db.wal_numbers(), [2])
+        self.assertEqual(read_records(db.memtable_wal_path())[0], [(OP_SET, 'sides', 'seeds')])
+
+        # The metadata is saved with the flush, so nothing is lost without save_metadata
+        db.close()
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.segments, ['test_file-1'])
+        self.assertEqual(db.wal_number, 2)
+        self.assertEqual(db.db_get('green'), 'green')
+        self.assertEqual(db.db_get('sides'), 'seeds')
+        self.assertEqual(db.memtable.total_bytes, len('sides') + len('seeds'))
+
+    def test_flush_recycles_wal(self):
+        '''
+        Tests that retired write-ahead-logs are written over by later ones, and
+        that their stale records aren't replayed.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(20)
+        db.set_wal_recycle_limit(1)
+
+        db.db_set('aaaa', 'bbbb')
+        db.db_set('cccc', 'dddd')
+        inode = os.stat(db.memtable_wal_path()).st_ino
+        db.db_set('eeee', 'ffffffff')
+        db.db_set('gggg', 'hhhh')
+
+        self.assertEqual(db.wal_numbers(), [2])
+        self.assertEqual(db.recycled_wal_numbers(), [1])
+
+        db.db_set('iiii', 'jjjj')
+
+        # Log 1 was recycled as log 3, and log 2 is kept to be recycled next
+        self.assertEqual(db.wal_numbers(), [3])
+        self.assertEqual(db.recycled_wal_numbers(), [2])
+        self.assertEqual(os.stat(db.memtable_wal_path()).st_ino, inode)
+
+        # Log 1's second record is still intact past the new one
+        db.close()
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual([node.key for node in db.memtable.in_order()], ['iiii'])
+        self.assertEqual(db.db_get('cccc'), 'dddd')
+        self.assertEqual(db.db_get('gggg'), 'hhhh')
+
+    # SSTable segments
+    def test_sstable_segments_serve_reads(self):
+        '''
+        Tests that segments written as tables are read back through their block
+        index, including values CSV segments can't hold, and after a restart.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_segment_format('sstable')
+        db.set_block_size(32)
+        db.set_threshold(100)
+
+        pairs = [('key' + str(i).zfill(3), 'a,b\n' + str(i)) for i in range(100)]
+        for key, value in pairs:
+            db.db_set(key, value)
+
+        first_segment = db.levels[0][0]
+        self.assertTrue(is_sstable(TEST_BASEPATH + first_segment))
+        for key, value in pairs:
+            self.assertEqual(db.db_get(key), value)
+            first, last = db.segment_key_range(first_segment)
+            if first <= key <= last:
+                self.assertEqual(db.search_segment(key, first_segment), value)
+            else:
+                self.assertIsNone(db.search_segment(key, first_segment))
+
+        db.save_metadata()
+        db.close()
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.db_get('key042'), 'a,b\n42')
+        self.assertEqual(db.db_get('key100'), None)
+
+    def test_compaction_migrates_csv_segments_to_sstables(self):
+        '''
+        Tests that CSV segments stay readable once the tree writes tables, and that
+        compaction rewrites them as tables.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.write_level0(db, [['abc,old\n', 'def,old\n'], ['abc,new\n', 'ghi,new\n']])
+
+        db.set_segment_format('sstable')
+        self.assertEqual(db.db_get('abc'), 'new')
+        self.assertIsNone(db.segment_table(db.segments[0]))
+
+        db.compact_level(0)
+
+        self.assertEqual(len(db.levels[0]), 1)
+        table = db.segment_table(db.levels[0][0])
+        self.assertEqual(list(table.items()), [('abc', 'new'), ('def', 'old'), ('ghi', 'new')])
+        self.assertEqual(db.segment_key_range(db.levels[0][0]), ('abc', 'ghi'))
+        self.assertEqual(db.db_get('def'), 'old')
+
+    def test_compaction_unmaps_merged_sstables(self):
+        '''
+        Tests that the tables merged by compaction are unmapped before their files
+        are deleted, and that closing the tree unmaps the rest.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_segment_format('sstable')
+        for pairs in [[('abc', 'old'), ('def', 'old')], [('abc', 'new'), ('ghi', 'new')]]:
+            segment = db.new_segment_name()
+            db.write_segment(db.segment_path(segment), segment, iter(pairs))
+            db.segments.append(segment)
+        inputs = [db.segment_table(segment) for segment in db.segments]
+
+        db.compact_level(0)
+
+        for table in inputs:
+            self.assertTrue(table.data.closed)
+        output = db.segment_table(db.levels[0][0])
+        self.assertEqual(output.get('abc'), 'new')
+
+        db.close()
+        self.assertTrue(output.data.closed)
+
+    def test_table_cache_bounds_open_segments(self):
+        '''
+        Tests that reads keep at most max_open_files segments open, of either
+        format, and that evicted segments are reopened when read again.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_max_open_files(2)
+        self.write_level0(db, [['abc,1\n'], ['def,2\n']])
+        db.set_segment_format('sstable')
+        for pairs in [[('ghi', '3')], [('jkl', '4')]]:
+            segment = db.new_segment_name()
+            db.write_segment(db.segment_path(segment), segment, iter(pairs))
+            db.segments.append(segment)
+            db.bloom_filter.add(pairs[0][0])
+
+        for i in range(2):
+            for key, value in [('abc', '1'), ('def', '2'), ('ghi', '3'), ('jkl', '4')]:
+                self.assertEqual(db.db_get(key), value)
+                self.assertLessEqual(len(db.table_cache), 2)
+
+        self.assertEqual(list(db.table_cache.readers), db.segments[2:])
+
+        # Evicted tables are closed as soon as no read holds them any more
+        table = weakref.ref(db.table_cache.get(db.segments[2]))
+        db.db_get('abc')
+        db.db_get('def')
+        self.assertIsNone(table())
+
+    def test_trees_share_block_cache(self):
+        '''
+        Tests that trees can read their tables through one block cache, and that
+        the blocks of the tables compaction merges are dropped from it.
+        '''
+        other_basepath = 'test-segments-2/'
+        self.addCleanup(shutil.rmtree, other_basepath)
+        cache = BlockCache(1000000)
+
+        trees = []
+        for basepath in (TEST_BASEPATH, other_basepath):
+            db = LSMTree(TEST_FILENAME, basepath, BKUP_NAME)
+            db.set_segment_format('sstable')
+            db.set_block_cache(cache)
+            for pairs in [[('abc', basepath), ('def', 'old')], [('abc', 'new'), ('ghi', 'new')]]:
+                segment = db.new_segment_name()
+                db.write_segment(db.segment_path(segment), segment, iter(pairs))
+                db.segments.append(segment)
+                db.bloom_filter.add_many([key for key, value in pairs])
+            trees.append(db)
+
+        self.assertEqual([db.db_get('def') for db in trees], ['old', 'old'])
+        self.assertEqual([db.db_get('def') for db in trees], ['old', 'old'])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        trees[0].compact_level(0)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(trees[0].db_get('def'), 'old')
+        self.assertEqual(len(cache), 2)
+
+        trees[1].set_block_cache_size(0)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(trees[1].db_get('abc'), 'new')
+        self.assertEqual(len(cache), 0)
+        for db in trees:
+            db.close()
+
+    def test_row_cache_serves_hot_keys_until_written(self):
+        '''
+        Tests that values read from disk are served from the row cache, that a
+        write to a key replaces its cached value, and that the cache is off by
+        default.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.write_level0(db, [['abc,old\n', 'def,old\n']])
+
+        self.assertEqual(db.db_get('abc'), 'old')
+        self.assertEqual(len(db.row_cache), 0)
+
+        db.set_row_cache_size(1000)
+        for i in range(3):
+            self.assertEqual(db.db_get('abc'), 'old')
+        self.assertEqual(db.db_get('xyz'), None)
+        self.assertEqual(db.row_cache.rows, {'abc': 'old'})
+        self.assertEqual((db.row_cache.hits, db.row_cache.misses), (2, 2))
+
+        # A write goes to the memtable, which is flushed to disk over the old value
+        db.db_set('abc', 'new')
+        self.assertEqual(db.db_get('abc'), 'new')
+        db.flush_memtable_to_disk(db.current_segment_path())
+        db.segments.append(db.current_segment)
+        db.memtable = RedBlackTree()
+
+        self.assertEqual(db.db_get('abc'), 'new')
+        self.assertEqual(db.db_get('abc'), 'new')
+        self.assertEqual(db.row_cache.rows, {'abc': 'new'})
+
+    def test_multi_get_matches_db_get(self):
+        '''
+        Tests that looking up many keys at once returns, in order, the same values
+        as looking them up one at a time, wherever the keys' most recent values
+        are: in the memtable, in CSV or table segments, in level 0 or deeper.
+        '''
+        for segment_format in ('csv', 'sstable'):
+            db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+            db.set_segment_format(segment_format)
+            db.set_threshold(300)
+            db.set_sparsity_factor(30)
+
+            latest = {}
+            for i in range(400):
+                key = 'key' + str(i * 7 % 150).zfill(3)
+                latest[key] = key + '-' + str(i)
+                db.db_set(key, latest[key])
+            self.assertTrue(db.levels)
+            self.assertTrue(db.segments)
+
+            keys = ['key' + str(i).zfill(3) for i in range(0, 170, 3)] + ['key004', 'a', 'key004']
+            self.assertEqual(db.multi_get(keys), [latest.get(key) for key in keys])
+            self.assertEqual(db.multi_get(keys), [db.db_get(key) for key in keys])
+
+            db.set_row_cache_size(10000)
+            db.set_block_cache_size(0)
+            self.assertEqual(db.multi_get(keys), [db.db_get(key) for key in keys])
+            self.assertEqual(db.multi_get([]), [])
+
+            db.close()
+            self.tearDown()
+
+    def test_multi_get_sees_memtable_swapped_by_background_flush(self):
+        '''
+        Tests that a background flush making the memtable immutable while keys are
+        looked up can't hide their newest values, nor get older ones cached.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.write_level0(db, [['abc,old\n']])
+        db.set_row_cache_size(1000)
+
+        flushing = RedBlackTree()
+        flushing.add('abc', 'new')
+
+        class SwappedMemtable(RedBlackTree):
+            # The flush swaps the memtables just as this one is probed
+            def find_node(self, key):
+                db.immutable_memtable = flushing
+                return super().find_node(key)
+
+        db.memtable = SwappedMemtable()
+        db.memtable.total_bytes = 0
+
+        self.assertEqual(db.multi_get(['abc']), ['new'])
+        self.assertEqual(db.db_get('abc'), 'new')
+        self.assertEqual(len(db.row_cache), 0)
+
+    def test_segment_bloom_filter_is_rebuilt_from_sstable(self):
+        '''
+        Tests that a table's bloom filter is rebuilt from its keys when its file
+        is missing.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_segment_format('sstable')
+        db.db_set('chris', 'lessard')
+        db.flush_memtable_to_disk(TESTPATH)
+
+        os.remove(db.bloom_filter_path(TESTPATH))
+        db.bloom_filters = {}
+
+        self.assertTrue(db.segment_bloom_filter(TEST_FILENAME).check('chris'))
+        self.assertTrue(os.path.exists(db.bloom_filter_path(TESTPATH)))
+
+    def test_segment_bloom_filter_is_rebuilt_when_torn(self):
+        '''
+        Tests that a bloom filter file torn by a crash is rebuilt from its segment
+        instead of failing the read.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+        db.flush_memtable_to_disk(TESTPATH)
+
+        with open(db.bloom_filter_path(TESTPATH), 'rb') as s:
+            data = s.read()
+        with open(db.bloom_filter_path(TESTPATH), 'wb') as s:
+            s.write(data[:len(data) // 2])
+        db.bloom_filters = {}
+
+        self.assertTrue(db.segment_bloom_filter(TEST_FILENAME).check('chris'))
+        with open(db.bloom_filter_path(TESTPATH), 'rb') as s:
+            self.assertTrue(pickle.load(s).check('chris'))
+
+    def test_level_compression_overrides_tree_compression(self):
+        '''
+        Tests that tables are compressed as configured for the level they are
+        written to.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_segment_format('sstable')
+        db.set_threshold(400)
+        db.set_compression('zlib', 9)
+        db.set_level_compression(0, 'none')
+        db.set_level_compression(2, 'bz2')
+
+        for i in range(45):
+            db.db_set('key' + str(i).zfill(3), 'value' * 8)
+
+        self.assertNotEqual(db.segments, [])
+        self.assertEqual(db.segment_table(db.segments[0]).block_compression(0), 'none')
+        self.assertEqual(db.segment_table(db.levels[0][0]).block_compression(0), 'zlib')
+        self.assertEqual(db.db_get('key000'), 'value' * 8)
+
+        with self.assertRaises(ValueError):
+            db.set_compression('snappy')
+
+    def test_set_segment_format_rejects_unknown_format(self):
+        '''
+        Tests that only known segment formats can be set.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        with self.assertRaises(ValueError):
+            db.set_segment_format('parquet')
 
 if __name__ == '__main__':
     unittest.main()
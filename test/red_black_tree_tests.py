@@ -2181,6 +2181,40 @@ class RbTreeTests(unittest.TestCase):
         for i in range(20, 50):
             self.assertEqual(rb_tree.floor(i), 20)
 
+    def test_from_sorted_builds_valid_tree(self):
+        '''
+        Tests that trees built from sorted pairs hold every pair, keep the red
+        black properties, and can still be added to and removed from.
+        '''
+        def black_height(node):
+            if node.color == NIL:
+                return 1
+            if node.color == RED:
+                self.assertNotEqual(node.left.color, RED)
+                self.assertNotEqual(node.right.color, RED)
+            for child in (node.left, node.right):
+                if child.color != NIL:
+                    self.assertIs(child.parent, node)
+            height = black_height(node.left)
+            self.assertEqual(height, black_height(node.right))
+            return height + (node.color == BLACK)
+
+        for size in range(40):
+            rb_tree = RedBlackTree.from_sorted([(i, str(i)) for i in range(size)])
+
+            self.assertEqual(rb_tree.count, size)
+            self.assertEqual(list(rb_tree), list(range(size)))
+            if size:
+                self.assertEqual(rb_tree.root.color, BLACK)
+                black_height(rb_tree.root)
+                self.assertEqual(rb_tree.find_node(size // 3).value, str(size // 3))
+
+            rb_tree.add(size)
+            rb_tree.remove(0)
+            self.assertEqual(list(rb_tree), list(range(1, size + 1)))
+            if rb_tree.root:
+                black_height(rb_tree.root)
+
 
 # These tests take the bulk of the time for testing.
 class RbTreePerformanceTests(unittest.TestCase):
@@ -0,0 +1,78 @@
+import unittest
+from src.row_cache import RowCache
+
+class RowCacheTests(unittest.TestCase):
+    def test_get_counts_hits_and_misses(self):
+        '''
+        Tests that cached values are found by key, and that every lookup is
+        counted as a hit or a miss.
+        '''
+        cache = RowCache(100)
+        cache.put('chris', 'lessard', cache.generation)
+
+        self.assertEqual(cache.get('chris'), 'lessard')
+        self.assertIsNone(cache.get('daniel'))
+
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+    def test_put_evicts_least_recently_read_past_capacity(self):
+        '''
+        Tests that the cache holds at most capacity bytes of keys and values,
+        evicting the keys read the longest ago.
+        '''
+        cache = RowCache(30)
+        cache.put('chris', 'lessard', cache.generation)
+        cache.put('daniel', 'lessard', cache.generation)
+        cache.get('chris')
+        cache.put('steve', 'lessard', cache.generation)
+
+        self.assertEqual(cache.usage, 24)
+        self.assertIsNone(cache.get('daniel'))
+        self.assertEqual(cache.get('chris'), 'lessard')
+        self.assertEqual(cache.get('steve'), 'lessard')
+
+    def test_erase_drops_key(self):
+        '''
+        Tests that erasing a key drops its value and frees its bytes.
+        '''
+        cache = RowCache(100)
+        cache.put('chris', 'lessard', cache.generation)
+
+        cache.erase('chris')
+        cache.erase('daniel')
+
+        self.assertIsNone(cache.get('chris'))
+        self.assertEqual(cache.usage, 0)
+
+    def test_put_skips_values_read_before_a_write(self):
+        '''
+        Tests that a value read from disk before a write isn't cached, since it
+        may be the value the write replaced.
+        '''
+        cache = RowCache(100)
+        generation = cache.generation
+        cache.erase('chris')
+
+        cache.put('chris', 'old', generation)
+
+        self.assertIsNone(cache.get('chris'))
+
+    def test_set_capacity_shrinks_cache(self):
+        '''
+        Tests that lowering the capacity evicts the least recently read keys, and
+        that a capacity of 0 empties the cache.
+        '''
+        cache = RowCache(100)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, 'value', cache.generation)
+
+        cache.set_capacity(12)
+        self.assertEqual(list(cache.rows), ['b', 'c'])
+
+        cache.set_capacity(0)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.usage, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import unittest
+import os
+from src.sstable import SSTable, SSTableWriter, is_sstable, FOOTER, INDEX_ENTRY, META_HEADER, \
+    MAGIC, DECODE_AFTER, decoded_size
+from src.block_cache import BlockCache
+
+FILENAME = 'testfile'
+
+class SSTableTests(unittest.TestCase):
+    def tearDown(self):
+        for filename in os.listdir('.'):
+            if filename.startswith(FILENAME):
+                os.remove(filename)
+
+    def write_table(self, pairs, block_size=4096, restart_interval=16, compression='none',
+            compression_level=None):
+        '''
+        Writes pairs to a table and opens it.
+        '''
+        writer = SSTableWriter(FILENAME, block_size, restart_interval, compression, compression_level)
+        for key, value in pairs:
+            writer.add(key, value)
+        writer.finish()
+
+        return SSTable(FILENAME)
+
+    def test_get_finds_every_key(self):
+        '''
+        Tests that every key written can be read back, across many blocks, and that
+        missing keys aren't found.
+        '''
+        pairs = [(str(i).zfill(5), 'value' + str(i)) for i in range(0, 2000, 2)]
+        table = self.write_table(pairs, block_size=64)
+
+        self.assertGreater(len(table.block_offsets), 100)
+        for key, value in pairs:
+            self.assertEqual(table.get(key), value)
+
+        self.assertIsNone(table.get('00001'))
+        self.assertIsNone(table.get(''))
+        self.assertIsNone(table.get('99999'))
+
+    def test_get_searches_between_restart_points(self):
+        '''
+        Tests that keys are found whatever their position relative to the restart
+        points of their block.
+        '''
+        pairs = [('tenant-0042/' + str(i).zfill(4), str(i)) for i in range(0, 200, 2)]
+        for restart_interval in (1, 2, 3, 16, 1000):
+            table = self.write_table(pairs, block_size=256, restart_interval=restart_interval)
+
+            self.assertEqual(list(table.items()), pairs)
+            for key, value in pairs:
+                self.assertEqual(table.get(key), value)
+            for i in range(1, 200, 2):
+                self.assertIsNone(table.get('tenant-0042/' + str(i).zfill(4)))
+            self.assertIsNone(table.get('tenant-0042/'))
+
+    def test_prefix_compression_shrinks_tables(self):
+        '''
+        Tests that keys sharing long prefixes take less space when only restart
+        points store them in full.
+        '''
+        pairs = [('tenant-0042/2024-01-01/' + str(i).zfill(6), 'v') for i in range(1000)]
+
+        self.write_table(pairs, restart_interval=1)
+        full_size = os.path.getsize(FILENAME)
+        self.write_table(pairs, restart_interval=16)
+        compressed_size = os.path.getsize(FILENAME)
+
+        self.assertLess(compressed_size, full_size * 0.6)
+
+    def test_compressed_tables_read_back(self):
+        '''
+        Tests that tables written with each compression read back the same pairs,
+        and that compressible blocks shrink.
+        '''
+        pairs = [(str(i).zfill(5), 'value,' * 20 + str(i)) for i in range(500)]
+        self.write_table(pairs, block_size=1024)
+        uncompressed_size = os.path.getsize(FILENAME)
+
+        for compression, level in [('zlib', None), ('zlib', 1), ('lzma', None), ('bz2', 9)]:
+            table = self.write_table(pairs, block_size=1024, compression=compression,
+                compression_level=level)
+
+            self.assertEqual(table.block_compression(0), compression)
+            self.assertLess(os.path.getsize(FILENAME), uncompressed_size / 4)
+            self.assertEqual(list(table.items()), pairs)
+            for key, value in pairs[::7]:
+                self.assertEqual(table.get(key), value)
+            self.assertIsNone(table.get('00000a'))
+
+    def test_incompressible_blocks_are_stored_raw(self):
+        '''
+        Tests that blocks which compression doesn't shrink are stored as they are.
+        '''
+        pairs = [('chris', 'lessard')]
+
+        table = self.write_table(pairs, compression='zlib')
+
+        self.assertEqual(table.block_compression(0), 'none')
+        self.assertEqual(list(table.items()), pairs)
+
+    def test_writer_rejects_unknown_compression(self):
+        '''
+        Tests that only known compressions can be used.
+        '''
+        with self.assertRaises(ValueError):
+            SSTableWriter(FILENAME, compression='snappy')
+
+    def test_get_reads_through_block_cache(self):
+        '''
+        Tests that lookups through a block cache find the same values, caching each
+        block read decompressed, then decoded once it has been read often enough.
+        '''
+        pairs = [(str(i).zfill(5), 'value,' * 20 + str(i)) for i in range(500)]
+        table = self.write_table(pairs, block_size=1024, compression='zlib')
+        values = dict(pairs)
+        cache = BlockCache(1000000)
+
+        # Read each block once per round
+        for i in range(DECODE_AFTER):
+            for key in table.block_last_keys:
+                self.assertEqual(table.get(key, cache), values[key])
+
+            cached = cache.blocks[(FILENAME, 0)][0]
+            if i < DECODE_AFTER - 1:
+                self.assertEqual(cached[1], i + 1)
+            else:
+                self.assertEqual(cached['00000'], pairs[0][1])
+
+        self.assertEqual(len(cache), len(table.block_offsets))
+        self.assertEqual(cache.misses, len(table.block_offsets))
+        self.assertEqual(cache.usage, sum(decoded_size(entries) for entries, charge in cache.blocks.values()))
+        for key, value in pairs:
+            self.assertEqual(table.get(key, cache), value)
+        self.assertIsNone(table.get('00000a', cache))
+
+    def test_decoded_blocks_too_large_for_cache_stay_bytes(self):
+        '''
+        Tests that a block whose decoded dictionary doesn't fit in the cache stays
+        cached as bytes, since it is charged the memory the dictionary takes up.
+        '''
+        pairs = [(str(i).zfill(5), 'value' + str(i)) for i in range(100)]
+        table = self.write_table(pairs, block_size=4096, compression='none')
+        cache = BlockCache(4096)
+
+        for i in range(DECODE_AFTER + 1):
+            self.assertEqual(table.get('00050', cache), 'value50')
+
+        data, reads = cache.blocks[(FILENAME, 0)][0]
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(cache.usage, len(data))
+
+    def test_multi_get_reads_each_block_once(self):
+        '''
+        Tests that looking up many keys at once finds the same values as one at a
+        time, reading each block through the cache once.
+        '''
+        pairs = [(str(i).zfill(5), 'value' + str(i)) for i in range(0, 2000, 2)]
+        table = self.write_table(pairs, block_size=256, compression='zlib')
+        keys = sorted([key for key, value in pairs[::3]] + ['00001', '00999', '99999', ''])
+
+        self.assertEqual(table.multi_get(keys), dict(pairs[::3]))
+
+        cache = BlockCache(1000000)
+        self.assertEqual(table.multi_get(keys, cache), dict(pairs[::3]))
+        self.assertEqual(cache.misses, len(table.block_offsets))
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(table.multi_get([]), {})
+
+    def test_close_unmaps_table(self):
+        '''
+        Tests that a table is read from a single mapping of its file, which closing
+        the table releases.
+        '''
+        pairs = [(str(i).zfill(5), 'value' + str(i)) for i in range(500)]
+        table = self.write_table(pairs, block_size=256)
+
+        self.assertEqual(len(table.data), os.path.getsize(FILENAME))
+        self.assertEqual(table.get('00250'), 'value250')
+
+        table.close()
+        self.assertTrue(table.data.closed)
+        with self.assertRaises(ValueError):
+            table.get('00250')
+
+    def test_items_yields_pairs_in_order(self):
+        '''
+        Tests that a table's pairs are read back in order, including values holding
+        commas, newlines and non ASCII characters.
+        '''
+        pairs = [('chris', 'a,b'), ('clé', 'valeur'), ('daniel', 'line\nbreak')]
+        table = self.write_table(pairs, block_size=16)
+
+        self.assertEqual(list(table.items()), pairs)
+        self.assertEqual(list(table.keys()), ['chris', 'clé', 'daniel'])
+        self.assertEqual(table.get('daniel'), 'line\nbreak')
+
+    def test_meta_block_holds_key_range_and_count(self):
+        '''
+        Tests that a table records its first and last keys and its number of entries.
+        '''
+        table = self.write_table([('abc', '1'), ('def', '2'), ('ghi', '3')])
+
+        self.assertEqual(table.num_entries, 3)
+        self.assertEqual(table.first_key, 'abc')
+        self.assertEqual(table.last_key, 'ghi')
+
+    def test_empty_table(self):
+        '''
+        Tests that a table without any entries can be written and read.
+        '''
+        table = self.write_table([])
+
+        self.assertEqual(table.num_entries, 0)
+        self.assertIsNone(table.first_key)
+        self.assertIsNone(table.get('chris'))
+        self.assertEqual(list(table.items()), [])
+
+    def test_writer_size_counts_pending_block(self):
+        '''
+        Tests that the writer's size includes the block not yet written out.
+        '''
+        writer = SSTableWriter(FILENAME, 4096)
+        writer.add('chris', 'lessard')
+
+        self.assertEqual(writer.size(), 12 + len('chris') + len('lessard'))
+        writer.finish()
+
+    def test_is_sstable_tells_tables_from_csv(self):
+        '''
+        Tests that tables are told apart from CSV segments by their magic number.
+        '''
+        self.write_table([('chris', 'lessard')])
+        self.assertTrue(is_sstable(FILENAME))
+
+        with open(FILENAME, 'w') as s:
+            s.write('chris,lessard\n' * 10)
+        self.assertFalse(is_sstable(FILENAME))
+
+        open(FILENAME, 'w').close()
+        self.assertFalse(is_sstable(FILENAME))
+
+    def test_open_rejects_unknown_version(self):
+        '''
+        Tests that a table written with an unknown format version isn't opened.
+        '''
+        self.write_table([('chris', 'lessard')])
+        with open(FILENAME, 'r+b') as s:
+            s.seek(-FOOTER.size, 2)
+            footer = list(FOOTER.unpack(s.read()))
+            footer[4] = 99
+            s.seek(-FOOTER.size, 2)
+            s.write(FOOTER.pack(*footer))
+
+        with self.assertRaises(ValueError):
+            SSTable(FILENAME)
+
+if __name__ == '__main__':
+    unittest.main()
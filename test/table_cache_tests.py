@@ -0,0 +1,87 @@
+import unittest
+from src.table_cache import TableCache
+
+class Reader():
+    '''
+    Stands in for an open segment reader, recording whether it was closed.
+    '''
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TableCacheTests(unittest.TestCase):
+    def test_get_returns_cached_reader(self):
+        '''
+        Tests that readers are found by segment name, and misses return None.
+        '''
+        cache = TableCache(2)
+        reader = Reader()
+        cache.put('segment1', reader)
+
+        self.assertIs(cache.get('segment1'), reader)
+        self.assertIsNone(cache.get('segment2'))
+        self.assertIn('segment1', cache)
+
+    def test_put_evicts_least_recently_used(self):
+        '''
+        Tests that once the cache is full, the reader read the longest ago is
+        evicted, without being closed.
+        '''
+        cache = TableCache(2)
+        readers = [Reader() for i in range(3)]
+        cache.put('segment1', readers[0])
+        cache.put('segment2', readers[1])
+        cache.get('segment1')
+        cache.put('segment3', readers[2])
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('segment2', cache)
+        self.assertIn('segment1', cache)
+        self.assertIn('segment3', cache)
+        self.assertFalse(readers[1].closed)
+
+    def test_evict_closes_reader(self):
+        '''
+        Tests that evicting a segment's reader closes it.
+        '''
+        cache = TableCache(2)
+        reader = Reader()
+        cache.put('segment1', reader)
+
+        cache.evict('segment1')
+        cache.evict('segment2')
+
+        self.assertTrue(reader.closed)
+        self.assertEqual(len(cache), 0)
+
+    def test_set_max_open_files_shrinks_cache(self):
+        '''
+        Tests that lowering the limit evicts the least recently used readers.
+        '''
+        cache = TableCache(4)
+        for i in range(4):
+            cache.put('segment' + str(i), Reader())
+
+        cache.set_max_open_files(1)
+
+        self.assertEqual(len(cache), 1)
+        self.assertIn('segment3', cache)
+
+    def test_clear_closes_every_reader(self):
+        '''
+        Tests that clearing the cache closes every reader in it.
+        '''
+        cache = TableCache(4)
+        readers = [Reader() for i in range(3)]
+        for i, reader in enumerate(readers):
+            cache.put('segment' + str(i), reader)
+
+        cache.clear()
+
+        self.assertEqual(len(cache), 0)
+        self.assertTrue(all(reader.closed for reader in readers))
+
+if __name__ == '__main__':
+    unittest.main()